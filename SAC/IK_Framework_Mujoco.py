@@ -13,6 +13,7 @@ import numpy as np
 from gym import utils
 from . import sensory_feedback_specs
 from . import kinematics_preprocessing_specs
+from . import kinematics_cache
 
 import ipdb
 
@@ -53,10 +54,11 @@ class MujocoEnv(gym.Env):
 
         #Load the kin_train
         # Load the experimental kinematics x and y coordinates from the data
-        with open(self.kinematics_path + '/kinematics.pkl', 'rb') as f:
-            kin_train_test = pickle.load(f)
+        #The kinematics are scaled and centered as specified by trajectory_scaling and center, and loaded from the preprocessed cache
+        self.radius = args.trajectory_scaling
+        self.center = args.center
 
-        kin_train = kin_train_test['train'] #[num_conds][num_targets, num_coords, timepoints]
+        kin_train, _ = kinematics_cache.load_kinematics(self.kinematics_path, self.radius, self.center) #[num_conds][num_targets, num_coords, timepoints]
 
         #Randomly sample the number of targets from a condition = 0
         num_targets = kin_train[0].shape[0]
@@ -77,17 +79,6 @@ class MujocoEnv(gym.Env):
 
 
         self.n_fixedsteps = args.n_fixedsteps
-        self.radius = args.trajectory_scaling
-        self.center = args.center
-
-        #Kinematics preprocessing for training and testing kinematics
-        #Preprocess training kinematics
-        for i_target in range(kin_train[0].shape[0]):
-            for i_cond in range(len(kin_train)):
-                for i_coord in range(kin_train[i_cond].shape[1]):
-                    kin_train[i_cond][i_target, i_coord, :] = kin_train[i_cond][i_target, i_coord, :] / self.radius[i_target]
-                    kin_train[i_cond][i_target, i_coord, :] = kin_train[i_cond][i_target, i_coord, :] + self.center[i_target][i_coord]
-
 
         self.kin_train = kin_train
         self.kin_to_sim = self.kin_train
@@ -7,11 +7,15 @@ import numpy as np
 from os import path
 import gym
 import pickle
+import traceback
+import multiprocessing as mp
 
 import numpy as np
 from gym import utils
 from . import sensory_feedback_specs, reward_function_specs, perturbation_specs
 from . import kinematics_preprocessing_specs
+from . import kinematics_cache
+from .step_profiler import StepProfiler
 
 try:
     import mujoco_py
@@ -63,6 +67,9 @@ class MujocoEnv(gym.Env):
         if args.sim_dt != 0:
             self.model.opt.timestep = args.sim_dt
 
+        #Skip the forward passes that are recomputed by the next mj_step anyway
+        self.lean_stepping = args.lean_stepping
+
         #Save all the sensory feedback specs for use in the later functions
         self.sfs_stimulus_feedback = args.stimulus_feedback
         self.sfs_proprioceptive_feedback = args.proprioceptive_feedback
@@ -73,13 +80,14 @@ class MujocoEnv(gym.Env):
         self.sfs_visual_distance_bodies = args.visual_distance_bodies
         self.sfs_visual_velocity = args.visual_velocity
         self.sfs_sensory_delay_timepoints = args.sensory_delay_timepoints
+        self.sfs_channel_delay_timepoints = args.channel_delay_timepoints or []
 
         # Load the experimental kinematics x and y coordinates from the data
-        with open(self.kinematics_path + '/kinematics.pkl', 'rb') as f:
-            kin_train_test = pickle.load(f)
+        #The kinematics are scaled and centered as specified by trajectory_scaling and center, and loaded from the preprocessed cache
+        self.radius = args.trajectory_scaling
+        self.center = args.center
 
-        kin_train = kin_train_test['train']     #[num_conds][num_targets, num_coords, timepoints]
-        kin_test = kin_train_test['test']       #[num_conds][num_targets, num_coords, timepoints]
+        kin_train, kin_test = kinematics_cache.load_kinematics(self.kinematics_path, self.radius, self.center)     #[num_conds][num_targets, num_coords, timepoints]
 
 
         #Load the neural activities for nusim if they exist
@@ -95,8 +103,8 @@ class MujocoEnv(gym.Env):
             self.nusim_data_exists = False
             assert args.zeta_nusim == 0, "Neural Activity not provided for nuSim training"
             #Create a dummy neural activity as it is not being used anywhere
-            na_train = kin_train_test['train']
-            na_test = kin_train_test['test']
+            na_train = {cond: np.array(kin_cond) for cond, kin_cond in kin_train.items()}
+            na_test = {cond: np.array(kin_cond) for cond, kin_cond in kin_test.items()}
 
         #Normalize the neural activity
         for na_idx, na_item in na_train.items():
@@ -121,8 +129,6 @@ class MujocoEnv(gym.Env):
 
         self.n_fixedsteps = args.n_fixedsteps
         self.timestep_limit = args.timestep_limit
-        self.radius = args.trajectory_scaling
-        self.center = args.center
 
         #The threshold is varied dynamically in the step and reset functions 
         self.threshold_user = 0.064   #Previously it was 0.1
@@ -134,21 +140,6 @@ class MujocoEnv(gym.Env):
         self.na_to_sim = na_train
 
 
-        #Kinematics preprocessing for training and testing kinematics
-        #Preprocess training kinematics
-        for i_target in range(kin_train[0].shape[0]):
-            for i_cond in range(len(kin_train)):
-                for i_coord in range(kin_train[i_cond].shape[1]):
-                    kin_train[i_cond][i_target, i_coord, :] = kin_train[i_cond][i_target, i_coord, :] / self.radius[i_target]
-                    kin_train[i_cond][i_target, i_coord, :] = kin_train[i_cond][i_target, i_coord, :] + self.center[i_target][i_coord]
-
-        #Preprocess testing kinematics
-        for i_target in range(kin_test[0].shape[0]):
-            for i_cond in range(len(kin_test)):
-                for i_coord in range(kin_test[i_cond].shape[1]):
-                    kin_test[i_cond][i_target, i_coord, :] = kin_test[i_cond][i_target, i_coord, :] / self.radius[i_target]
-                    kin_test[i_cond][i_target, i_coord, :] = kin_test[i_cond][i_target, i_coord, :] + self.center[i_target][i_coord]
-
         self.kin_train = kin_train 
         self.kin_test = kin_test 
 
@@ -173,7 +164,9 @@ class MujocoEnv(gym.Env):
         self.init_qvel = np.load(args.initial_pose_path + '/initial_qpos_opt.npy')*0
 
         self._set_action_space()
-        
+
+        self._compile_obs_layout()
+        self._compile_delay_line()
         self._set_observation_space(self._get_obs())
 
         self.seed()
@@ -261,6 +254,7 @@ class MujocoEnv(gym.Env):
         self.theta= np.pi
         self.threshold= self.threshold_user
         self.sim.reset()
+        self._set_target_trajectory()
         ob = self.reset_model()
         return ob
 
@@ -280,6 +274,14 @@ class MujocoEnv(gym.Env):
 
     def do_simulation(self, ctrl, n_frames):
         self.sim.data.ctrl[:]= ctrl 
+        if self.lean_stepping:
+            #mj_step runs the forward dynamics before integrating every frame, so only the state
+            #after the last frame needs a forward pass for the reward and the observation
+            for _ in range(n_frames):
+                self.sim.step()
+            self.sim.forward()
+            return
+
         for _ in range(n_frames):
             self.sim.data.ctrl[:]= ctrl
             self.sim.step()
@@ -353,21 +355,90 @@ class Muscle_Env(MujocoEnv):
     def __init__(self, model_path, frame_skip, args):
         MujocoEnv.__init__(self, model_path, frame_skip, args)
 
+        self._compile_target_joints()
+        self._compile_tracking_bodies()
+
+        #Time the phases of every step if requested
+        self.step_profiler = None
+        if args.profile_env_step:
+            self.step_profiler = StepProfiler()
+            self.step_profiler.instrument(self)
+
+    def _compile_tracking_bodies(self):
+
+        #Body ids of the musculo_tracking pairs for the reward, followed by the hand/target0 pair
+        #used for the termination criteria if it is not already tracked
+        tracking_pairs = [tuple(musculo_body_tracking) for musculo_body_tracking in reward_function_specs.musculo_tracking]
+        self._n_tracking = len(tracking_pairs)
+
+        if ("hand", "target0") not in tracking_pairs:
+            tracking_pairs.append(("hand", "target0"))
+
+        self._done_pair = tracking_pairs.index(("hand", "target0"))
+        self._tracking_ids = reward_function_specs.tracking_body_ids(self.model, tracking_pairs)
+        self._tracking_dists = np.zeros((len(tracking_pairs), 3))
+
+    def _update_tracking_distances(self):
+        self._tracking_dists = reward_function_specs.tracking_distances(self.sim.data.body_xpos, self._tracking_ids)
+
+    def _compile_target_joints(self):
+
+        #Resolve the qpos addresses of the target joints once, together with the kinematics row driving each of them
+        self._target_qpos_addrs = []
+        self._target_kin_idx = []
+        self._target_kin_rows = []
+
+        n_targets = self.kin_to_sim[self.current_cond_to_sim].shape[0]
+        for i_target in range(n_targets):
+            xyz_target = kinematics_preprocessing_specs.xyz_target[i_target]
+
+            if xyz_target[0]:
+                self._target_qpos_addrs.append(self.model.get_joint_qpos_addr("box:x{}".format(i_target)))
+                self._target_kin_idx.append(i_target)
+                self._target_kin_rows.append(0)
+
+            if xyz_target[1]:
+                self._target_qpos_addrs.append(self.model.get_joint_qpos_addr("box:y{}".format(i_target)))
+                self._target_kin_idx.append(i_target)
+                self._target_kin_rows.append(xyz_target[0])
+
+            if xyz_target[2]:
+                self._target_qpos_addrs.append(self.model.get_joint_qpos_addr("box:z{}".format(i_target)))
+                self._target_kin_idx.append(i_target)
+                self._target_kin_rows.append(xyz_target[0] + xyz_target[1])
+
+        self._target_qpos_addrs = np.array(self._target_qpos_addrs, dtype=np.int64)
+        self._target_kin_idx = np.array(self._target_kin_idx, dtype=np.int64)
+        self._target_kin_rows = np.array(self._target_kin_rows, dtype=np.int64)
+
+    def _set_target_trajectory(self):
+
+        #Lay out the target trajectory of the current condition as [timepoints, n_target_dofs]
+        coords_to_sim = self.kin_to_sim[self.current_cond_to_sim]
+        self._target_traj = np.ascontiguousarray(coords_to_sim[self._target_kin_idx, self._target_kin_rows, :].T)
+
     def get_cost(self, action):
         scaler= 1/50
         act= np.array(action)
         cost= scaler * np.sum(np.abs(act))
         return cost
 
-    def is_done(self):
-        #Define the distance threshold termination criteria
-        target_position= self.sim.data.get_body_xpos("target0").copy()
-        hand_position= self.sim.data.get_body_xpos("hand").copy()
-        
-        criteria= hand_position - target_position
+    def get_reward(self, action):
+
+        #Currently the reward function is the function of the delayed state, current simulator state, action and threshold
+        if self._max_delay != 0:
+            state_td = self._read_delay_line(self.istep, reward_read=True)
+        else:
+            #Pass a dummy variable for the delayed state feedback
+            state_td = 0
+
+        return reward_function_specs.reward_function(state_td, self.sim, action, self.threshold,
+                                                     xyz_coord_dists=self._tracking_dists[:self._n_tracking])
 
+    def is_done(self):
+        #Define the distance threshold termination criteria on the hand/target0 distances computed for this step
         if self.istep < self.timestep_limit:
-            if np.abs(criteria[0]) > self.threshold or np.abs(criteria[1]) > self.threshold or np.abs(criteria[2]) > self.threshold:
+            if (self._tracking_dists[self._done_pair] > self.threshold).any():
                 return True
             else:
                 return False
@@ -385,21 +456,16 @@ class Muscle_Env(MujocoEnv):
             self.threshold = 0.008
 
         #Save the xpos of the musculo bodies for visual vels
-        if len(self.sfs_visual_velocity) != 0:
-            prev_body_xpos = []
-            for musculo_body in self.sfs_visual_velocity:
-                body_xpos = self.sim.data.get_body_xpos(musculo_body)
-                prev_body_xpos = [*prev_body_xpos, *body_xpos]
+        if "visual_velocity" in self._obs_layout:
+            np.take(self.sim.data.body_xpos, self._visual_velocity_ids, axis=0, out=self._prev_velocity_xpos)
 
         #Now carry out one step of the MuJoCo simulation
         self.do_simulation(action, self.frame_skip)
 
-        #Currently the reward function is the function of the delayed state, current simulator state, action and threshold
-        if self.sfs_sensory_delay_timepoints != 0:
-            reward= reward_function_specs.reward_function(self.state_to_return[-1], self.sim, action, self.threshold)
-        else:
-            #Pass a dummy variable for the delayed state feedback
-            reward= reward_function_specs.reward_function(0, self.sim, action, self.threshold)
+        #The distances between the musculo bodies and the targets are shared by the reward and the termination criteria
+        self._update_tracking_distances()
+
+        reward= self.get_reward(action)
             
         cost= self.get_cost(action)
         final_reward= (5*reward) #- (0.5*cost)
@@ -408,36 +474,16 @@ class Muscle_Env(MujocoEnv):
 
         self.upd_theta()
 
-        visual_vels = []
-        #Find the visual vels after the simulation
-        if len(self.sfs_visual_velocity) != 0:
-            current_body_xpos = []
-            for musculo_body in self.sfs_visual_velocity:
-                body_xpos = self.sim.data.get_body_xpos(musculo_body)
-                current_body_xpos = [*current_body_xpos, *body_xpos]
-
-            #Find the velocity
-            visual_vels = (np.abs(np.array(prev_body_xpos) - np.array(current_body_xpos)) / self.dt).tolist()
-
         ob= self._get_obs()
-        
-        #process visual velocity feedback
-        if self.mode_to_sim in ["sensory_pert"]:
-            visual_vels = sensory_feedback_specs.process_visual_velocity_pert(visual_vels, self.istep)
-
-        visual_vels = sensory_feedback_specs.process_visual_velocity(visual_vels)
-
-        if self.mode_to_sim in ["SFE"] and "visual_velocity" in perturbation_specs.sf_elim:
-            obser= [*ob, *[ele*0 for ele in visual_vels]]
-        else:
-            obser= [*ob, *visual_vels]
 
-        #Append the current observation to the start of the list
-        #Return the last observation later on
-        self.state_to_return.insert(0, obser)
+        #Find the visual vels after the simulation
+        if "visual_velocity" in self._obs_layout:
+            self._get_visual_velocity()
 
+        #Write the current observation into the delay line and return the delayed observation
+        self._write_delay_line(self.istep)
 
-        return self.state_to_return.pop(), final_reward, done, {}
+        return self._read_delay_line(self.istep), final_reward, done, {}
 
     def viewer_setup(self):
         self.viewer.cam.trackbodyid = 0
@@ -449,120 +495,221 @@ class Muscle_Env(MujocoEnv):
 
         #Now get the observation of the initial state and append zeros corresponding to the velocity of musculo bodies 
         #as specified in sensory_feedback_specs (len*3 for x/y/z vel for each musculo body)
-        initial_state_obs = [*self._get_obs(), *np.zeros(len(self.sfs_visual_velocity)*3)]
+        self._get_obs()
+        self._obs_buffer[self._n_obs_features:] = 0
 
-        #Maintain a list of state observations for implementing the state delay
-        self.state_to_return = [[0]*len(initial_state_obs)] * self.sfs_sensory_delay_timepoints
-        #Insert the inital state obs to the start of the list
-        self.state_to_return.insert(0, initial_state_obs)
+        #The delay line holds zeros before the initial state
+        self._delay_line[:] = 0
+        self._write_delay_line(0)
 
-        #Return the last element of the state_to_return 
-        return self.state_to_return.pop()
+        #Return the delayed initial observation
+        return self._read_delay_line(0)
 
-    def _get_obs(self):
-        
-        sensory_feedback = []
+    def _compile_obs_layout(self):
+
+        #Resolve the enabled feedback channels, their slices in the observation and the ids of the
+        #musculo bodies once, so that _get_obs writes straight into a preallocated float32 buffer
+        self._obs_layout = OrderedDict()
+        n_features = 0
+
+        channel_sizes = []
         if self.sfs_stimulus_feedback == True:
-            stim_feedback = self.stim_data_sim[self.current_cond_to_sim][max(0, self.istep - 1), :].tolist()  #other feedbacks are in in lists
+            channel_sizes.append(("stimulus", self.stim_data_sim[0].shape[1]))
 
-            #process through the given function for muscle lens and muscle vels
-            if self.mode_to_sim in ["sensory_pert"]:
-                stim_feedback = sensory_feedback_specs.process_stimulus_pert(stim_feedback, self.istep)
+        if self.sfs_proprioceptive_feedback == True:
+            channel_sizes.append(("proprioceptive", 2*self.model.nu))
 
-            stim_feedback = sensory_feedback_specs.process_stimulus(stim_feedback)
+        if self.sfs_muscle_forces == True:
+            channel_sizes.append(("muscle_forces", self.model.nv))
 
-            if self.mode_to_sim in ["SFE"] and "stimulus" in perturbation_specs.sf_elim:
-                sensory_feedback = [*sensory_feedback, *[ele*0 for ele in stim_feedback]]
-            else:
-                sensory_feedback = [*sensory_feedback, *stim_feedback]
+        if self.sfs_joint_feedback == True:
+            channel_sizes.append(("joint_feedback", self.model.nq + self.model.nv))
 
+        if self.sfs_visual_feedback == True:
+            #Check if the user specified the musculo bodies to be included
+            assert len(self.sfs_visual_feedback_bodies) != 0
+            channel_sizes.append(("visual_position", 3*len(self.sfs_visual_feedback_bodies)))
 
-        if self.sfs_proprioceptive_feedback == True:
-            muscle_lens = self.sim.data.actuator_length.flat.copy()
-            muscle_vels = self.sim.data.actuator_velocity.flat.copy()
+        if len(self.sfs_visual_distance_bodies) != 0:
+            channel_sizes.append(("visual_distance", 3*len(self.sfs_visual_distance_bodies)))
 
-            #process through the given function for muscle lens and muscle vels
-            if self.mode_to_sim in ["sensory_pert"]:
-                muscle_lens, muscle_vels = sensory_feedback_specs.process_proprioceptive_pert(muscle_lens, muscle_vels, self.istep)
+        #The visual velocity is appended after the observation returned by _get_obs
+        if len(self.sfs_visual_velocity) != 0:
+            channel_sizes.append(("visual_velocity", 3*len(self.sfs_visual_velocity)))
 
-            muscle_lens, muscle_vels = sensory_feedback_specs.process_proprioceptive(muscle_lens, muscle_vels)
+        for channel, n_channel in channel_sizes:
+            self._obs_layout[channel] = slice(n_features, n_features + n_channel)
+            n_features += n_channel
 
-            if self.mode_to_sim in ["SFE"] and "proprioceptive" in perturbation_specs.sf_elim:
-                sensory_feedback = [*sensory_feedback, *[ele*0 for ele in muscle_lens], *[ele*0 for ele in muscle_vels]]
-            else:
-                sensory_feedback = [*sensory_feedback, *muscle_lens, *muscle_vels]
+        self._n_obs_features = n_features - 3*len(self.sfs_visual_velocity)
+        self._obs_buffer = np.zeros((n_features,), dtype=np.float32)
 
+        #Channels eliminated in the SFE mode are kept at zero
+        self._obs_eliminated = []
+        if self.mode_to_sim in ["SFE"]:
+            self._obs_eliminated = [channel for channel in self._obs_layout if channel in perturbation_specs.sf_elim]
 
-        if self.sfs_muscle_forces == True:
-            actuator_forces = self.sim.data.qfrc_actuator.flat.copy()
+        self._sensory_pert = self.mode_to_sim in ["sensory_pert"]
+        self._feedback_hooks = sensory_feedback_specs
 
-            #process
-            if self.mode_to_sim in ["sensory_pert"]:
-                actuator_forces = sensory_feedback_specs.process_muscle_forces_pert(actuator_forces, self.istep)
+        #Body ids and scratch arrays for the visual feedback
+        body_id = self.model.body_name2id
+        if self.sfs_visual_feedback == True:
+            self._visual_position_ids = np.array([body_id(musculo_body) for musculo_body in self.sfs_visual_feedback_bodies])
+            self._visual_position_xpos = np.zeros((len(self._visual_position_ids), 3))
 
-            actuator_forces = sensory_feedback_specs.process_muscle_forces(actuator_forces)
-            
-            if self.mode_to_sim in ["SFE"] and "muscle_forces" in perturbation_specs.sf_elim:
-                sensory_feedback = [*sensory_feedback, *[ele*0 for ele in actuator_forces]]
-            else:
-                sensory_feedback = [*sensory_feedback, *actuator_forces]
+        if len(self.sfs_visual_distance_bodies) != 0:
+            self._visual_distance_ids = np.array([[body_id(musculo_tuple[0]), body_id(musculo_tuple[1])] for musculo_tuple in self.sfs_visual_distance_bodies])
+            self._visual_distance_xpos0 = np.zeros((len(self._visual_distance_ids), 3))
+            self._visual_distance_xpos1 = np.zeros((len(self._visual_distance_ids), 3))
 
+        if len(self.sfs_visual_velocity) != 0:
+            self._visual_velocity_ids = np.array([body_id(musculo_body) for musculo_body in self.sfs_visual_velocity])
+            self._prev_velocity_xpos = np.zeros((len(self._visual_velocity_ids), 3))
+            self._current_velocity_xpos = np.zeros((len(self._visual_velocity_ids), 3))
 
-        if self.sfs_joint_feedback == True:
-            sensory_qpos = self.sim.data.qpos.flat.copy()
-            sensory_qvel = self.sim.data.qvel.flat.copy()
+    def _compile_delay_line(self):
+
+        #Per-feature delays: sensory_delay_timepoints for all channels unless overridden in channel_delay_timepoints
+        self._obs_delays = np.full(self._obs_buffer.shape, self.sfs_sensory_delay_timepoints, dtype=np.int64)
+
+        for channel, delay in self.sfs_channel_delay_timepoints:
+            assert channel in self._obs_layout, "Delay specified for a sensory feedback channel ({}) that is not included".format(channel)
+            assert int(delay) >= 0, "Sensory delays should be non-negative"
+            self._obs_delays[self._obs_layout[channel]] = int(delay)
+
+        self._max_delay = int(self._obs_delays.max()) if self._obs_delays.size else 0
+        self._uniform_delay = (self._obs_delays == self._max_delay).all()
+
+        #Ring buffer of the last max_delay+1 observations, observation t is stored at row t % (max_delay+1)
+        self._delay_depth = self._max_delay + 1
+        self._delay_line = np.zeros((self._delay_depth, self._obs_buffer.shape[0]), dtype=np.float32)
+        self._delay_cols = np.arange(self._obs_buffer.shape[0])
+
+        #Zero delay channels read the latest observation already written when the reward is computed
+        self._reward_delays = np.maximum(self._obs_delays, 1)
+
+    def _write_delay_line(self, t):
+        self._delay_line[t % self._delay_depth] = self._obs_buffer
+
+    def _read_delay_line(self, t, reward_read=False):
+
+        #Returns a new array with the observation delayed per feature
+        if self._uniform_delay:
+            return self._delay_line[(t - self._max_delay) % self._delay_depth].copy()
+
+        delays = self._reward_delays if reward_read else self._obs_delays
+        return self._delay_line[(t - delays) % self._delay_depth, self._delay_cols]
+
+    def _write_feedback(self, feedback_buffers, processed_feedback):
+
+        #The sensory feedback functions may process the buffers in place or return new values
+        for feedback_buffer, feedback in zip(feedback_buffers, processed_feedback):
+            if feedback is not feedback_buffer:
+                feedback_buffer[:] = feedback
+
+    def _get_obs(self):
+
+        #Builds the observation in place in _obs_buffer (float32) and returns a copy of its _get_obs features
+        obs = self._obs_buffer
+        layout = self._obs_layout
+        data = self.sim.data
+
+        if "stimulus" in layout:
+            stim_feedback = obs[layout["stimulus"]]
+            stim_feedback[:] = self.stim_data_sim[self.current_cond_to_sim][max(0, self.istep - 1), :]
+
+            #process through the given function for the stimulus feedback
+            if self._sensory_pert:
+                self._write_feedback((stim_feedback,), (self._feedback_hooks.process_stimulus_pert(stim_feedback, self.istep),))
+
+            self._write_feedback((stim_feedback,), (self._feedback_hooks.process_stimulus(stim_feedback),))
+
+        if "proprioceptive" in layout:
+            proprioceptive = obs[layout["proprioceptive"]]
+            muscle_lens = proprioceptive[:self.model.nu]
+            muscle_vels = proprioceptive[self.model.nu:]
+            np.copyto(muscle_lens, data.actuator_length)
+            np.copyto(muscle_vels, data.actuator_velocity)
+
+            #process through the given function for muscle lens and muscle vels
+            if self._sensory_pert:
+                self._write_feedback((muscle_lens, muscle_vels), self._feedback_hooks.process_proprioceptive_pert(muscle_lens, muscle_vels, self.istep))
+
+            self._write_feedback((muscle_lens, muscle_vels), self._feedback_hooks.process_proprioceptive(muscle_lens, muscle_vels))
+
+        if "muscle_forces" in layout:
+            actuator_forces = obs[layout["muscle_forces"]]
+            np.copyto(actuator_forces, data.qfrc_actuator)
 
             #process
-            if self.mode_to_sim in ["sensory_pert"]:
-                sensory_qpos, sensory_qvel = sensory_feedback_specs.process_joint_feedback_pert(sensory_qpos, sensory_qvel, self.istep)
+            if self._sensory_pert:
+                self._write_feedback((actuator_forces,), (self._feedback_hooks.process_muscle_forces_pert(actuator_forces, self.istep),))
 
-            sensory_qpos, sensory_qvel = sensory_feedback_specs.process_joint_feedback(sensory_qpos, sensory_qvel)
-            
-            if self.mode_to_sim in ["SFE"] and "joint_feedback" in perturbation_specs.sf_elim:
-                sensory_feedback = [*sensory_feedback, *[ele*0 for ele in sensory_qpos], *[ele*0 for ele in sensory_qvel]]
-            else:
-                sensory_feedback = [*sensory_feedback, *sensory_qpos, *sensory_qvel]
+            self._write_feedback((actuator_forces,), (self._feedback_hooks.process_muscle_forces(actuator_forces),))
 
+        if "joint_feedback" in layout:
+            joint_feedback = obs[layout["joint_feedback"]]
+            sensory_qpos = joint_feedback[:self.model.nq]
+            sensory_qvel = joint_feedback[self.model.nq:]
+            np.copyto(sensory_qpos, data.qpos)
+            np.copyto(sensory_qvel, data.qvel)
 
-        if self.sfs_visual_feedback == True:
-            
-            #Check if the user specified the musculo bodies to be included
-            assert len(self.sfs_visual_feedback_bodies) != 0
+            #process
+            if self._sensory_pert:
+                self._write_feedback((sensory_qpos, sensory_qvel), self._feedback_hooks.process_joint_feedback_pert(sensory_qpos, sensory_qvel, self.istep))
 
-            visual_xyz_coords = []
-            for musculo_body in self.sfs_visual_feedback_bodies:
-                visual_xyz_coords = [*visual_xyz_coords, *self.sim.data.get_body_xpos(musculo_body)]
+            self._write_feedback((sensory_qpos, sensory_qvel), self._feedback_hooks.process_joint_feedback(sensory_qpos, sensory_qvel))
 
-            if self.mode_to_sim in ["sensory_pert"]:
-                visual_xyz_coords = sensory_feedback_specs.process_visual_position_pert(visual_xyz_coords, self.istep)
+        if "visual_position" in layout:
+            visual_xyz_coords = obs[layout["visual_position"]]
+            np.take(data.body_xpos, self._visual_position_ids, axis=0, out=self._visual_position_xpos)
+            np.copyto(visual_xyz_coords.reshape(-1, 3), self._visual_position_xpos)
 
-            visual_xyz_coords = sensory_feedback_specs.process_visual_position(visual_xyz_coords)
-            
-            if self.mode_to_sim in ["SFE"] and "visual_position" in perturbation_specs.sf_elim:
-                sensory_feedback = [*sensory_feedback, *[ele*0 for ele in visual_xyz_coords]]
-            else:
-                sensory_feedback = [*sensory_feedback, *visual_xyz_coords]
+            if self._sensory_pert:
+                self._write_feedback((visual_xyz_coords,), (self._feedback_hooks.process_visual_position_pert(visual_xyz_coords, self.istep),))
 
-        if len(self.sfs_visual_distance_bodies) != 0:
-            visual_xyz_distance = []
-            for musculo_tuple in self.sfs_visual_distance_bodies:
-                body0_xyz = self.sim.data.get_body_xpos(musculo_tuple[0])
-                body1_xyz = self.sim.data.get_body_xpos(musculo_tuple[1])
-                tuple_dist = (body0_xyz - body1_xyz).tolist()
-                visual_xyz_distance = [*visual_xyz_distance, *tuple_dist]
+            self._write_feedback((visual_xyz_coords,), (self._feedback_hooks.process_visual_position(visual_xyz_coords),))
+
+        if "visual_distance" in layout:
+            visual_xyz_distance = obs[layout["visual_distance"]]
+            body_xpos = data.body_xpos
+            np.take(body_xpos, self._visual_distance_ids[:, 0], axis=0, out=self._visual_distance_xpos0)
+            np.take(body_xpos, self._visual_distance_ids[:, 1], axis=0, out=self._visual_distance_xpos1)
+            np.subtract(self._visual_distance_xpos0, self._visual_distance_xpos1, out=visual_xyz_distance.reshape(-1, 3))
 
             #process
-            if self.mode_to_sim in ["sensory_pert"]:
-                visual_xyz_distance = sensory_feedback_specs.process_visual_distance_pert(visual_xyz_distance, self.istep)
+            if self._sensory_pert:
+                self._write_feedback((visual_xyz_distance,), (self._feedback_hooks.process_visual_distance_pert(visual_xyz_distance, self.istep),))
 
-            visual_xyz_distance = sensory_feedback_specs.process_visual_distance(visual_xyz_distance)
+            self._write_feedback((visual_xyz_distance,), (self._feedback_hooks.process_visual_distance(visual_xyz_distance),))
 
-            if self.mode_to_sim in ["SFE"] and "visual_distance" in perturbation_specs.sf_elim:
-                sensory_feedback = [*sensory_feedback, *[ele*0 for ele in visual_xyz_distance]]
-            else:
-                sensory_feedback = [*sensory_feedback, *visual_xyz_distance]
+        for channel in self._obs_eliminated:
+            if channel != "visual_velocity":
+                obs[layout[channel]] = 0
+
+        return obs[:self._n_obs_features].copy()
+
+    def _get_visual_velocity(self):
 
-        return np.array(sensory_feedback)
+        #Absolute velocity of the musculo bodies over the last step, written after the _get_obs features
+        visual_vels = self._obs_buffer[self._obs_layout["visual_velocity"]]
+
+        np.take(self.sim.data.body_xpos, self._visual_velocity_ids, axis=0, out=self._current_velocity_xpos)
+        np.subtract(self._prev_velocity_xpos, self._current_velocity_xpos, out=self._prev_velocity_xpos)
+        np.abs(self._prev_velocity_xpos, out=self._prev_velocity_xpos)
+        np.divide(self._prev_velocity_xpos, self.dt, out=visual_vels.reshape(-1, 3))
+
+        #process visual velocity feedback
+        if self._sensory_pert:
+            self._write_feedback((visual_vels,), (self._feedback_hooks.process_visual_velocity_pert(visual_vels, self.istep),))
+
+        self._write_feedback((visual_vels,), (self._feedback_hooks.process_visual_velocity(visual_vels),))
+
+        if "visual_velocity" in self._obs_eliminated:
+            visual_vels[:] = 0
+
+        return visual_vels
 
     def upd_theta(self):
         if self.istep <= self._max_episode_steps:
@@ -576,24 +723,259 @@ class Muscle_Env(MujocoEnv):
 
         self.coord_idx = self.tpoint_to_sim
 
-        coords_to_sim = self.kin_to_sim[self.current_cond_to_sim]
-        
-        crnt_state = self.sim.get_state()
+        #Write the target positions straight into qpos and recompute the derived quantities
+        self.sim.data.qpos[self._target_qpos_addrs] = self._target_traj[self.tpoint_to_sim]
+
+        if self.lean_stepping:
+            #The targets are kinematic bodies, their positions only need the forward kinematics
+            mujoco_py.functions.mj_kinematics(self.model, self.sim.data)
+        else:
+            self.sim.forward()
+
+
+def vector_env_step(env, action):
+
+    #Repeat the same action for frame_repeat timepoints as in the single environment training
+    reward = 0
+    n_steps = 0
+    for _ in range(env.frame_repeat):
+        ob, inter_reward, done, _ = env.step(action)
+
+        reward += inter_reward
+        n_steps += 1
+
+        if done:
+            break
+
+    step_profile = None
+    if done and env.step_profiler is not None:
+        step_profile = env.step_profiler.pop_summary()
+
+    return ob, reward, done, n_steps, env.current_cond_to_sim, env._max_episode_steps, step_profile, *vector_env_decision_state(env)
+
+def vector_env_reset(env, cond_to_select):
+
+    ob = env.reset(cond_to_select)
+
+    return ob, *vector_env_decision_state(env)
+
+def vector_env_decision_state(env):
+
+    #High-level task scalar, neural activity index and neural activity row of the next decision
+    na_idx = env.coord_idx
+    if not env.nusim_data_exists:
+        env.neural_activity[na_idx] = 0
+
+    return env.condition_scalar, na_idx, np.array(env.neural_activity[na_idx])
 
-        for i_target in range(self.kin_to_sim[self.current_cond_to_sim].shape[0]):
-            if kinematics_preprocessing_specs.xyz_target[i_target][0]:
-                x_joint_idx= self.model.get_joint_qpos_addr(f"box:x{i_target}")
-                crnt_state.qpos[x_joint_idx] = coords_to_sim[i_target, 0, self.tpoint_to_sim]
+def vector_env_worker(remote, env_class, model_path, frame_skip, args, env_seeds):
 
+    #Owns a group of environments and steps them on the commands of VectorMuscleEnv
+    try:
+        envs = [env_class(model_path, frame_skip, args) for _ in env_seeds]
+        for env, env_seed in zip(envs, env_seeds):
+            env.seed(env_seed)
 
-            if kinematics_preprocessing_specs.xyz_target[i_target][1]:
-                y_joint_idx= self.model.get_joint_qpos_addr(f"box:y{i_target}")
-                crnt_state.qpos[y_joint_idx] = coords_to_sim[i_target, kinematics_preprocessing_specs.xyz_target[i_target][0], self.tpoint_to_sim]
+        remote.send(("ok", (envs[0].n_exp_conds, envs[0].frame_repeat,
+                            envs[0].observation_space.shape[0] + len(envs[0].sfs_visual_velocity)*3 + 1)))
+
+        while True:
+            command, data = remote.recv()
+
+            if command == "step":
+                remote.send(("ok", [vector_env_step(env, action) for env, action in zip(envs, data)]))
+            elif command == "reset":
+                remote.send(("ok", [vector_env_reset(envs[i_local], cond_to_select) for i_local, cond_to_select in data]))
+            elif command == "close":
+                for env in envs:
+                    env.close()
+                break
+
+    except Exception:
+        remote.send(("error", traceback.format_exc()))
+        raise
+
+class VectorMuscleEnv():
+
+    """Steps n_envs independent musculoskeletal environments in lockstep
+
+        Every environment owns its own MjSim. Observations are returned stacked as (n_envs, obs_dim)
+        with the high-level task scalar appended as the last feature, as consumed by the agent.
+        An environment that is done is reset automatically to the condition returned by cond_selector(i_env),
+        its final observation is returned in infos[i_env]["terminal_observation"].
+
+        With n_workers > 0 the environments are split across n_workers processes that step their groups in parallel,
+        mujoco_py 2.1 holds the GIL while stepping and has no MjSimPool, so threads would not overlap the physics.
+        The neural activity index and row of the next decision of every environment are kept in coord_idx
+        and neural_activities, with n_workers > 0 the environments are not accessible from this process.
+    """
+
+    def __init__(self, env_class, model_path, frame_skip, args, n_envs, cond_selector=None, n_workers=0):
+
+        self.n_envs = n_envs
+        self.n_workers = min(n_workers, n_envs)
+        env_seeds = [args.seed + i_env for i_env in range(n_envs)]
+
+        if self.n_workers == 0:
+            self.envs = [env_class(model_path, frame_skip, args) for _ in range(n_envs)]
+
+            for env, env_seed in zip(self.envs, env_seeds):
+                env.seed(env_seed)
+
+            self.n_exp_conds = self.envs[0].n_exp_conds
+            self.frame_repeat = self.envs[0].frame_repeat
+            self.obs_dim = self.envs[0].observation_space.shape[0] + len(self.envs[0].sfs_visual_velocity)*3 + 1
+        else:
+            self.envs = None
+
+            #Contiguous groups of environments per worker
+            self.groups = np.array_split(np.arange(n_envs), self.n_workers)
+            self.ctx = mp.get_context("spawn")
+            self.remotes, self.processes = [], []
+            for group in self.groups:
+                remote, worker_remote = self.ctx.Pipe()
+                process = self.ctx.Process(target=vector_env_worker,
+                                           args=(worker_remote, env_class, model_path, frame_skip, args, [env_seeds[i_env] for i_env in group]),
+                                           daemon=True)
+                process.start()
+                worker_remote.close()
+                self.remotes.append(remote)
+                self.processes.append(process)
+
+            self.n_exp_conds, self.frame_repeat, self.obs_dim = self._recv(0)
+            for i_worker in range(1, self.n_workers):
+                self._recv(i_worker)
+
+        #Cycle through the conditions if no condition selection is given
+        if cond_selector is None:
+            cond_selector = lambda i_env: self._n_resets % self.n_exp_conds
+        self.cond_selector = cond_selector
+        self._n_resets = 0
+
+        #Preallocated buffers for the stacked outputs
+        self.observations = np.zeros((n_envs, self.obs_dim), dtype=np.float32)
+        self.rewards = np.zeros((n_envs,), dtype=np.float32)
+        self.dones = np.zeros((n_envs,), dtype=bool)
+        self.episode_rewards = np.zeros((n_envs,))
+        self.episode_steps = np.zeros((n_envs,), dtype=np.int64)
+        self.coord_idxs = np.zeros((n_envs,), dtype=np.int64)
+        self.neural_activities = [None] * n_envs
+
+    @property
+    def coord_idx(self):
+        return self.coord_idxs.copy()
+
+    def _recv(self, i_worker):
+
+        #Poll so that a worker that died without replying raises instead of blocking forever
+        remote = self.remotes[i_worker]
+        process = self.processes[i_worker]
+        while not remote.poll(1.0):
+            if not process.is_alive():
+                raise RuntimeError("VectorMuscleEnv worker {} exited with code {}".format(i_worker, process.exitcode))
+
+        status, data = remote.recv()
+        if status == "error":
+            raise RuntimeError("VectorMuscleEnv worker {} failed:\n{}".format(i_worker, data))
+
+        return data
+
+    def _step_envs(self, actions):
+
+        if self.n_workers == 0:
+            return [vector_env_step(env, action) for env, action in zip(self.envs, actions)]
+
+        #Send all the commands before waiting so the workers step in parallel
+        for remote, group in zip(self.remotes, self.groups):
+            remote.send(("step", actions[group]))
+
+        results = []
+        for i_worker in range(self.n_workers):
+            results.extend(self._recv(i_worker))
+
+        return results
+
+    def _reset_envs(self, conds_to_select):
+
+        #conds_to_select: {i_env: cond_to_select}
+        if self.n_workers == 0:
+            return {i_env: vector_env_reset(self.envs[i_env], cond_to_select) for i_env, cond_to_select in conds_to_select.items()}
+
+        requests = []
+        for i_worker, (remote, group) in enumerate(zip(self.remotes, self.groups)):
+            reset_envs = [i_env for i_env in group if i_env in conds_to_select]
+            if len(reset_envs) != 0:
+                remote.send(("reset", [(i_env - group[0], conds_to_select[i_env]) for i_env in reset_envs]))
+                requests.append((i_worker, reset_envs))
+
+        results = {}
+        for i_worker, reset_envs in requests:
+            results.update(zip(reset_envs, self._recv(i_worker)))
+
+        return results
+
+    def _write_decision_state(self, i_env, ob, condition_scalar, na_idx, neural_activity):
+        self.observations[i_env, :-1] = ob
+        self.observations[i_env, -1] = condition_scalar
+        self.coord_idxs[i_env] = na_idx
+        self.neural_activities[i_env] = neural_activity
+
+    def _reset(self, i_envs, conds_to_select=None):
+
+        #The conditions are selected in this process, in the order of the environments
+        conds = {}
+        for i_env in i_envs:
+            conds[i_env] = self.cond_selector(i_env) if conds_to_select is None else conds_to_select[i_env]
+            self._n_resets += 1
+
+        for i_env, result in self._reset_envs(conds).items():
+            self.episode_rewards[i_env] = 0
+            self.episode_steps[i_env] = 0
+            self._write_decision_state(i_env, *result)
+
+    def reset(self, conds_to_select=None):
+
+        self._reset(range(self.n_envs), conds_to_select)
+
+        return self.observations.copy()
+
+    def step(self, actions):
+
+        infos = [{} for _ in range(self.n_envs)]
+        for i_env, (ob, reward, done, n_steps, cond, max_episode_steps, step_profile, *decision_state) in enumerate(self._step_envs(actions)):
+
+            self.episode_steps[i_env] += n_steps
+            self.episode_rewards[i_env] += reward
+            self.rewards[i_env] = reward
+            self.dones[i_env] = done
+            self._write_decision_state(i_env, ob, *decision_state)
+
+            if done:
+                infos[i_env]["terminal_observation"] = self.observations[i_env].copy()
+                infos[i_env]["episode_reward"] = self.episode_rewards[i_env]
+                infos[i_env]["episode_steps"] = self.episode_steps[i_env]
+                infos[i_env]["max_episode_steps"] = max_episode_steps
+                infos[i_env]["condition"] = cond
+                if step_profile is not None:
+                    infos[i_env]["step_profile"] = step_profile
+
+        #Reset the finished environments to their next condition
+        if self.dones.any():
+            self._reset(np.flatnonzero(self.dones))
+
+        return self.observations.copy(), self.rewards.copy(), self.dones.copy(), infos
+
+    def close(self):
 
-            if kinematics_preprocessing_specs.xyz_target[i_target][2]:
-                z_joint_idx= self.model.get_joint_qpos_addr(f"box:z{i_target}")
-                crnt_state.qpos[z_joint_idx] = coords_to_sim[i_target, kinematics_preprocessing_specs.xyz_target[i_target][0] + kinematics_preprocessing_specs.xyz_target[i_target][1], self.tpoint_to_sim]
+        if self.n_workers == 0:
+            for env in self.envs:
+                env.close()
+            return
 
+        for remote in self.remotes:
+            remote.send(("close", None))
 
-        #Now set the state
-        self.set_state(crnt_state.qpos, crnt_state.qvel)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
@@ -0,0 +1,238 @@
+#Actor/learner training: rollout worker processes collect whole episodes with a CPU copy of the actor
+#and hand them to the learner process that owns the replay memory and the SAC agent
+
+import queue
+import traceback
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from .model import Actor
+from .replay_memory import INTEGER_FIELDS
+
+def transition_fields(obs_dim, action_dim, hidden_size, na_shape):
+
+    #Name and per-transition shape of the fields of an experience tuple, in the order pushed to the replay
+    return [("state", (obs_dim,)),
+            ("action", (action_dim,)),
+            ("reward", ()),
+            ("next_state", (obs_dim,)),
+            ("mask", ()),
+            ("h_current", (1, hidden_size)),
+            ("neural_activity", tuple(na_shape)),
+            ("na_idx", (1,))]
+
+class EpisodeSlot():
+
+    """Preallocated shared memory tensors that hold one episode of transitions
+
+        The tensors are shared with the worker processes, so an episode is written once by the worker
+        and read in place by the learner instead of being pickled through a queue.
+    """
+
+    def __init__(self, fields, max_steps):
+
+        self.fields = fields
+        self.tensors = [torch.zeros((max_steps, *shape), dtype=torch.int64 if name in INTEGER_FIELDS else torch.float32).share_memory_()
+                        for name, shape in fields]
+
+    def arrays(self, n_steps=None):
+        return [tensor[:n_steps].numpy() for tensor in self.tensors]
+
+def rollout_worker(worker_id, env_class, model_file, args, obs_dim, shared_actor, weights_version, weights_lock,
+                   slots, free_slots, ready_queue, cond_queue, replay):
+
+    #Report the traceback of a failed worker to the learner instead of leaving it waiting
+    try:
+        collect_episodes(worker_id, env_class, model_file, args, obs_dim, shared_actor, weights_version, weights_lock,
+                         slots, free_slots, ready_queue, cond_queue, replay)
+    except Exception:
+        ready_queue.put(("error", worker_id, traceback.format_exc()))
+        raise
+
+def collect_episodes(worker_id, env_class, model_file, args, obs_dim, shared_actor, weights_version, weights_lock,
+                     slots, free_slots, ready_queue, cond_queue, replay):
+
+    #Keep the workers from oversubscribing the cores
+    torch.set_num_threads(1)
+    torch.manual_seed(args.seed + worker_id + 1)
+    np.random.seed(args.seed + worker_id + 1)
+
+    env = env_class(model_file, 1, args)
+    env.seed(args.seed + worker_id + 1)
+
+    actor = Actor(obs_dim, env.action_space.shape[0], args.hidden_size, args.model, action_space=None)
+    local_version = -1
+
+    while True:
+
+        cond_to_select = cond_queue.get()
+        if cond_to_select is None:
+            break
+
+        i_slot = free_slots.get()
+        if i_slot is None:
+            break
+
+        #Pull the latest weights broadcast by the learner
+        if weights_version.value != local_version:
+            with weights_lock:
+                actor.load_state_dict(shared_actor.state_dict())
+                local_version = weights_version.value
+
+        state_b, action_b, reward_b, next_state_b, mask_b, h_b, na_b, na_idx_b = slots[i_slot].arrays()
+
+        episode_reward = 0
+        episode_steps = 0
+        n_transitions = 0
+        done = False
+
+        state = env.reset(cond_to_select)
+        state = [*state, env.condition_scalar]
+
+        h_prev = torch.zeros(size=(1, 1, args.hidden_size))
+
+        while not(done):
+
+            with torch.no_grad():
+                action, _, _, h_current, _, _, _ = actor.sample(torch.FloatTensor(state).unsqueeze(0).unsqueeze(0), h_prev, sampling=True, len_seq=None)
+                action = action.numpy()[0]
+
+            na_idx = env.coord_idx
+
+            reward = 0
+            for _ in range(env.frame_repeat):
+                next_state, inter_reward, done, _ = env.step(action)
+                next_state = [*next_state, env.condition_scalar]
+
+                reward += inter_reward
+                episode_steps += 1
+
+                if done:
+                    break
+
+            episode_reward += reward
+
+            mask = 1 if episode_steps == env._max_episode_steps else float(not done)
+
+            if not env.nusim_data_exists:
+                env.neural_activity[na_idx] = 0
+
+            #Write the transition straight into the shared episode slot
+            state_b[n_transitions] = state
+            action_b[n_transitions] = action
+            reward_b[n_transitions] = reward
+            next_state_b[n_transitions] = next_state
+            mask_b[n_transitions] = mask
+            h_b[n_transitions] = h_current.squeeze(0).numpy()
+            na_b[n_transitions] = env.neural_activity[na_idx]
+            na_idx_b[n_transitions] = na_idx
+            n_transitions += 1
+
+            state = next_state
+            h_prev = h_current
+
+        #Push the episode straight into the shared replay, the learner only receives its statistics
+        if replay is not None:
+            replay.push_columns(slots[i_slot].arrays(n_transitions))
+            free_slots.put(i_slot)
+            i_slot = None
+
+        ready_queue.put((worker_id, i_slot, n_transitions, episode_reward, episode_steps, cond_to_select))
+
+class RolloutWorkers():
+
+    """Pool of rollout worker processes feeding a central learner
+
+        Each worker owns a Muscle_Env and a CPU copy of the Actor. Finished episodes are written into
+        double-buffered shared memory slots per worker, only the slot index is sent over the queue.
+        The learner broadcasts its actor weights through a shared CPU copy guarded by a version counter.
+        With a SharedPolicyReplayMemory as replay the workers push their episodes into it themselves
+        and get_episode returns None as the slot index.
+    """
+
+    def __init__(self, n_workers, env_class, model_file, args, obs_dim, action_dim, na_shape, replay=None):
+
+        self.n_workers = n_workers
+        self.ctx = mp.get_context("spawn")
+
+        fields = transition_fields(obs_dim, action_dim, args.hidden_size, na_shape)
+        self.slots_per_worker = 2
+        self.slots = [EpisodeSlot(fields, args.timestep_limit) for _ in range(n_workers*self.slots_per_worker)]
+
+        self.shared_actor = Actor(obs_dim, action_dim, args.hidden_size, args.model, action_space=None)
+        self.shared_actor.share_memory()
+        self.weights_version = self.ctx.Value("l", 0)
+        self.weights_lock = self.ctx.Lock()
+
+        self.ready_queue = self.ctx.Queue()
+        self.cond_queue = self.ctx.Queue()
+        self.free_slots = [self.ctx.Queue() for _ in range(n_workers)]
+
+        for worker_id in range(n_workers):
+            for i_slot in range(self.slots_per_worker):
+                self.free_slots[worker_id].put(worker_id*self.slots_per_worker + i_slot)
+
+        self.processes = [self.ctx.Process(target=rollout_worker,
+                                           args=(worker_id, env_class, model_file, args, obs_dim, self.shared_actor,
+                                                 self.weights_version, self.weights_lock, self.slots,
+                                                 self.free_slots[worker_id], self.ready_queue, self.cond_queue, replay),
+                                           daemon=True)
+                          for worker_id in range(n_workers)]
+
+    def start(self, actor):
+        self.broadcast(actor)
+        for process in self.processes:
+            process.start()
+
+    def broadcast(self, actor):
+
+        #Copy the learner weights into the shared CPU actor in place
+        with self.weights_lock:
+            self.shared_actor.load_state_dict({name: param.cpu() for name, param in actor.state_dict().items()})
+            self.weights_version.value += 1
+
+    def request_episode(self, cond_to_select):
+        self.cond_queue.put(cond_to_select)
+
+    def get_episode(self, block=True, poll_timeout=1.0):
+
+        #Returns None if no episode is ready and block is False
+        #A blocking wait polls the queue and raises if a worker failed or exited instead of waiting forever
+        while True:
+            try:
+                received = self.ready_queue.get(block=block, timeout=poll_timeout if block else None)
+                break
+            except queue.Empty:
+                if not block:
+                    return None
+
+            dead_workers = [(worker_id, process.exitcode) for worker_id, process in enumerate(self.processes) if not process.is_alive()]
+            if len(dead_workers) != 0:
+                #A failed worker reports its traceback before exiting
+                try:
+                    received = self.ready_queue.get(timeout=poll_timeout)
+                    break
+                except queue.Empty:
+                    raise RuntimeError("rollout worker {} exited with code {}".format(*dead_workers[0]))
+
+        if received[0] == "error":
+            _, worker_id, worker_traceback = received
+            raise RuntimeError("rollout worker {} failed:\n{}".format(worker_id, worker_traceback))
+
+        worker_id, i_slot, n_transitions, episode_reward, episode_steps, cond = received
+
+        return worker_id, i_slot, n_transitions, episode_reward, episode_steps, cond
+
+    def release(self, worker_id, i_slot):
+        self.free_slots[worker_id].put(i_slot)
+
+    def close(self):
+
+        for worker_id in range(self.n_workers):
+            self.cond_queue.put(None)
+            self.free_slots[worker_id].put(None)
+
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
@@ -0,0 +1,109 @@
+#Vectorized preprocessing of the experimental kinematics with an on-disk cache of the preprocessed arrays
+#The cache is keyed by the content of kinematics.pkl and the trajectory_scaling/center used for the preprocessing,
+#so env constructions, IK runs and worker processes load memory-mapped arrays instead of unpickling and preprocessing
+
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+
+CACHE_FOLDER = 'preprocessed_cache'
+
+def preprocess_kinematics(kin, radius, center):
+
+    #kin: {cond: [num_targets, num_coords, timepoints]}
+    #Scale each target trajectory by 1/radius[i_target] and shift each coordinate by center[i_target][i_coord]
+    kin_preprocessed = {}
+    for cond, kin_cond in kin.items():
+        num_targets, num_coords = kin_cond.shape[:2]
+        radius_cond = np.asarray(radius[:num_targets], dtype=np.float64)[:, np.newaxis, np.newaxis]
+        center_cond = np.asarray([center_t[:num_coords] for center_t in center[:num_targets]], dtype=np.float64)[:, :, np.newaxis]
+
+        kin_preprocessed[cond] = kin_cond / radius_cond + center_cond
+
+    return kin_preprocessed
+
+def cache_key(kinematics_file, radius, center):
+
+    #sha1 of the source pickle and the preprocessing parameters
+    sha = hashlib.sha1()
+    with open(kinematics_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+
+    sha.update(np.asarray(radius, dtype=np.float64).tobytes())
+    for center_t in center:
+        sha.update(np.asarray(center_t, dtype=np.float64).tobytes())
+        sha.update(b';')
+
+    return sha.hexdigest()
+
+def _umask():
+
+    #Current umask of the process (os.umask can only be read by setting it)
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+def _load_cache(cache_path):
+
+    kin = {'train': {}, 'test': {}}
+    for file_name in os.listdir(cache_path):
+        split, cond = os.path.splitext(file_name)[0].split('_')
+        kin[split][int(cond)] = np.load(os.path.join(cache_path, file_name), mmap_mode='r')
+
+    return kin['train'], kin['test']
+
+def _write_cache(cache_root, cache_path, kin_train, kin_test):
+
+    #Write into a temporary folder and rename it, so concurrent processes never see a partial cache
+    os.makedirs(cache_root, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=cache_root)
+    try:
+        for split, kin in [('train', kin_train), ('test', kin_test)]:
+            for cond, kin_cond in kin.items():
+                np.save(os.path.join(tmp_path, '{}_{}.npy'.format(split, cond)), kin_cond)
+
+        #mkdtemp creates the folder with mode 0700, give it the permissions of a folder created with os.makedirs
+        #so that other users sharing the kinematics folder can read the cache
+        os.chmod(tmp_path, 0o755 & ~_umask())
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        #Another process has written the same cache in the meantime
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        if not os.path.isdir(cache_path):
+            raise
+
+def load_kinematics(kinematics_path, radius, center):
+
+    """Returns the preprocessed train and test kinematics {cond: [num_targets, num_coords, timepoints]}
+
+        The arrays are read-only memory maps of the cache in kinematics_path/preprocessed_cache,
+        which is created on the first call for a given kinematics.pkl, trajectory_scaling and center.
+    """
+
+    kinematics_file = kinematics_path + '/kinematics.pkl'
+    cache_root = os.path.join(kinematics_path, CACHE_FOLDER)
+    cache_path = os.path.join(cache_root, cache_key(kinematics_file, radius, center))
+
+    if os.path.isdir(cache_path):
+        try:
+            return _load_cache(cache_path)
+        except OSError:
+            #The cache is not readable (e.g. written by another user), preprocess in memory instead
+            pass
+
+    with open(kinematics_file, 'rb') as f:
+        kin_train_test = pickle.load(f)
+
+    kin_train = preprocess_kinematics(kin_train_test['train'], radius, center)
+    kin_test = preprocess_kinematics(kin_train_test['test'], radius, center)
+
+    try:
+        _write_cache(cache_root, cache_path, kin_train, kin_test)
+        return _load_cache(cache_path)
+    except OSError:
+        #The kinematics folder is not writable or the cache is not readable, use the preprocessed arrays in memory
+        return kin_train, kin_test
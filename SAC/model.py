@@ -1,13 +1,43 @@
+import functools
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.distributions import Normal
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, PackedSequence
+from typing import NamedTuple, List
 
 LOG_SIG_MAX = 2
 LOG_SIG_MIN = -20
 epsilon = 1e-6
 
+class SequenceLayout(NamedTuple):
+
+    """Packing layout of a padded batch sorted by decreasing sequence length, computed once per sampled batch
+
+        lengths: sequence lengths, batch_sizes: number of sequences at each timepoint (CPU tensor),
+        pack_idx: rows of the flattened [batch, T_max] padded batch in packed (time-major) order
+    """
+
+    lengths: List[int]
+    batch_sizes: torch.Tensor
+    pack_idx: torch.Tensor
+
+def pack_sequence_batch(x, len_seq):
+
+    #Pack a padded batch [batch, T_max, features] using the precomputed layout, or the sequence lengths as given
+    if isinstance(len_seq, SequenceLayout):
+        return PackedSequence(x.reshape(-1, x.size()[-1])[len_seq.pack_idx], len_seq.batch_sizes)
+
+    return pack_padded_sequence(x, len_seq, batch_first= True, enforce_sorted= False)
+
+@functools.lru_cache(maxsize=64)
+def sequence_mask(lengths, sl_max, device):
+
+    #Flattened [batch * sl_max] mask of the valid timepoints of a padded batch, cached per length signature
+    #The cached tensor is shared by all the callers and must not be modified in place
+    lengths = torch.tensor(lengths, device=device)
+    return (torch.arange(sl_max, device=device)[None, :] < lengths[:, None]).reshape(-1)
+
 # Initialize Policy weights
 def weights_init_(m):
     if isinstance(m, nn.Linear):
@@ -49,7 +79,7 @@ class Actor(nn.Module):
 
         if sampling == False:
             assert len_seq!=None, "Proved the len_seq"
-            x = pack_padded_sequence(x, len_seq, batch_first= True, enforce_sorted= False)
+            x = pack_sequence_batch(x, len_seq)
 
         #Tap RNN input for fixedpoint analysis
         rnn_in = x
@@ -76,16 +106,8 @@ class Actor(nn.Module):
         if sampling == False:
             assert mean.size()[1] == log_std.size()[1], "There is a mismatch between and mean and sigma Sl_max"
             sl_max = mean.size()[1]
-            with torch.no_grad():
-                for seq_idx, k in enumerate(len_seq):
-                    for j in range(1, sl_max + 1):
-                        if j <= k:
-                            if seq_idx == 0 and j == 1:
-                                mask_seq = torch.tensor([True], dtype=bool)
-                            else:
-                                mask_seq = torch.cat((mask_seq, torch.tensor([True])), dim=0)
-                        else:
-                            mask_seq = torch.cat((mask_seq, torch.tensor([False])), dim=0)
+            lengths = len_seq.lengths if isinstance(len_seq, SequenceLayout) else len_seq
+            mask_seq = sequence_mask(tuple(int(k) for k in lengths), sl_max, mean.device)
             #The mask has been created, Now filter the mean and sigma using this mask
             mean = mean.reshape(-1, mean.size()[-1])[mask_seq]
             log_std = log_std.reshape(-1, log_std.size()[-1])[mask_seq]
@@ -93,6 +115,38 @@ class Actor(nn.Module):
         if sampling == True:
             mask_seq = [] #If sampling is True return a dummy mask seq
 
+        action, log_prob, mean = self._squashed_sample(mean, log_std)
+
+        return action, log_prob, mean, h_current, mask_seq, x, rnn_in
+
+    def sample_with_taps(self, state, h_prev, len_seq):
+
+        """Single unroll of a padded batch for the actor update
+
+            Returns the sampled actions and log probabilities with the taps used by the policy regularizers,
+            the RNN output and the linear1 output, flattened to the valid timepoints selected by mask_seq
+        """
+
+        x_l1 = F.tanh(self.linear1(state))
+
+        x, h_current = self.rnn(pack_sequence_batch(x_l1, len_seq), h_prev)
+        x, _ = pad_packed_sequence(x, batch_first= True)
+
+        lengths = len_seq.lengths if isinstance(len_seq, SequenceLayout) else len_seq
+        mask_seq = sequence_mask(tuple(int(k) for k in lengths), x.size()[1], x.device)
+        x = x.reshape(-1, x.size()[-1])[mask_seq]
+        x_l1 = x_l1.reshape(-1, x_l1.size()[-1])[mask_seq]
+
+        mean = self.mean_linear(x)
+        log_std = self.log_std_linear(x)
+        log_std = torch.clamp(log_std, min=LOG_SIG_MIN, max=LOG_SIG_MAX)
+
+        action, log_prob, mean = self._squashed_sample(mean, log_std)
+
+        return action, log_prob, mean, h_current, mask_seq, x, x_l1
+
+    def _squashed_sample(self, mean, log_std):
+
         std = log_std.exp()
 
         # white noise
@@ -109,7 +163,7 @@ class Actor(nn.Module):
         log_prob = log_prob.sum(1, keepdim=True)
         mean = torch.tanh(mean) * self.action_scale + self.action_bias
 
-        return action, log_prob, mean, h_current, mask_seq, x, rnn_in
+        return action, log_prob, mean
 
     def forward_for_simple_dynamics(self, state, h_prev, sampling, len_seq= None):
 
@@ -120,7 +174,7 @@ class Actor(nn.Module):
 
         if sampling == False:
             assert len_seq!=None, "Proved the len_seq"
-            x = pack_padded_sequence(x, len_seq, batch_first= True, enforce_sorted= False)
+            x = pack_sequence_batch(x, len_seq)
 
         x, _ = self.rnn(x, (h_prev))
 
@@ -139,7 +193,7 @@ class Actor(nn.Module):
         if sampling == False:
             assert len_seq!=None, "Proved the len_seq"
 
-            x = pack_padded_sequence(x, len_seq, batch_first= True, enforce_sorted= False)
+            x = pack_sequence_batch(x, len_seq)
 
         x, (h_current) = self.rnn(x, (h_prev))
 
@@ -175,31 +229,90 @@ class Actor(nn.Module):
         return action.detach().cpu().numpy()[0], h_current.detach(), x.detach().cpu().numpy(), rnn_in.detach().cpu().numpy()
 
 class Critic(nn.Module):
-    def __init__(self, num_inputs, num_actions, hidden_dim):
+
+    """Ensemble of n_critics Q-networks with the weights of each layer stacked over the heads
+
+        The heads are evaluated together with batched matmuls, forward returns the Q-values [n_critics, batch, 1].
+        State dicts of the former twin critic (linear1..3 and linear4..6) are converted with twin_critic_state_dict.
+    """
+
+    def __init__(self, num_inputs, num_actions, hidden_dim, n_critics=2):
         super(Critic, self).__init__()
 
-        # Q1 architecture
-        self.linear1 = nn.Linear(num_inputs + num_actions, hidden_dim)
-        self.linear2 = nn.Linear(hidden_dim, hidden_dim)
-        self.linear3 = nn.Linear(hidden_dim, 1)
+        self.n_critics = n_critics
+        layer_dims = [(num_inputs + num_actions, hidden_dim), (hidden_dim, hidden_dim), (hidden_dim, 1)]
 
-        # Q2 architecture
-        self.linear4 = nn.Linear(num_inputs + num_actions, hidden_dim)
-        self.linear5 = nn.Linear(hidden_dim, hidden_dim)
-        self.linear6 = nn.Linear(hidden_dim, 1)
+        #Layer k of head i computes x @ weight{k}[i] + bias{k}[i], weight{k} is [n_critics, in_features, out_features]
+        for k, (in_features, out_features) in enumerate(layer_dims, 1):
+            self.register_parameter(f'weight{k}', nn.Parameter(torch.empty(n_critics, in_features, out_features)))
+            self.register_parameter(f'bias{k}', nn.Parameter(torch.empty(n_critics, 1, out_features)))
 
-        self.apply(weights_init_)
+        #Initialized as the nn.Linear layers of the twin critic with weights_init_, head by head
+        layers = [nn.Linear(in_features, out_features) for _ in range(n_critics) for in_features, out_features in layer_dims]
+        for layer in layers:
+            weights_init_(layer)
+
+        with torch.no_grad():
+            for i in range(n_critics):
+                for k in range(1, 4):
+                    layer = layers[3 * i + k - 1]
+                    getattr(self, f'weight{k}')[i] = layer.weight.t()
+                    getattr(self, f'bias{k}')[i] = layer.bias
 
     def forward(self, state, action):
 
         xu = torch.cat([state, action], 1)
-        
-        x1 = F.relu(self.linear1(xu))
-        x1 = F.relu(self.linear2(x1))
-        x1 = self.linear3(x1)
+        xu = xu.unsqueeze(0).expand(self.n_critics, -1, -1)
 
-        x2 = F.relu(self.linear4(xu))
-        x2 = F.relu(self.linear5(x2))
-        x2 = self.linear6(x2)
+        #bmm then in-place bias and relu, baddbmm with the broadcast bias is slower on CPU
+        x = torch.bmm(xu, self.weight1).add_(self.bias1).relu_()
+        x = torch.bmm(x, self.weight2).add_(self.bias2).relu_()
+        x = torch.bmm(x, self.weight3) + self.bias3
+
+        return x
 
-        return x1, x2
\ No newline at end of file
+def twin_critic_state_dict(state_dict):
+
+    #Stacks the nn.Linear layers of a twin critic checkpoint (linear1..3 are the first head, linear4..6 the second)
+    #into the parameters of the ensemble critic with n_critics = 2, state dicts of the ensemble critic are returned unchanged
+    if 'linear1.weight' not in state_dict:
+        return state_dict
+
+    stacked_state_dict = {}
+    for k in range(1, 4):
+        stacked_state_dict[f'weight{k}'] = torch.stack([state_dict[f'linear{k + 3 * i}.weight'].t() for i in range(2)])
+        stacked_state_dict[f'bias{k}'] = torch.stack([state_dict[f'linear{k + 3 * i}.bias'] for i in range(2)]).unsqueeze(1)
+
+    return stacked_state_dict
+
+def twin_critic_optimizer_state(optimizer_state_dict):
+
+    #Stacks the Adam state of a twin critic checkpoint (the 12 nn.Linear parameters) into the layout of the ensemble critic,
+    #optimizer states of the ensemble critic are returned unchanged
+    param_group = optimizer_state_dict['param_groups'][0]
+    if len(param_group['params']) != 12:
+        return optimizer_state_dict
+
+    params = param_group['params']
+    state = optimizer_state_dict['state']
+
+    #Twin critic: linear{k}.weight, linear{k}.bias for k = 1..6, ensemble critic: weight{k}, bias{k} for k = 1..3
+    stacked_state = {}
+    if all(param in state for param in params):
+        for k in range(3):
+            for is_bias in range(2):
+                heads = [state[params[2 * (k + 3 * i) + is_bias]] for i in range(2)]
+                stacked = {}
+                for name, value in heads[0].items():
+                    if not torch.is_tensor(value):
+                        stacked[name] = value
+                    elif value.dim() == 0:
+                        #Step count, copied so that the source optimizer state is left untouched
+                        stacked[name] = value.clone()
+                    elif is_bias:
+                        stacked[name] = torch.stack([head[name] for head in heads]).unsqueeze(1)
+                    else:
+                        stacked[name] = torch.stack([head[name].t() for head in heads])
+                stacked_state[2 * k + is_bias] = stacked
+
+    return {'state': stacked_state, 'param_groups': [dict(param_group, params=list(range(6)))]}
\ No newline at end of file
@@ -1,30 +1,945 @@
-import random
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import weakref
 import numpy as np
-from itertools import chain
-import torch
+
+#Fields of an experience tuple, in the order pushed to the replay
+TRANSITION_FIELDS = ("state", "action", "reward", "next_state", "mask", "h_current", "neural_activity", "na_idx")
+
+#Fields stored as int64, the other fields are floating point
+INTEGER_FIELDS = ("na_idx",)
+
+#Storage dtype of the codecs of the floating point fields
+#bfloat16 is stored as the upper 16 bits of the float32 and uint8 as a per-episode, per-feature affine quantization
+REPLAY_CODECS = {"float32": np.float32, "float16": np.float16, "bfloat16": np.uint16, "uint8": np.uint8}
+
+def encode_bfloat16(x):
+
+    #Round to nearest even on the upper 16 bits of the float32
+    bits = np.ascontiguousarray(x, dtype=np.float32).view(np.uint32)
+    return ((bits + 0x7FFF + ((bits >> 16) & 1)) >> 16).astype(np.uint16)
+
+def decode_bfloat16(x):
+    return (x.astype(np.uint32) << 16).view(np.float32)
 
 class PolicyReplayMemory:
-    def __init__(self, capacity, seed):
-        random.seed(seed)
+
+    """Episodic replay memory backed by preallocated contiguous numpy arrays per field
+
+        The transitions of an episode are stored in consecutive rows of the field arrays, which are used as a ring:
+        an episode that does not fit before the end of the arrays is written from row 0. Episodes are indexed by
+        (start row, length, id) in FIFO order and the oldest episodes are evicted once capacity episodes are stored
+        or their rows are needed for a new episode. With transition_capacity=None the arrays grow on demand and only
+        the number of episodes is limited.
+
+        The field shapes are taken from the first pushed episode and later episodes have to match them.
+        INTEGER_FIELDS are stored as int64, codecs maps the floating point fields to one of REPLAY_CODECS
+        (float32 by default), fields are encoded on push and decoded to float32 on sample.
+
+        Pushes and samples hold lock, so a ReplayPrefetcher can sample from another thread. generation is
+        incremented whenever the sampling distribution changes, to invalidate the batches sampled before.
+
+        With sequence_window > 0 a window of at most sequence_window transitions is sampled from each episode
+        instead of the whole episode, with up to burn_in transitions before it to warm up the RNN state.
+    """
+
+    def __init__(self, capacity, seed, transition_capacity=None, codecs=None, sequence_window=0, burn_in=0):
+
         self.capacity = capacity
-        self.buffer = []
-        self.position = 0
+        self.transition_capacity = transition_capacity
+        self.rng = np.random.RandomState(seed)
+        self.sequence_window = sequence_window
+        self.burn_in = burn_in
+
+        self.codecs = {name: codec for name, codec in (codecs or {}).items() if codec != "float32"}
+        for name, codec in self.codecs.items():
+            if name not in TRANSITION_FIELDS or codec not in REPLAY_CODECS:
+                raise ValueError("Unknown replay codec {} for {}".format(codec, name))
+
+        self.storage = None
+
+        #Episode index in FIFO order: the oldest episode is at position head
+        self.ep_start = self._alloc_array("ep_start", (capacity,), np.int64)
+        self.ep_len = self._alloc_array("ep_len", (capacity,), np.int64)
+        self.ep_id = self._alloc_array("ep_id", (capacity,), np.int64)
+
+        #Cursor: [next row to write, FIFO head, number of episodes, id of the next episode, number of rows, number of transitions]
+        self.cursor = self._alloc_array("cursor", (6,), np.int64)
+
+        #Number of agent updates counted with count_update, and its value when each episode was pushed
+        self.n_updates = self._alloc_array("n_updates", (1,), np.int64)
+        self.ep_update = self._alloc_array("ep_update", (capacity,), np.int64)
+
+        #Per-episode [offset, scale] of the uint8 fields, allocated with the storage
+        self.codec_params = {}
+
+        #Id of the last episode written to the replay snapshot
+        self.snapshot_last_id = -1
+
+        self.lock = threading.RLock()
+        self.generation = 0
+
+        #Sample latencies and ages of the sampled episodes since the last reset_statistics
+        self.sample_latency_ns = []
+        self.sampled_staleness = []
+
+    def _alloc_array(self, name, shape, dtype):
+
+        #Allocation hook for the field arrays, the episode index and the cursor
+        return np.zeros(shape, dtype=dtype)
+
+    def _allocate_storage(self, schema, n_rows):
+
+        self.schema = schema
+        self.storage = {name: self._alloc_array(name, (n_rows, *shape), dtype) for name, (shape, dtype) in schema.items()}
+        self.cursor[4] = n_rows
+
+        for name, codec in self.codecs.items():
+            if codec == "uint8" and name not in self.codec_params:
+                self.codec_params[name] = self._alloc_array(name + "_affine", (self.capacity, 2, *schema[name][0]), np.float32)
+
+    def _schema(self, columns):
+
+        #Per-transition shape of each field, floating point fields are stored as float32 or with their codec
+        schema = {}
+        for name, column in zip(TRANSITION_FIELDS, columns):
+            if name in INTEGER_FIELDS:
+                dtype = np.int64
+            else:
+                dtype = REPLAY_CODECS[self.codecs.get(name, "float32")]
+            schema[name] = (column.shape[1:], dtype)
+
+        return schema
+
+    def _check_columns(self, columns):
+
+        #The fields of an episode have to match the schema of the replay
+        if len(columns) != len(TRANSITION_FIELDS):
+            raise ValueError("Episode with {} fields pushed to a replay of {} fields {}".format(len(columns), len(TRANSITION_FIELDS), TRANSITION_FIELDS))
+
+        n = len(columns[0])
+        for name, column in zip(TRANSITION_FIELDS, columns):
+            shape, dtype = self.schema[name]
+            if column.shape != (n, *shape):
+                raise ValueError("Replay field {} pushed with shape {}, expected {} for an episode of {} transitions".format(name, column.shape, (n, *shape), n))
+
+            if name in INTEGER_FIELDS:
+                valid_dtype = np.issubdtype(column.dtype, np.integer)
+            else:
+                valid_dtype = np.issubdtype(column.dtype, np.number) or column.dtype == bool
+            if not valid_dtype:
+                raise ValueError("Replay field {} pushed with dtype {}, it is stored as {}".format(name, column.dtype, np.dtype(dtype)))
+
+    def _encode(self, name, column, position):
+
+        codec = self.codecs.get(name)
+        if codec is None:
+            return column
+        if codec == "float16":
+            return column.astype(np.float16)
+        if codec == "bfloat16":
+            return encode_bfloat16(column)
+
+        #Affine quantization of each feature over the episode to 0..255
+        column = np.asarray(column, dtype=np.float32)
+        offset = column.min(axis=0)
+        scale = (column.max(axis=0) - offset) / 255
+        scale[scale == 0] = 1
+        self.codec_params[name][position] = offset, scale
+
+        return np.rint((column - offset) / scale).astype(np.uint8)
+
+    def _decode(self, name, rows, row_positions):
+
+        codec = self.codecs.get(name)
+        if codec is None:
+            return self.storage[name][rows]
+        if codec == "float16":
+            return self.storage[name][rows].astype(np.float32)
+        if codec == "bfloat16":
+            return decode_bfloat16(self.storage[name][rows])
+
+        offset, scale = np.moveaxis(self.codec_params[name][row_positions], 1, 0)
+        return self.storage[name][rows] * scale + offset
+
+    def bytes_per_transition(self):
+
+        #Bytes of the field arrays per stored transition, with the per-episode codec parameters spread over the transitions
+        row_bytes = sum(np.dtype(dtype).itemsize * int(np.prod(shape)) for shape, dtype in self.schema.values())
+        param_bytes = sum(params[0].nbytes for params in self.codec_params.values()) * len(self)
+
+        return row_bytes + param_bytes / max(self.n_transitions, 1)
+
+    @property
+    def n_rows(self):
+        return int(self.cursor[4])
+
+    @property
+    def n_transitions(self):
+        return int(self.cursor[5])
+
+    def push(self, episode):
+
+        #episode: list of experience tuples (state, action, reward, next_state, mask, h_current, neural_activity, na_idx)
+        self.push_columns([np.stack(column) for column in zip(*episode)])
+
+    def push_columns(self, columns):
+
+        with self.lock:
+            self._push_columns(columns)
+
+    def _push_columns(self, columns):
+
+        #columns: one array per field of shape [episode length, *field shape]
+        n = len(columns[0])
+
+        if self.storage is None:
+            n_rows = self.transition_capacity if self.transition_capacity else max(2*n, 1024)
+            self._allocate_storage(self._schema(columns), n_rows)
+
+        self._check_columns(columns)
+
+        start = self._reserve_rows(n)
+        position = (self.cursor[1] + self.cursor[2]) % self.capacity
+
+        for name, column in zip(TRANSITION_FIELDS, columns):
+            self.storage[name][start:start + n] = self._encode(name, column, position)
+
+        self._index_episode(position, start, n, self.cursor[3])
+
+    def _index_episode(self, position, start, n, ep_id):
+
+        #Add the episode written at rows start:start + n to the FIFO index
+        self.ep_start[position] = start
+        self.ep_len[position] = n
+        self.ep_id[position] = ep_id
+        self.ep_update[position] = self.n_updates[0]
+
+        self.cursor[0] = start + n
+        self.cursor[2] += 1
+        self.cursor[3] = ep_id + 1
+        self.cursor[5] += n
+        self.generation += 1
+
+    def _reserve_rows(self, n):
+
+        #Start row for an episode of n transitions, evicting the oldest episodes as required
+        if n > self.n_rows:
+            if self.transition_capacity:
+                raise ValueError("Episode of {} transitions does not fit in a replay of {} transitions".format(n, self.n_rows))
+            self._grow(2*n)
+
+        #Evict the oldest episode if the replay is full
+        if self.cursor[2] == self.capacity:
+            self._evict_oldest()
+
+        start, n_evict = self._find_rows(n)
+
+        #Grow instead of evicting episodes when the number of transitions is not limited
+        if n_evict > 0 and not self.transition_capacity:
+            self._grow(max(2*self.n_rows, self.n_transitions + n))
+            start, n_evict = self._find_rows(n)
+
+        for _ in range(n_evict):
+            self._evict_oldest()
+
+        return start
+
+    def _find_rows(self, n):
+
+        #Start row for n consecutive transitions and the number of oldest episodes whose rows are needed
+        write_row = int(self.cursor[0])
+        wrap = write_row + n > self.n_rows
+        start = 0 if wrap else write_row
+
+        n_evict = 0
+        for i_episode in range(int(self.cursor[2])):
+            position = (self.cursor[1] + i_episode) % self.capacity
+            ep_start = self.ep_start[position]
+
+            #Episodes after the write row are skipped when wrapping to row 0, they are the oldest ones
+            skipped = wrap and ep_start >= write_row
+            overlaps = ep_start < start + n and start < ep_start + self.ep_len[position]
+            if not (skipped or overlaps):
+                break
+            n_evict += 1
+
+        return start, n_evict
+
+    def _evict_oldest(self):
+
+        self.cursor[5] -= self.ep_len[self.cursor[1]]
+        self.cursor[1] = (self.cursor[1] + 1) % self.capacity
+        self.cursor[2] -= 1
+
+    def _grow(self, n_rows):
+
+        #Reallocate the field arrays and copy the stored episodes to consecutive rows in FIFO order
+        positions = self._positions()
+        rows = self._episode_rows(self.ep_start[positions], self.ep_len[positions])
+
+        storage = self.storage
+        self._allocate_storage(self.schema, n_rows)
+        for name in TRANSITION_FIELDS:
+            self.storage[name][:len(rows)] = storage[name][rows]
+
+        self.ep_start[positions] = np.cumsum(self.ep_len[positions]) - self.ep_len[positions]
+        self.cursor[0] = len(rows)
+
+    def _positions(self):
+
+        #FIFO positions of the stored episodes, oldest first
+        return (self.cursor[1] + np.arange(self.cursor[2])) % self.capacity
+
+    @staticmethod
+    def _episode_rows(starts, lengths):
+
+        #Rows of the given episodes concatenated in order, without a Python loop over the transitions
+        offsets = np.cumsum(lengths) - lengths
+        return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+    @staticmethod
+    def _sequence_layout(lengths):
+
+        #lengths sorted in decreasing order
+        #Returns the [batch, T_max] positions of the transitions concatenated in episode order,
+        #the number of sequences at each timepoint and the flattened padded rows in packed (time-major) order
+        T_max = int(lengths[0])
+        offsets = np.cumsum(lengths) - lengths
+        batch_idx = np.repeat(np.arange(len(lengths)), lengths)
+        time_idx = np.arange(lengths.sum()) - np.repeat(offsets, lengths)
+
+        valid = np.arange(T_max)[:, np.newaxis] < lengths[np.newaxis, :]
+        batch_sizes = valid.sum(axis=1)
+        pack_time_idx, pack_batch_idx = np.nonzero(valid)
+        pack_idx = pack_batch_idx * T_max + pack_time_idx
+
+        return batch_idx, time_idx, batch_sizes, pack_idx
+
+    def _sample_episodes(self, batch_size, rng):
+
+        #FIFO positions of the sampled episodes and their importance-sampling weights (None for uniform sampling)
+        positions = (self.cursor[1] + rng.choice(int(self.cursor[2]), batch_size, replace=False)) % self.capacity
+        return positions, None
+
+    def sample(self, batch_size, rng=None):
+
+        #rng: RandomState used instead of the replay's own to draw the episodes
+        t_start = time.perf_counter_ns()
+        with self.lock:
+            batch = self._sample(batch_size, self.rng if rng is None else rng)
+
+            #Staleness: number of agent updates since the sampled episode was pushed
+            self.sampled_staleness.append(self.n_updates[0] - self.ep_update[batch[11][0]])
+
+        self.sample_latency_ns.append(time.perf_counter_ns() - t_start)
+
+        return batch
+
+    def count_update(self):
+
+        #Called by the agent once per update_parameters
+        self.n_updates[0] += 1
+
+    def statistics(self):
+
+        """Occupancy, memory, sampled episode staleness and sample latency of the replay since the last reset_statistics
+
+            The staleness of a sampled episode is the number of agent updates (count_update calls) between its push
+            and the sample, staleness_histogram[k] is the number of sampled episodes with
+            2**k - 1 <= staleness < 2**(k+1) - 1. A ReplayPrefetcher samples up to its n_batches updates ahead.
+        """
+
+        with self.lock:
+            arrays = [self.ep_start, self.ep_len, self.ep_id, self.ep_update, self.cursor, self.n_updates]
+            if self.storage is not None:
+                arrays += [*self.storage.values(), *self.codec_params.values()]
+
+            stats = {"episodes": len(self),
+                     "transitions": self.n_transitions,
+                     "rows": self.n_rows if self.storage is not None else 0,
+                     "bytes_allocated": sum(array.nbytes for array in arrays),
+                     "bytes_per_transition": self.bytes_per_transition() if self.storage is not None else 0,
+                     "samples": len(self.sample_latency_ns)}
+
+        stats["bytes_used"] = stats["bytes_per_transition"] * stats["transitions"]
+
+        if len(self.sample_latency_ns) != 0:
+            latency_ms = np.array(self.sample_latency_ns) / 1e6
+            staleness = np.concatenate(self.sampled_staleness)
+            stats["latency_ms"] = dict(zip(["p50", "p90", "p99", "max"], np.percentile(latency_ms, [50, 90, 99, 100]).tolist()))
+            stats["latency_ms"]["mean"] = float(latency_ms.mean())
+            stats["staleness"] = dict(zip(["p50", "p90", "max"], np.percentile(staleness, [50, 90, 100]).tolist()))
+            stats["staleness"]["mean"] = float(staleness.mean())
+            stats["staleness_histogram"] = np.bincount(np.log2(staleness + 1).astype(np.int64))
+
+        return stats
+
+    def reset_statistics(self):
+
+        self.sample_latency_ns = []
+        self.sampled_staleness = []
+
+    def _sample(self, batch_size, rng):
+
+        positions, weights = self._sample_episodes(batch_size, rng)
+        lengths = self.ep_len[positions]
+
+        #Window start drawn uniformly over the episode
+        if self.sequence_window > 0:
+            window_starts = (rng.uniform(size=len(positions)) * (np.maximum(lengths - self.sequence_window, 0) + 1)).astype(np.int64)
+            lengths = np.minimum(lengths - window_starts, self.sequence_window)
+        else:
+            window_starts = np.zeros(len(positions), dtype=np.int64)
+
+        #Sort the sampled sequences by decreasing length, so the padded batch can be packed without sorting
+        order = np.argsort(-lengths, kind='stable')
+        positions, lengths, window_starts = positions[order], lengths[order], window_starts[order]
+        rows = self._episode_rows(self.ep_start[positions] + window_starts, lengths)
+
+        row_positions = np.repeat(positions, lengths)
+        state, action, reward, next_state, done, h_current, neural_activity, na_idx = [self._decode(name, rows, row_positions) for name in TRANSITION_FIELDS]
+
+        #Padded state sequences [batch, T_max, obs] of the sampled episodes for the policy update
+        batch_idx, time_idx, batch_sizes, pack_idx = self._sequence_layout(lengths)
+        policy_state_batch = np.zeros((len(lengths), lengths[0], *state.shape[1:]), dtype=state.dtype)
+        policy_state_batch[batch_idx, time_idx] = state
+
+        policy_seq_layout = (lengths, batch_sizes, pack_idx)
+
+        #Per-transition importance-sampling weights
+        if weights is not None:
+            weights = np.repeat(weights[order], lengths).astype(np.float32)
+
+        #Sampled episodes, to update their priorities
+        sampled_episodes = (positions, self.ep_id[positions])
+
+        policy_burn_in = self._burn_in_batch(positions, window_starts) if self.sequence_window > 0 else None
+
+        return state, action, reward, next_state, done, h_current, policy_state_batch, policy_seq_layout, neural_activity, na_idx, weights, sampled_episodes, policy_burn_in
+
+    def _burn_in_batch(self, positions, window_starts):
+
+        #Stored hidden state before the burn-in prefix of each window (zeros at the episode start),
+        #the padded burn-in states [batch, burn-in T_max, obs] and the burn-in lengths
+        starts = self.ep_start[positions]
+        burn_in_starts = np.maximum(window_starts - self.burn_in, 0)
+        burn_in_lengths = window_starts - burn_in_starts
+
+        has_h = burn_in_starts > 0
+        h_init = np.zeros((len(positions), *self.schema["h_current"][0]), dtype=np.float32)
+        h_init[has_h] = self._decode("h_current", starts[has_h] + burn_in_starts[has_h] - 1, positions[has_h])
+
+        rows = self._episode_rows(starts + burn_in_starts, burn_in_lengths)
+        state = self._decode("state", rows, np.repeat(positions, burn_in_lengths))
+
+        offsets = np.cumsum(burn_in_lengths) - burn_in_lengths
+        batch_idx = np.repeat(np.arange(len(positions)), burn_in_lengths)
+        time_idx = np.arange(len(rows)) - np.repeat(offsets, burn_in_lengths)
+        burn_in_batch = np.zeros((len(positions), burn_in_lengths.max(), *state.shape[1:]), dtype=np.float32)
+        burn_in_batch[batch_idx, time_idx] = state
+
+        return h_init, burn_in_batch, burn_in_lengths
+
+    def save_snapshot(self, snapshot_dir):
+
+        """Writes the episodes pushed since the last snapshot to a new chunk in snapshot_dir
+
+            A chunk holds the encoded field arrays of its episodes as .npy files, snapshot.json lists the chunks
+            in order. Chunks whose episodes have all been evicted are deleted.
+        """
+
+        if self.storage is None:
+            return
+
+        os.makedirs(snapshot_dir, exist_ok=True)
+        manifest = read_snapshot_manifest(snapshot_dir)
+        if manifest is None:
+            manifest = {"schema": {name: [list(shape), np.dtype(dtype).str] for name, (shape, dtype) in self.schema.items()},
+                        "codecs": self.codecs,
+                        "chunks": []}
+
+        #Copy the new episodes under the lock, the rollout workers of a shared replay and the prefetcher
+        #may push or sample concurrently, the files are written outside the lock
+        with self.lock:
+            positions = self._positions()
+            new_positions = positions[self.ep_id[positions] > self.snapshot_last_id]
+            oldest_id = self.ep_id[positions[0]] if len(positions) != 0 else self.cursor[3]
 
-    def push(self, state):
-        if len(self.buffer) < self.capacity:
-            self.buffer.append(None)
-        self.buffer[self.position] = state
-        self.position = (self.position + 1) % self.capacity
+            if len(new_positions) != 0:
+                lengths = self.ep_len[new_positions]
+                rows = self._episode_rows(self.ep_start[new_positions], lengths)
+                chunk = {name: self.storage[name][rows] for name in TRANSITION_FIELDS}
+                chunk.update({name + "_affine": params[new_positions] for name, params in self.codec_params.items()})
+                chunk["ep_len"] = lengths
+                chunk["ep_id"] = self.ep_id[new_positions]
 
-    def sample(self, batch_size):
-        batch = random.sample(self.buffer, batch_size)
-        batch_list = list(chain(*batch))
-        state, action, reward, next_state, done, h_current, neural_activity, na_idx = map(np.stack, zip(*batch_list))
+        if len(new_positions) != 0:
+            #Write into a temporary folder and rename it, so a partial chunk is never listed
+            last_id = int(chunk["ep_id"][-1])
+            chunk_name = "chunk_{:08d}".format(last_id)
+            tmp_path = tempfile.mkdtemp(dir=snapshot_dir)
+            for name, array in chunk.items():
+                np.save(os.path.join(tmp_path, name + ".npy"), array)
 
-        policy_state_batch = [[list(element)[0] for element in sample]for sample in batch]
-        policy_state_batch = list(map(torch.FloatTensor, policy_state_batch))
+            #A chunk left by an interrupted snapshot is not in the manifest and is replaced
+            #mkdtemp creates the folder with mode 0700, give it the permissions of a folder created with os.makedirs
+            shutil.rmtree(os.path.join(snapshot_dir, chunk_name), ignore_errors=True)
+            os.chmod(tmp_path, 0o755 & ~_umask())
+            os.rename(tmp_path, os.path.join(snapshot_dir, chunk_name))
 
-        return state, action, reward, next_state, done, h_current, policy_state_batch, neural_activity, na_idx
+            manifest["chunks"].append({"name": chunk_name, "last_id": last_id})
+            self.snapshot_last_id = last_id
+
+        #Prune the chunks of evicted episodes
+        pruned = [chunk for chunk in manifest["chunks"] if chunk["last_id"] < oldest_id]
+        manifest["chunks"] = [chunk for chunk in manifest["chunks"] if chunk["last_id"] >= oldest_id]
+
+        tmp_file_name = os.path.join(snapshot_dir, "snapshot.json.tmp")
+        with open(tmp_file_name, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_file_name, os.path.join(snapshot_dir, "snapshot.json"))
+
+        for chunk in pruned:
+            shutil.rmtree(os.path.join(snapshot_dir, chunk["name"]), ignore_errors=True)
+
+    def load_snapshot(self, snapshot_dir):
+
+        """Pushes the episodes of the snapshot in snapshot_dir into the replay, returns the number of episodes restored
+
+            The chunks are memory-mapped and copied episode by episode without decoding, the episode ids
+            are kept so later snapshots only add the new episodes. Only the last capacity episodes are copied.
+        """
+
+        with self.lock:
+            return self._load_snapshot(snapshot_dir)
+
+    def _load_snapshot(self, snapshot_dir):
+
+        manifest = read_snapshot_manifest(snapshot_dir)
+        if manifest is None:
+            return 0
+
+        if manifest["codecs"] != self.codecs:
+            raise ValueError("The replay snapshot in {} was written with different codecs".format(snapshot_dir))
+
+        if self.storage is None:
+            schema = {name: (tuple(shape), np.dtype(dtype)) for name, (shape, dtype) in manifest["schema"].items()}
+            self._allocate_storage(schema, self.transition_capacity if self.transition_capacity else 1024)
+
+        chunk_paths = [os.path.join(snapshot_dir, chunk["name"]) for chunk in manifest["chunks"]]
+        chunk_ep_lens = [np.load(os.path.join(chunk_path, "ep_len.npy")) for chunk_path in chunk_paths]
+        chunk_ep_ids = [np.load(os.path.join(chunk_path, "ep_id.npy")) for chunk_path in chunk_paths]
+
+        #Only the last capacity new episodes would be kept, the older ones are not copied
+        new_ids = np.concatenate([ep_ids[ep_ids >= self.cursor[3]] for ep_ids in chunk_ep_ids] + [np.zeros(0, dtype=np.int64)])
+        first_id = new_ids[-self.capacity] if len(new_ids) > self.capacity else self.cursor[3]
+
+        n_restored = 0
+        for chunk, chunk_path, lengths, ep_ids in zip(manifest["chunks"], chunk_paths, chunk_ep_lens, chunk_ep_ids):
+            if chunk["last_id"] < first_id:
+                self.snapshot_last_id = chunk["last_id"]
+                continue
+
+            fields = {name: np.load(os.path.join(chunk_path, name + ".npy"), mmap_mode='r') for name in TRANSITION_FIELDS}
+            params = {name: np.load(os.path.join(chunk_path, name + "_affine.npy"), mmap_mode='r') for name in self.codec_params}
+
+            offsets = np.cumsum(lengths) - lengths
+            for i_episode, (offset, n, ep_id) in enumerate(zip(offsets, lengths, ep_ids)):
+                if ep_id < max(first_id, self.cursor[3]):
+                    continue
+
+                start = self._reserve_rows(n)
+                position = (self.cursor[1] + self.cursor[2]) % self.capacity
+                for name in TRANSITION_FIELDS:
+                    self.storage[name][start:start + n] = fields[name][offset:offset + n]
+                for name in params:
+                    self.codec_params[name][position] = params[name][i_episode]
+
+                self._index_episode(position, start, n, ep_id)
+                n_restored += 1
+
+            self.snapshot_last_id = chunk["last_id"]
+
+        return n_restored
 
     def __len__(self):
-        return len(self.buffer)
+        return int(self.cursor[2])
+
+def _umask():
+
+    #Current umask of the process (os.umask can only be read by setting it)
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+def read_snapshot_manifest(snapshot_dir):
+
+    #The manifest of the replay snapshot in snapshot_dir, None if there is no snapshot
+    manifest_file = os.path.join(snapshot_dir, "snapshot.json")
+    if not os.path.isfile(manifest_file):
+        return None
+
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def read_replay_statistics(file_name):
+
+    #The statistics() records appended to file_name during training, one pickle per episode
+    records = []
+    with open(file_name, 'rb') as f:
+        while True:
+            try:
+                records.append(pickle.load(f))
+            except EOFError:
+                return records
+
+class SumTree:
+
+    """Binary sum-tree over n_leaves priorities with O(log n) updates and prefix-sum search
+
+        The internal nodes are updated by differences, they are recomputed from the leaves after every n_leaves
+        updates to bound the accumulated rounding error.
+    """
+
+    def __init__(self, n_leaves):
+
+        self.n_leaves = 1
+        while self.n_leaves < n_leaves:
+            self.n_leaves *= 2
+
+        self.depth = self.n_leaves.bit_length() - 1
+        self.tree = np.zeros((2*self.n_leaves,))
+        self.n_updates = 0
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def get(self, leaves):
+        return self.tree[self.n_leaves + np.asarray(leaves)]
+
+    def update(self, leaf, priority):
+
+        node = self.n_leaves + int(leaf)
+        change = priority - self.tree[node]
+        self.tree[node] = priority
+        node //= 2
+        while node >= 1:
+            self.tree[node] += change
+            node //= 2
+
+        self.n_updates += 1
+        if self.n_updates >= self.n_leaves:
+            self.rebuild()
+
+    def rebuild(self):
+
+        #Recompute the internal nodes level by level from the leaves
+        for level in range(self.depth - 1, -1, -1):
+            first, last = 2**level, 2**(level + 1)
+            self.tree[first:last] = self.tree[2*first:2*last:2] + self.tree[2*first + 1:2*last:2]
+
+        self.n_updates = 0
+
+    def find(self, values):
+
+        #Leaves whose prefix-sum interval contains each of the values, vectorized over the values
+        #A subtree of zero sum is never entered, so a value past the drifted sum of its subtree still ends in a nonzero leaf
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        for _ in range(self.depth):
+            left = 2*nodes
+            go_right = ((values > self.tree[left]) & (self.tree[left + 1] > 0)) | (self.tree[left] <= 0)
+            values = np.where(go_right, values - self.tree[left], values)
+            nodes = np.where(go_right, left + 1, left)
+
+        return nodes - self.n_leaves
+
+class PrioritizedPolicyReplayMemory(PolicyReplayMemory):
+
+    """PolicyReplayMemory that samples episodes with probability proportional to priority**alpha
+
+        Priorities are kept per episode in a sum-tree over the FIFO positions. New episodes get the highest
+        priority seen so far and update_priorities sets them from the mean absolute TD error of their transitions.
+        The episodes of a batch are drawn with replacement. The importance-sampling weights (N*P(i))**-beta
+        are normalized by their maximum in the batch.
+    """
+
+    def __init__(self, capacity, seed, transition_capacity=None, codecs=None, sequence_window=0, burn_in=0, alpha=0.6, beta=0.4, epsilon=1e-6):
+
+        super().__init__(capacity, seed, transition_capacity, codecs, sequence_window, burn_in)
+
+        self.alpha = alpha
+        self.beta = beta
+        self.epsilon = epsilon
+        self.max_priority = 1.0
+        self.sum_tree = SumTree(capacity)
+
+    def _index_episode(self, position, start, n, ep_id):
+
+        super()._index_episode(position, start, n, ep_id)
+        self.sum_tree.update(position, self.max_priority**self.alpha)
+
+    def _evict_oldest(self):
+
+        self.sum_tree.update(self.cursor[1], 0)
+        super()._evict_oldest()
+
+    def _sample_episodes(self, batch_size, rng):
+
+        #Stratified sampling of the prefix sums in (0, total), one value per segment of the total priority
+        #The episodes are drawn with replacement, unlike the uniform sampling of PolicyReplayMemory: an episode whose
+        #priority spans several segments can appear several times in a batch (update_priorities keeps the last TD error)
+        total = self.sum_tree.total
+        values = (np.arange(batch_size) + 1 - rng.uniform(size=batch_size)) * total / batch_size
+        positions = self.sum_tree.find(np.minimum(values, total * (1 - 1e-12)))
+
+        #A leaf of zero priority (empty or evicted slot) would give an infinite importance-sampling weight
+        probabilities = self.sum_tree.get(positions) / total
+        assert (probabilities > 0).all(), "Sampled an episode of zero priority"
+        weights = (len(self) * probabilities) ** -self.beta
+
+        return positions, weights / weights.max()
+
+    def update_priorities(self, sampled_episodes, td_errors):
+
+        #td_errors: mean absolute TD error of each sampled episode
+        #Episodes evicted since they were sampled are skipped
+        positions, ep_ids = sampled_episodes
+        with self.lock:
+            for position, ep_id, td_error in zip(positions, ep_ids, td_errors):
+                if self.ep_id[position] == ep_id and self.sum_tree.get(position) > 0:
+                    priority = float(td_error) + self.epsilon
+                    self.max_priority = max(self.max_priority, priority)
+                    self.sum_tree.update(position, priority**self.alpha)
+
+            self.generation += 1
+
+class MemmapPolicyReplayMemory(PolicyReplayMemory):
+
+    """PolicyReplayMemory with the field arrays in memory-mapped .npy files under replay_dir
+
+        Only the episode index and the cursor are kept in RAM, they are saved to replay_dir/index.npz after
+        every push (written to a temporary file and renamed), so the replay is reopened with its contents when
+        a replay_dir that already holds a replay is given again. The number of transitions has to be limited
+        with transition_capacity as the files are not grown.
+    """
+
+    def __init__(self, capacity, seed, transition_capacity, replay_dir, codecs=None, sequence_window=0, burn_in=0):
+
+        assert transition_capacity, "The memory-mapped replay requires a transition_capacity"
+
+        self.replay_dir = replay_dir
+        os.makedirs(replay_dir, exist_ok=True)
+
+        super().__init__(capacity, seed, transition_capacity, codecs, sequence_window, burn_in)
+
+        #Reopen the replay saved in replay_dir
+        if os.path.isfile(self._path("index.npz")):
+            self._load_index()
+
+    def _path(self, file_name):
+        return os.path.join(self.replay_dir, file_name)
+
+    def _alloc_array(self, name, shape, dtype):
+
+        #The episode index and the cursor are kept in RAM and saved with _save_index
+        if name in ("ep_start", "ep_len", "ep_id", "cursor"):
+            return np.zeros(shape, dtype=dtype)
+
+        #Reuse the existing file if it matches, otherwise create it
+        file_name = self._path(name + ".npy")
+        if os.path.isfile(file_name):
+            array = np.load(file_name, mmap_mode='r+')
+            if array.shape == tuple(shape) and array.dtype == np.dtype(dtype):
+                return array
+            del array
+
+        return np.lib.format.open_memmap(file_name, mode='w+', dtype=dtype, shape=tuple(shape))
+
+    def _allocate_storage(self, schema, n_rows):
+
+        super()._allocate_storage(schema, n_rows)
+
+        schema_json = {name: [list(shape), np.dtype(dtype).str] for name, (shape, dtype) in schema.items()}
+        self._atomic_write("schema.json", lambda f: f.write(json.dumps(schema_json).encode()))
+
+    def _atomic_write(self, file_name, write):
+
+        tmp_file_name = self._path(file_name + ".tmp")
+        with open(tmp_file_name, 'wb') as f:
+            write(f)
+
+        os.replace(tmp_file_name, self._path(file_name))
+
+    def _save_index(self):
+        self._atomic_write("index.npz", lambda f: np.savez(f, ep_start=self.ep_start, ep_len=self.ep_len, ep_id=self.ep_id, cursor=self.cursor))
+
+    def _load_index(self):
+
+        index = np.load(self._path("index.npz"))
+        if len(index["ep_start"]) != self.capacity or int(index["cursor"][4]) != self.transition_capacity:
+            raise ValueError("The replay in {} was created with a different capacity".format(self.replay_dir))
+
+        with open(self._path("schema.json")) as f:
+            schema = {name: (tuple(shape), np.dtype(dtype)) for name, (shape, dtype) in json.load(f).items()}
+
+        if any(dtype != np.dtype(REPLAY_CODECS[self.codecs.get(name, "float32")]) for name, (_, dtype) in schema.items() if dtype != np.int64):
+            raise ValueError("The replay in {} was created with different codecs".format(self.replay_dir))
+
+        self._allocate_storage(schema, self.transition_capacity)
+
+        self.ep_start[:] = index["ep_start"]
+        self.ep_len[:] = index["ep_len"]
+        self.ep_id[:] = index["ep_id"]
+        self.cursor[:] = index["cursor"]
+
+    def _reserve_rows(self, n):
+
+        start = super()._reserve_rows(n)
+
+        #Drop the evicted episodes from the saved index before their rows are overwritten
+        self._save_index()
+
+        return start
+
+    def push_columns(self, columns):
+
+        super().push_columns(columns)
+
+        #The new episode is added to the saved index once its transitions are written
+        self._save_index()
+
+    def load_snapshot(self, snapshot_dir):
+
+        n_restored = super().load_snapshot(snapshot_dir)
+        self._save_index()
+
+        return n_restored
+
+    def flush(self):
+
+        for array in [*self.storage.values(), *self.codec_params.values()]:
+            array.flush()
+
+def unlink_segments(segments):
+
+    #Remove the shared memory segments, the pages are freed once no process maps them
+    for segment in segments:
+        segment.unlink()
+
+class SharedPolicyReplayMemory(PolicyReplayMemory):
+
+    """PolicyReplayMemory with all its arrays in multiprocessing.shared_memory segments
+
+        The field arrays, the episode index, the cursor and the generation counter live in shared memory, so
+        collector processes that receive the replay (it pickles to the segment names and the lock) push
+        episodes straight into the pages the learner samples from. Pushes and samples hold a process-shared
+        lock for the length of one episode copy.
+
+        The field shapes are given up front as (name, per-transition shape) in TRANSITION_FIELDS order and the
+        number of transitions has to be limited with transition_capacity as the segments are not grown.
+        The process that created the replay unlinks the segments in close() or at exit, the replay stays
+        readable in the processes that have it mapped.
+    """
+
+    def __init__(self, capacity, seed, transition_capacity, fields, codecs=None, sequence_window=0, burn_in=0, ctx=None):
+
+        assert transition_capacity, "The shared memory replay requires a transition_capacity"
+
+        #Python >= 3.8
+        from multiprocessing import shared_memory, get_context
+        self._shared_memory = shared_memory
+        self._segments = {}
+        self._owner = True
+        self._generation = self._alloc_array("generation", (1,), np.int64)
+
+        super().__init__(capacity, seed, transition_capacity, codecs, sequence_window, burn_in)
+
+        self.lock = (ctx or get_context("spawn")).RLock()
+
+        #Allocate the field arrays now, the collector processes attach to them
+        columns = [np.zeros((1, *shape), dtype=np.float32) for _, shape in fields]
+        self._allocate_storage(self._schema(columns), transition_capacity)
+
+        self._finalizer = weakref.finalize(self, unlink_segments, [segment for segment, _, _ in self._segments.values()])
+
+    @property
+    def generation(self):
+        return int(self._generation[0])
+
+    @generation.setter
+    def generation(self, value):
+        self._generation[0] = value
+
+    def _alloc_array(self, name, shape, dtype):
+
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        segment = self._shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self._segments[name] = (segment, tuple(shape), np.dtype(dtype).str)
+
+        array = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+        array[...] = 0
+
+        return array
+
+    def _grow(self, n_rows):
+        raise ValueError("The shared memory replay of {} transitions cannot be grown".format(self.n_rows))
+
+    def __getstate__(self):
+
+        #Handle of the replay: the segment names, the lock and the settings
+        return {"capacity": self.capacity,
+                "transition_capacity": self.transition_capacity,
+                "codecs": self.codecs,
+                "sequence_window": self.sequence_window,
+                "burn_in": self.burn_in,
+                "schema": self.schema,
+                "segments": {name: (segment.name, shape, dtype) for name, (segment, shape, dtype) in self._segments.items()},
+                "lock": self.lock}
+
+    def __setstate__(self, state):
+
+        from multiprocessing import shared_memory
+        self._shared_memory = shared_memory
+        self._owner = False
+
+        self.capacity = state["capacity"]
+        self.transition_capacity = state["transition_capacity"]
+        self.codecs = state["codecs"]
+        self.sequence_window = state["sequence_window"]
+        self.burn_in = state["burn_in"]
+        self.schema = state["schema"]
+        self.lock = state["lock"]
+        self.rng = np.random.RandomState()
+        self.snapshot_last_id = -1
+        self.sample_latency_ns = []
+        self.sampled_staleness = []
+
+        self._segments = {}
+        arrays = {}
+        for name, (segment_name, shape, dtype) in state["segments"].items():
+            segment = shared_memory.SharedMemory(name=segment_name)
+            self._segments[name] = (segment, shape, dtype)
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+
+        self._generation = arrays["generation"]
+        self.ep_start = arrays["ep_start"]
+        self.ep_len = arrays["ep_len"]
+        self.ep_id = arrays["ep_id"]
+        self.cursor = arrays["cursor"]
+        self.n_updates = arrays["n_updates"]
+        self.ep_update = arrays["ep_update"]
+        self.storage = {name: arrays[name] for name in self.schema}
+        self.codec_params = {name: arrays[name + "_affine"] for name in self.codecs if name + "_affine" in arrays}
+
+    def close(self):
+
+        if self._owner:
+            self._finalizer()
@@ -0,0 +1,147 @@
+#Background sampling of replay batches: a thread samples and collates the next batches into tensors
+#while the learner steps the environment and runs the updates
+
+import threading
+from collections import deque
+import numpy as np
+import torch
+
+def batch_to_tensors(batch, device):
+
+    #Converts a batch returned by PolicyReplayMemory.sample to tensors on device, the packing layout and
+    #the priority bookkeeping are passed through
+    (state, action, reward, next_state, mask, h_current, policy_state_batch, policy_seq_layout,
+     neural_activity, na_idx, weights, sampled_episodes, policy_burn_in) = batch
+
+    non_blocking = torch.device(device).type == "cuda"
+
+    def to_device(array):
+        tensor = torch.from_numpy(array)
+        if non_blocking:
+            tensor = tensor.pin_memory()
+        return tensor.to(device, non_blocking=non_blocking)
+
+    lengths, batch_sizes, pack_idx = policy_seq_layout
+
+    #Hidden state [1, batch, hidden] before the burn-in, padded burn-in states and burn-in lengths (kept in numpy)
+    if policy_burn_in is not None:
+        h_init, burn_in_batch, burn_in_lengths = policy_burn_in
+        policy_burn_in = (to_device(h_init).permute(1, 0, 2), to_device(burn_in_batch), burn_in_lengths)
+
+    return (to_device(state),
+            to_device(action),
+            to_device(reward).unsqueeze(1),
+            to_device(next_state),
+            to_device(mask).unsqueeze(1),
+            to_device(h_current).permute(1, 0, 2),
+            to_device(policy_state_batch),
+            (lengths.tolist(), torch.from_numpy(batch_sizes), to_device(pack_idx)),
+            to_device(neural_activity),
+            to_device(na_idx).float(),
+            None if weights is None else to_device(weights).unsqueeze(1),
+            sampled_episodes,
+            policy_burn_in)
+
+class ReplayPrefetcher():
+
+    """Keeps up to n_batches tensor batches of the replay ready, sampled by a background thread
+
+        The k-th batch handed to the learner is drawn with np.random.RandomState([seed, k]) from the replay
+        as it is when the batch is requested, so a run is reproducible whatever the thread timing.
+        Batches sampled before the replay generation changed (new episodes, new priorities) are dropped and
+        resampled by the thread. With a prioritized replay the priorities change after every update,
+        so prefetching only helps with uniform sampling.
+    """
+
+    def __init__(self, replay, batch_size, device, n_batches, seed):
+
+        self.replay = replay
+        self.batch_size = batch_size
+        self.device = device
+        self.n_batches = n_batches
+        self.seed = seed
+
+        #Index of the next batch handed to the learner and of the next batch to sample
+        self.n_consumed = 0
+        self.next_k = 0
+        self.ready = deque()
+
+        self.cond = threading.Condition()
+        self.closed = False
+        self.error = None
+        self.thread = None
+
+    def __len__(self):
+        return len(self.replay)
+
+    def _sample_batch(self, k):
+
+        #Batch k and the replay generation it was sampled from
+        with self.replay.lock:
+            generation = self.replay.generation
+            batch = self.replay.sample(self.batch_size, rng=np.random.RandomState([self.seed, k]))
+
+        return generation, batch_to_tensors(batch, self.device)
+
+    def _run(self):
+
+        try:
+            while True:
+                with self.cond:
+                    while not self.closed and len(self.ready) >= self.n_batches:
+                        self.cond.wait()
+                    if self.closed:
+                        return
+                    k = self.next_k
+
+                generation, tensors = self._sample_batch(k)
+
+                with self.cond:
+                    #Drop the batch if the prefetcher was closed, the prefetching was restarted or the replay has changed in the meantime
+                    if not self.closed and k == self.next_k and generation == self.replay.generation:
+                        self.ready.append((generation, k, tensors))
+                        self.next_k += 1
+                        self.cond.notify_all()
+
+        except Exception as error:
+            with self.cond:
+                self.error = error
+                self.cond.notify_all()
+
+    def sample_tensors(self, batch_size, device):
+
+        assert batch_size == self.batch_size and torch.device(device) == torch.device(self.device)
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+        with self.cond:
+            #Restart the prefetching from this batch if the replay has changed since the batches were sampled
+            if len(self.ready) != 0 and self.ready[0][0] != self.replay.generation:
+                self.ready.clear()
+                self.next_k = self.n_consumed
+                self.cond.notify_all()
+
+            while len(self.ready) == 0 and self.error is None:
+                self.cond.wait()
+            if self.error is not None:
+                raise RuntimeError("The replay prefetcher thread failed") from self.error
+
+            _, k, tensors = self.ready.popleft()
+            assert k == self.n_consumed
+            self.n_consumed += 1
+            self.cond.notify_all()
+
+        return tensors
+
+    def close(self):
+
+        with self.cond:
+            self.closed = True
+            self.ready.clear()
+            self.cond.notify_all()
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
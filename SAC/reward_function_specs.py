@@ -18,34 +18,50 @@ reward_scaling_factor = 1000
 #Threshold crossing penalty is imposed if any of the body/end-effector xyz pos goes outside the thresholding region
 threshold_crossing_penalty = -5
 
-def reward_function(state_td, sim_state, action_t, threshold):
-	
-        xyz_coord_dists = []
+def reward_function(state_td, sim_state, action_t, threshold, xyz_coord_dists=None):
 
-        for musculo_body_tracking in musculo_tracking:
-        	musculo_body = sim_state.data.get_body_xpos(musculo_body_tracking[0]).flat.copy()
-        	musculo_target = sim_state.data.get_body_xpos(musculo_body_tracking[1]).flat.copy()
+	#xyz_coord_dists: absolute xyz distances [n_tracking, 3] of the musculo_tracking pairs if already computed by the environment
+	if xyz_coord_dists is None:
+		tracking_ids = tracking_body_ids(sim_state.model, musculo_tracking)
+		xyz_coord_dists = tracking_distances(sim_state.data.body_xpos, tracking_ids)
 
-        	current_dists = np.abs(musculo_body - musculo_target)
-        	xyz_coord_dists = [*xyz_coord_dists, *current_dists]
+	reward, _ = reward_from_distances_batch(xyz_coord_dists[np.newaxis], np.asarray(action_t)[np.newaxis], threshold)
 
-        	#If any body goes out of the movement thresholding region return a very high penalty
-        	if (np.array(current_dists) > threshold).any():
-        		return threshold_crossing_penalty
+	return reward[0]
 
-        xyz_coord_dists = np.array(xyz_coord_dists)
-        #Implement the exponential reward scaling 
-        reward_exp = 1/(reward_scaling_factor**xyz_coord_dists)
-        reward = np.sum(reward_exp)
+def tracking_body_ids(model, tracking_pairs):
 
+	#Resolve the (musculo body, target) names to body ids once: [n_pairs, 2]
+	return np.array([[model.body_name2id(musculo_body), model.body_name2id(musculo_target)] for musculo_body, musculo_target in tracking_pairs], dtype=np.int64)
 
-        if min_muscle_constraint:
-            muscle_cost = muscle_effort_cost(action_t)
-            reward = reward - muscle_cost
+def tracking_distances(body_xpos, tracking_ids):
 
-        return reward
+	#Distance kernel shared by the reward and the termination criteria
+	#body_xpos: [..., n_bodies, 3] e.g. sim.data.body_xpos or stacked for N_envs
+	#Returns the absolute xyz distances between the musculo bodies and their targets [..., n_pairs, 3]
+	return np.abs(np.take(body_xpos, tracking_ids[:, 0], axis=-2) - np.take(body_xpos, tracking_ids[:, 1], axis=-2))
+
+def reward_from_distances_batch(xyz_coord_dists, action_t, threshold):
+
+	#xyz_coord_dists: [N_envs, n_tracking, 3], action_t: [N_envs, n_muscles], threshold: scalar or [N_envs]
+	#Returns the rewards [N_envs] and whether any body went out of the thresholding region [N_envs]
+	threshold = np.reshape(threshold, (-1, 1, 1))
+	threshold_crossed = (xyz_coord_dists > threshold).any(axis=(1, 2))
+
+	#Implement the exponential reward scaling 
+	reward_exp = 1/(reward_scaling_factor**xyz_coord_dists)
+	reward = reward_exp.reshape(reward_exp.shape[0], -1).sum(axis=1)
+
+	if min_muscle_constraint:
+		reward = reward - muscle_effort_cost(action_t)
+
+	#If any body goes out of the movement thresholding region return a very high penalty
+	reward = np.where(threshold_crossed, threshold_crossing_penalty, reward)
+
+	return reward, threshold_crossed
 
 def muscle_effort_cost(action_t):
 
-        cost= muscle_cost_scaler * np.sum(np.abs(action_t))
+        #action_t: [n_muscles] or [N_envs, n_muscles], returns the effort cost of each action
+        cost= muscle_cost_scaler * np.sum(np.abs(action_t), axis=-1)
         return cost
\ No newline at end of file
@@ -3,10 +3,10 @@ import torch
 import torch.nn.functional as F
 from torch.optim import Adam
 from .utils import soft_update, hard_update
-from .model import Actor, Critic
-from torch.nn.utils.rnn import pad_sequence
+from .model import Actor, Critic, SequenceLayout
 import numpy as np
 from .replay_memory import PolicyReplayMemory
+from .replay_prefetcher import batch_to_tensors
 import ipdb
 
 class SAC_Agent():
@@ -25,7 +25,9 @@ class SAC_Agent():
                  beta_usim:float,
                  gamma_usim:float,
                  zeta_nusim:float,
-                 cuda: bool):
+                 cuda: bool,
+                 n_critics: int = 2,
+                 critic_target_heads: int = 2):
 
         if cuda:
             self.device = torch.device("cuda")
@@ -39,8 +41,12 @@ class SAC_Agent():
         self.zeta_nusim = zeta_nusim
 
         ### SET CRITIC NETWORKS ###
-        self.critic = Critic(num_inputs, action_space.shape[0], hidden_size).to(self.device)
-        self.critic_target = Critic(num_inputs, action_space.shape[0], hidden_size).to(self.device)
+        #The target Q-value is the min over a random subset of critic_target_heads of the n_critics target heads
+        assert 2 <= critic_target_heads <= n_critics, "critic_target_heads must be between 2 and n_critics"
+        self.n_critics = n_critics
+        self.critic_target_heads = critic_target_heads
+        self.critic = Critic(num_inputs, action_space.shape[0], hidden_size, n_critics).to(self.device)
+        self.critic_target = Critic(num_inputs, action_space.shape[0], hidden_size, n_critics).to(self.device)
         self.critic_optim = Adam(self.critic.parameters(), lr=lr)
         hard_update(self.critic_target, self.critic)
 
@@ -63,35 +69,27 @@ class SAC_Agent():
             self.log_alpha = torch.zeros(1, requires_grad=True, device=self.device)
             self.alpha_optim = Adam([self.log_alpha], lr=lr)
     
+    #The policy regularizers take the taps of the actor update unroll (Actor.sample_with_taps),
+    #the RNN output and the linear1 output at the valid timepoints of the batch
+
     #This loss encourages the simple low-dimensional dynamics in the RNN activity
-    def _policy_loss_2(self, policy_state_batch, h0, len_seq, mask_seq):
+    def _policy_loss_2(self, rnn_out_r):
 
         # Sample the hidden weights of the RNN
         J_rnn_w = self.actor.rnn.weight_hh_l0        #These weights would be of the size (hidden_dim, hidden_dim)
 
-        #Sample the output of the RNN for the policy_state_batch
-        rnn_out_r, _ = self.actor.forward_for_simple_dynamics(policy_state_batch, h0, sampling=False, len_seq=len_seq)
-        rnn_out_r = rnn_out_r.reshape(-1, rnn_out_r.size()[-1])[mask_seq]
-
-        #Reshape the policy hidden weights vector
-        J_rnn_w = J_rnn_w.unsqueeze(0).repeat(rnn_out_r.size()[0], 1, 1)
+        #||J_rnn_w * (1 - r_t^2)[:, None]||^2 summed over the timesteps t, reduced without the (timesteps, hidden_dim, hidden_dim) tensor:
+        #row i of J_rnn_w is scaled by (1 - r_t,i^2), so the loss is sum_i (sum_t (1 - r_t,i^2)^2) * ||J_rnn_w[i, :]||^2
         rnn_out_r = 1 - torch.pow(rnn_out_r, 2)
 
-        R_j = torch.mul(J_rnn_w, rnn_out_r.unsqueeze(-1))
-
-        policy_loss_2 = torch.norm(R_j)**2
+        policy_loss_2 = torch.dot(torch.pow(rnn_out_r, 2).sum(0), torch.pow(J_rnn_w, 2).sum(1))
 
         return policy_loss_2
     
     #This loss encourages the minimization of the firing rates for the linear and the RNN layer.
-    def _policy_loss_3(self, policy_state_batch, h0, len_seq, mask_seq):
+    def _policy_loss_3(self, rnn_out_r, linear_out):
 
         #Find the loss encouraging the minimization of the firing rates for the linear and the RNN layer
-        #Sample the output of the RNN for the policy_state_batch
-        rnn_out_r, linear_out = self.actor.forward_for_simple_dynamics(policy_state_batch, h0, sampling=False, len_seq=len_seq)
-        rnn_out_r = rnn_out_r.reshape(-1, rnn_out_r.size()[-1])[mask_seq]
-        linear_out = linear_out.reshape(-1, linear_out.size()[-1])[mask_seq]
-
         policy_loss_3 = torch.norm(rnn_out_r)**2 + torch.norm(linear_out)**2
 
         return policy_loss_3
@@ -115,10 +113,8 @@ class SAC_Agent():
         return policy_loss_4
 
     #Define a loss function that constraints a subset of the RNN nodes to the experimental neural data
-    def _policy_loss_exp_neural_constrain(self, policy_state_batch, h0, len_seq, neural_activity_batch, na_idx_batch, mask_seq):
+    def _policy_loss_exp_neural_constrain(self, lstm_out, neural_activity_batch, na_idx_batch):
         #Find the loss for neural activity constrainting
-        lstm_out = self.actor.forward_lstm(policy_state_batch, h0, sampling= False, len_seq= len_seq)
-        lstm_out = lstm_out.reshape(-1, lstm_out.size()[-1])[mask_seq]
         lstm_activity = lstm_out[:, 0:neural_activity_batch.shape[-1]]
 
         #Now filter the neural activity batch and lstm activity batch using the na_idx batch
@@ -149,34 +145,79 @@ class SAC_Agent():
 
         return action.detach().cpu().numpy()[0], h_current.detach(), rnn_out.detach().cpu().numpy(), rnn_in.detach().cpu().numpy()
 
+    def select_action_batch(self, states: np.ndarray, h_prev: torch.Tensor, evaluate=False) -> (np.ndarray, torch.Tensor):
+
+        #Select the actions of n_envs environments in one forward pass
+        #states: [n_envs, n_inputs], h_prev: [1, n_envs, hidden_size]
+        states = torch.from_numpy(np.asarray(states, dtype=np.float32)).to(self.device).unsqueeze(1)
+        h_prev = h_prev.to(self.device)
+
+        ### IF TRAINING ###
+        if evaluate == False:
+            action, _, _, h_current, _, _, _ = self.actor.sample(states, h_prev, sampling=True, len_seq=None)
+        ### IF TESTING ###
+        else:
+            _, _, action, h_current, _, _, _ = self.actor.sample(states, h_prev, sampling=True, len_seq=None)
+
+        return action.detach().cpu().numpy(), h_current.detach()
+
+    def _burn_in(self, h_init, burn_in_batch, burn_in_lengths):
+
+        #RNN state at the start of the sampled windows, the burn-in prefix is unrolled without gradients
+        if burn_in_batch.size()[1] == 0:
+            return h_init
+
+        has_burn_in = burn_in_lengths > 0
+        has_burn_in_t = torch.from_numpy(has_burn_in).to(self.device)
+        with torch.no_grad():
+            _, _, h_burn_in, _, _ = self.actor.forward(burn_in_batch[has_burn_in_t], h_init[:, has_burn_in_t].contiguous(), sampling=False, len_seq=burn_in_lengths[has_burn_in].tolist())
+
+        h0 = h_init.clone()
+        h0[:, has_burn_in_t] = h_burn_in
+
+        return h0
+
     def update_parameters(self, policy_memory: PolicyReplayMemory, policy_batch_size: int) -> (int, int, int):
 
         ### SAMPLE FROM REPLAY ###
-        state_batch, action_batch, reward_batch, next_state_batch, mask_batch, h_batch, policy_state_batch, neural_activity_batch, na_idx_batch = policy_memory.sample(batch_size=policy_batch_size)
-
-        ### CONVERT DATA TO TENSOR ###
-        state_batch = torch.FloatTensor(state_batch).to(self.device)
-        next_state_batch = torch.FloatTensor(next_state_batch).to(self.device)
-        action_batch = torch.FloatTensor(action_batch).to(self.device)
-        reward_batch = torch.FloatTensor(reward_batch).to(self.device).unsqueeze(1)
-        mask_batch = torch.FloatTensor(mask_batch).to(self.device).unsqueeze(1)
-        h_batch = torch.FloatTensor(h_batch).to(self.device).permute(1, 0, 2)
-        neural_activity_batch = torch.FloatTensor(neural_activity_batch).to(self.device)
-        na_idx_batch = torch.FloatTensor(na_idx_batch).to(self.device)
+        #A ReplayPrefetcher hands over batches already converted to tensors by its background thread
+        if hasattr(policy_memory, "sample_tensors"):
+            batch = policy_memory.sample_tensors(policy_batch_size, self.device)
+        else:
+            batch = batch_to_tensors(policy_memory.sample(batch_size=policy_batch_size), self.device)
+
+        state_batch, action_batch, reward_batch, next_state_batch, mask_batch, h_batch, policy_state_batch, policy_seq_layout, neural_activity_batch, na_idx_batch, weights_batch, sampled_episodes, policy_burn_in = batch
 
         h0 = torch.zeros(size=(1, next_state_batch.shape[0], self.hidden_size)).to(self.device)
         ### SAMPLE NEXT Q VALUE FOR CRITIC LOSS ###
         with torch.no_grad():
             next_state_action, next_state_log_pi, _, _, _, _, _ = self.actor.sample(next_state_batch.unsqueeze(1), h_batch, sampling=True)
-            qf1_next_target, qf2_next_target = self.critic_target(next_state_batch, next_state_action)
-            min_qf_next_target = torch.min(qf1_next_target, qf2_next_target) - self.alpha * next_state_log_pi
+            qf_next_target = self.critic_target(next_state_batch, next_state_action)
+            if self.critic_target_heads < self.n_critics:
+                qf_next_target = qf_next_target[torch.randperm(self.n_critics, device=self.device)[:self.critic_target_heads]]
+            min_qf_next_target = qf_next_target.min(0)[0] - self.alpha * next_state_log_pi
             next_q_value = reward_batch + mask_batch * self.gamma * (min_qf_next_target)
 
         ### CALCULATE CRITIC LOSS ###
-        qf1, qf2 = self.critic(state_batch, action_batch)  # Two Q-functions to mitigate positive bias in the policy improvement step
-        qf1_loss = F.mse_loss(qf1, next_q_value)  # JQ = 𝔼(st,at)~D[0.5(Q1(st,at) - r(st,at) - γ(𝔼st+1~p[V(st+1)]))^2]
-        qf2_loss = F.mse_loss(qf2, next_q_value)  # JQ = 𝔼(st,at)~D[0.5(Q1(st,at) - r(st,at) - γ(𝔼st+1~p[V(st+1)]))^2]
-        qf_loss = qf1_loss + qf2_loss
+        qf = self.critic(state_batch, action_batch)  # Several Q-functions to mitigate positive bias in the policy improvement step
+        if weights_batch is None:
+            qf_losses = (qf - next_q_value).pow(2).mean((1, 2))  # JQ = 𝔼(st,at)~D[0.5(Q1(st,at) - r(st,at) - γ(𝔼st+1~p[V(st+1)]))^2]
+        else:
+            #Importance-sampling weighted loss of the prioritized replay
+            qf_losses = (weights_batch * (qf - next_q_value).pow(2)).mean((1, 2))
+        qf_loss = qf_losses.sum()
+
+        ### UPDATE EPISODE PRIORITIES ###
+        policy_memory = getattr(policy_memory, "replay", policy_memory)
+        if hasattr(policy_memory, "update_priorities"):
+            #Mean absolute TD error of each sampled episode, the transitions of an episode are contiguous in the batch
+            td_errors = (qf - next_q_value).abs().mean(0).detach().squeeze(1).cpu().numpy()
+            episode_lengths = np.asarray(policy_seq_layout[0])
+            episode_starts = np.concatenate([[0], np.cumsum(episode_lengths)[:-1]])
+            policy_memory.update_priorities(sampled_episodes, np.add.reduceat(td_errors, episode_starts) / episode_lengths)
+
+        #The replay measures the staleness of the sampled episodes in updates
+        policy_memory.count_update()
 
         ### TAKE GRAIDENT STEP ###
         self.critic_optim.zero_grad()
@@ -184,17 +225,21 @@ class SAC_Agent():
         self.critic_optim.step()
 
         ### SAMPLE FROM ACTOR NETWORK ###
-        h0 = torch.zeros(size=(1, len(policy_state_batch), self.hidden_size)).to(self.device)
-        len_seq = list(map(len, policy_state_batch))
-        policy_state_batch = torch.FloatTensor(pad_sequence(policy_state_batch, batch_first= True)).to(self.device)
-        pi_action_bat, log_prob_bat, _, _, mask_seq, _, _  = self.actor.sample(policy_state_batch, h0, sampling=False, len_seq=len_seq)
+        #The replay returns the padded batch sorted by length with its packing layout, shared by all the RNN passes below
+        #Sampled windows start from the stored hidden state, warmed up over their burn-in prefix
+        if policy_burn_in is not None:
+            h0 = self._burn_in(*policy_burn_in)
+        else:
+            h0 = torch.zeros(size=(1, len(policy_state_batch), self.hidden_size)).to(self.device)
+        len_seq = SequenceLayout(*policy_seq_layout)
+        #One unroll provides the actions and the taps of all the policy regularizers
+        pi_action_bat, log_prob_bat, _, _, mask_seq, rnn_out, linear_out = self.actor.sample_with_taps(policy_state_batch, h0, len_seq)
 
         ### MASK POLICY STATE BATCH ###
         policy_state_batch_pi = policy_state_batch.reshape(-1, policy_state_batch.size()[-1])[mask_seq]
 
         ### GET VALUE OF CURRENT STATE AND ACTION PAIRS ###
-        qf1_pi, qf2_pi = self.critic(policy_state_batch_pi, pi_action_bat)
-        min_qf_pi = torch.min(qf1_pi, qf2_pi)
+        min_qf_pi = self.critic(policy_state_batch_pi, pi_action_bat).min(0)[0]
 
         ### CALCULATE POLICY LOSS ###
         task_loss = ((self.alpha * log_prob_bat) - min_qf_pi).mean() # Jπ = 𝔼st∼D,εt∼N[α * logπ(f(εt;st)|st) − Q(st,f(εt;st))]
@@ -206,10 +251,10 @@ class SAC_Agent():
 
         if self.multi_policy_loss:
 
-            loss_simple_dynamics = self._policy_loss_2(policy_state_batch, h0, len_seq, mask_seq)
-            loss_activations_min = self._policy_loss_3(policy_state_batch, h0, len_seq, mask_seq)
+            loss_simple_dynamics = self._policy_loss_2(rnn_out)
+            loss_activations_min = self._policy_loss_3(rnn_out, linear_out)
             loss_weights_min = self._policy_loss_4()
-            loss_exp_constrain = self._policy_loss_exp_neural_constrain(policy_state_batch, h0, len_seq, neural_activity_batch, na_idx_batch, mask_seq)
+            loss_exp_constrain = self._policy_loss_exp_neural_constrain(rnn_out, neural_activity_batch, na_idx_batch)
 
             ### CALCULATE FINAL POLICY LOSS ###
             #To implement nuSim training use a weighting of 1e+04 with loss_exp_constrain
@@ -237,4 +282,6 @@ class SAC_Agent():
         ### SOFT UPDATE OF CRITIC TARGET ###
         soft_update(self.critic_target, self.critic, self.tau)
 
-        return qf1_loss.item(), qf2_loss.item(), policy_loss.item()
\ No newline at end of file
+        qf1_loss, qf2_loss = qf_losses[:2].tolist()
+
+        return qf1_loss, qf2_loss, policy_loss.item()
\ No newline at end of file
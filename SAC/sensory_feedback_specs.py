@@ -16,17 +16,17 @@ visual_distance_pert = perturbation_specs.visual_distance_pert
 #Functions to process the sensory feedback from the environment before it enters the uSim controller
 def process_stimulus(stim_feedback):
 	
-	#Input: list objects
-	#Imp: First convert the input to numpy arrays, do the processing, and then convert the output
-	#back to list object before returning for all sensory feedback functions. 
+	#Input: numpy float32 views into the preallocated observation buffer
+	#Imp: The feedback can be processed in place, or new values (numpy arrays or lists of the same length)
+	#can be returned, for all sensory feedback functions.
 
 	return stim_feedback
 
 def process_proprioceptive(muscle_lengths, muscle_velocities):
 	
-	#Input: list objects
-	#Imp: First convert the input to numpy arrays, do the processing, and then convert the output
-	#back to list object before returning for all sensory feedback functions. 
+	#Input: numpy float32 views into the preallocated observation buffer
+	#Imp: The feedback can be processed in place, or new values (numpy arrays or lists of the same length)
+	#can be returned, for all sensory feedback functions.
 
 	return muscle_lengths, muscle_velocities
 
@@ -0,0 +1,74 @@
+#Per-phase wall time profiling of the environment step
+#The phases are timed by replacing the bound methods on the environment instance with timed wrappers,
+#so an environment that is not instrumented runs the original code without any overhead
+
+import time
+import types
+from collections import OrderedDict
+
+#Methods of Muscle_Env timed as the phases of a step
+ENV_PHASES = ["step", "do_simulation", "get_reward", "is_done", "upd_theta", "_get_obs", "_get_visual_velocity"]
+
+class StepProfiler():
+
+    """Accumulates the wall time (time.perf_counter_ns) and the number of calls of each phase
+
+        Phases are nested as they are called: the sensory feedback hooks are included in _get_obs
+        and all the other phases in step.
+    """
+
+    def __init__(self):
+
+        self.time_ns = OrderedDict()
+        self.calls = OrderedDict()
+
+    def timed(self, phase, fn):
+
+        perf_counter_ns = time.perf_counter_ns
+        time_ns = self.time_ns
+        calls = self.calls
+        time_ns[phase] = 0
+        calls[phase] = 0
+
+        def timed_fn(*args, **kwargs):
+            t_start = perf_counter_ns()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                time_ns[phase] += perf_counter_ns() - t_start
+                calls[phase] += 1
+
+        return timed_fn
+
+    def instrument(self, env):
+
+        #Time the step phases of this environment instance only
+        for phase in ENV_PHASES:
+            setattr(env, phase, self.timed(phase, getattr(env, phase)))
+
+        #The sensory feedback and perturbation hooks are looked up through env._feedback_hooks
+        hooks = env._feedback_hooks
+        env._feedback_hooks = types.SimpleNamespace(**{name: self.timed(name, getattr(hooks, name))
+                                                       for name in dir(hooks) if name.startswith("process_")})
+
+    def reset(self):
+
+        for phase in self.time_ns:
+            self.time_ns[phase] = 0
+            self.calls[phase] = 0
+
+    def summary(self):
+
+        #{phase: {"calls", "total_ms", "mean_us"}} of the phases called since the last reset
+        return OrderedDict((phase, {"calls": self.calls[phase],
+                                    "total_ms": self.time_ns[phase] / 1e6,
+                                    "mean_us": self.time_ns[phase] / 1e3 / self.calls[phase]})
+                           for phase in self.time_ns if self.calls[phase] > 0)
+
+    def pop_summary(self):
+
+        #Summary of the phases called since the last reset, then reset
+        summary = self.summary()
+        self.reset()
+
+        return summary
@@ -3,9 +3,12 @@ from pyquaternion import Quaternion
 import math
 import pandas as pd
 import matplotlib.pyplot as pp
+import skvideo
 import skvideo.io
 import os
 import pickle
+import queue
+import threading
 from copy import deepcopy
 import torch
 
@@ -28,9 +31,79 @@ def logsumexp(inputs, dim=None, keepdim=False):
     return outputs
 
 def soft_update(target, source, tau):
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(target_param.data * (1.0 - tau) + param.data * tau)
+    #Polyak update in place with the multi-tensor kernels, no temporaries per parameter
+    with torch.no_grad():
+        target_params = list(target.parameters())
+        torch._foreach_mul_(target_params, 1.0 - tau)
+        torch._foreach_add_(target_params, list(source.parameters()), alpha=tau)
 
 def hard_update(target, source):
+    #One multi-tensor copy where the torch version has it (torch._foreach_copy_ is not in torch 1.13)
+    if hasattr(torch, "_foreach_copy_"):
+        with torch.no_grad():
+            torch._foreach_copy_(list(target.parameters()), list(source.parameters()))
+        return
+
     for target_param, param in zip(target.parameters(), source.parameters()):
         target_param.data.copy_(param.data)
+
+class VideoRecorder():
+
+    """Encodes rgb frames into a video file in a background thread
+
+        Frames are handed over through a bounded queue, so the control loop only pays for reading the pixels
+        and blocks only if the encoder falls max_queued_frames behind.
+    """
+
+    def __init__(self, filename, fps, max_queued_frames=64):
+
+        self.filename = filename
+        self.frame_queue = queue.Queue(maxsize=max_queued_frames)
+        self.writer = skvideo.io.FFmpegWriter(filename,
+                                              inputdict={'-r': str(fps)},
+                                              outputdict={'-r': str(fps), '-vcodec': 'libx264', '-pix_fmt': 'yuv420p'})
+        self.error = None
+
+        self.thread = threading.Thread(target=self._encode, daemon=True)
+        self.thread.start()
+
+    def _encode(self):
+
+        while True:
+            frame = self.frame_queue.get()
+            if frame is None:
+                break
+
+            #Keep draining the queue after an error so that add_frame never blocks
+            if self.error is None:
+                try:
+                    self.writer.writeFrame(frame)
+                except Exception as e:
+                    self.error = e
+
+        self.writer.close()
+
+    @staticmethod
+    def unavailable_reason(env, width, height):
+
+        #None if the frames of env can be rendered offscreen and encoded, otherwise why no video can be recorded
+        try:
+            env.render(mode='rgb_array', width=width, height=height)
+        except Exception as e:
+            return "offscreen rendering failed ({}: {})".format(type(e).__name__, e)
+
+        if skvideo.getFFmpegVersion() == "0.0.0":
+            return "FFmpeg (ffmpeg and ffprobe) was not found"
+
+        return None
+
+    def add_frame(self, frame):
+        self.frame_queue.put(frame)
+
+    def close(self):
+
+        self.frame_queue.put(None)
+        self.thread.join()
+
+        if self.error is not None:
+            raise RuntimeError("Encoding {} failed".format(self.filename)) from self.error
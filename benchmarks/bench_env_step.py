@@ -0,0 +1,152 @@
+#Per-step cost of the musculoskeletal environment on the bundled monkey model
+#
+#  upd_theta: the per-step target update, with the target joint addresses resolved once and a single qpos write,
+#             against the former per-target name lookup, MjSimState copy and set_state
+#  throughput: environment steps per second of the single-environment loop (select_action for one environment,
+#              frame_repeat steps) against VectorMuscleEnv with select_action_batch for several n_envs,
+#              stepped in this process (n_env_workers 0) and in parallel by several worker processes
+#
+#Requires mujoco_py, musculo_targets.xml (append_musculo_targets.py) and the initial pose (find_init_pose.py)
+#usage: python benchmarks/bench_env_step.py --config configs/configs.txt [--n_envs_list 1 4 8 16] [--n_env_workers_list 0 2 4] [--n_decisions 200]
+#
+#Measured on MuJoCo 2.3.1 physics (mujoco_py API on the official bindings), 1 CPU, --n_decisions 1000:
+#  upd_theta                           cached addresses 21-25 us/step, per-target lookup and set_state 39-47 us/step
+#  upd_theta, lean_stepping True       cached addresses 7.7 us/step
+#  sequential Muscle_Env               3263-3319 env steps/s (4525 with lean_stepping True)
+#  VectorMuscleEnv n_envs 4            4994-5384 env steps/s (7020 with lean_stepping True)
+
+import os
+import sys
+import time
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from SAC import kinematics_preprocessing_specs
+from SAC.RL_Framework_Mujoco import Muscle_Env, VectorMuscleEnv
+from SAC.sac import SAC_Agent
+
+def upd_theta_baseline(env):
+
+    #upd_theta before the target joint addresses were cached: name lookups, full state copy and set_state every step
+    n_timepoints = env.kin_to_sim[env.current_cond_to_sim].shape[-1]
+    n_moving_steps = env._max_episode_steps - env.n_fixedsteps
+    if env.istep <= env.n_fixedsteps:
+        env.tpoint_to_sim = 0
+    elif env.istep <= env._max_episode_steps:
+        env.tpoint_to_sim = int(((n_timepoints - 1) / n_moving_steps) * (env.istep - env.n_fixedsteps))
+    else:
+        env.tpoint_to_sim = int(((n_timepoints - 1) / n_moving_steps) * ((env.istep - env.n_fixedsteps) % n_moving_steps))
+    env.coord_idx = env.tpoint_to_sim
+
+    coords_to_sim = env.kin_to_sim[env.current_cond_to_sim]
+    crnt_state = env.sim.get_state()
+
+    for i_target in range(coords_to_sim.shape[0]):
+        xyz_target = kinematics_preprocessing_specs.xyz_target[i_target]
+        if xyz_target[0]:
+            crnt_state.qpos[env.model.get_joint_qpos_addr(f"box:x{i_target}")] = coords_to_sim[i_target, 0, env.tpoint_to_sim]
+        if xyz_target[1]:
+            crnt_state.qpos[env.model.get_joint_qpos_addr(f"box:y{i_target}")] = coords_to_sim[i_target, xyz_target[0], env.tpoint_to_sim]
+        if xyz_target[2]:
+            crnt_state.qpos[env.model.get_joint_qpos_addr(f"box:z{i_target}")] = coords_to_sim[i_target, xyz_target[0] + xyz_target[1], env.tpoint_to_sim]
+
+    env.set_state(crnt_state.qpos, crnt_state.qvel)
+
+def time_upd_theta(env, upd_theta, n_calls):
+
+    env.reset(0)
+    t_start = time.perf_counter()
+    for i_call in range(n_calls):
+        env.istep = i_call % env._max_episode_steps
+        upd_theta()
+
+    return (time.perf_counter() - t_start) / n_calls * 1e6
+
+def make_agent(args, obs_dim, action_space):
+
+    return SAC_Agent(obs_dim, action_space, args.hidden_size, args.lr, args.gamma, args.tau, args.alpha,
+                     args.automatic_entropy_tuning, args.model, args.multi_policy_loss,
+                     args.alpha_usim, args.beta_usim, args.gamma_usim, args.zeta_nusim, False)
+
+def sequential_steps_per_second(env, agent, hidden_size, n_decisions):
+
+    #Single-environment training loop without the updates
+    state = [*env.reset(0), env.condition_scalar]
+    h_prev = torch.zeros(size=(1, 1, hidden_size))
+    n_steps = 0
+
+    t_start = time.perf_counter()
+    for _ in range(n_decisions):
+        with torch.no_grad():
+            action, h_prev, _, _ = agent.select_action(state, h_prev, evaluate=False)
+
+        for _ in range(env.frame_repeat):
+            next_state, _, done, _ = env.step(action)
+            n_steps += 1
+            if done:
+                break
+
+        if done:
+            next_state = env.reset(0)
+            h_prev = torch.zeros(size=(1, 1, hidden_size))
+        state = [*next_state, env.condition_scalar]
+
+    return n_steps / (time.perf_counter() - t_start)
+
+def vector_steps_per_second(vec_env, agent, hidden_size, n_decisions):
+
+    #Vectorized training loop without the updates
+    states = vec_env.reset()
+    h_prev = torch.zeros(size=(1, vec_env.n_envs, hidden_size))
+    n_steps = 0
+
+    t_start = time.perf_counter()
+    for _ in range(n_decisions):
+        with torch.no_grad():
+            actions, h_prev = agent.select_action_batch(states, h_prev, evaluate=False)
+
+        steps_before = vec_env.episode_steps.copy()
+        states, _, dones, infos = vec_env.step(actions)
+
+        #The environments that are done were reset in step, their steps are reported in infos
+        for i_env, info in enumerate(infos):
+            n_steps += (info["episode_steps"] if dones[i_env] else vec_env.episode_steps[i_env]) - steps_before[i_env]
+        h_prev[:, torch.from_numpy(dones)] = 0
+
+    return n_steps / (time.perf_counter() - t_start)
+
+def main():
+
+    parser = config.config_parser()
+    parser.add_argument('--n_envs_list', type=int, nargs='+', default=[1, 4, 8, 16])
+    parser.add_argument('--n_env_workers_list', type=int, nargs='+', default=[0, 2, 4])
+    parser.add_argument('--n_decisions', type=int, default=200)
+    parser.add_argument('--n_upd_theta_calls', type=int, default=20000)
+    args = parser.parse_args()
+
+    model_file = args.musculoskeletal_model_path[:-len('musculoskeletal_model.xml')] + 'musculo_targets.xml'
+    torch.set_num_threads(1)
+
+    env = Muscle_Env(model_file, 1, args)
+    print('upd_theta: cached addresses {:.1f} us/step, per-target lookup and set_state {:.1f} us/step'.format(
+        time_upd_theta(env, env.upd_theta, args.n_upd_theta_calls),
+        time_upd_theta(env, lambda: upd_theta_baseline(env), args.n_upd_theta_calls)))
+
+    obs_dim = env.observation_space.shape[0] + len(env.sfs_visual_velocity)*3 + 1
+    agent = make_agent(args, obs_dim, env.action_space)
+
+    print('sequential Muscle_Env: {:.0f} env steps/s'.format(sequential_steps_per_second(env, agent, args.hidden_size, args.n_decisions)))
+    for n_envs in args.n_envs_list:
+        for n_env_workers in args.n_env_workers_list:
+            if n_env_workers > n_envs:
+                continue
+            vec_env = VectorMuscleEnv(Muscle_Env, model_file, 1, args, n_envs, n_workers=n_env_workers)
+            print('VectorMuscleEnv n_envs={} n_env_workers={}: {:.0f} env steps/s'.format(
+                n_envs, n_env_workers, vector_steps_per_second(vec_env, agent, args.hidden_size, args.n_decisions)))
+            vec_env.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#Cost of the simple-dynamics regularizer SAC_Agent._policy_loss_2 (loss and backward) on the CPU
+#
+#  closed form: sum_i (sum_t (1 - r_t,i^2)^2) * ||W_hh[i, :]||^2, as computed by _policy_loss_2
+#  jacobian norm: the former ||W_hh * (1 - r_t^2)[:, None]||^2 through the (timesteps, hidden, hidden) tensor,
+#                 skipped above --max_jacobian_mb of float32 for that tensor
+#
+#The timesteps are the unmasked transitions of a policy batch, e.g. 8 episodes x 300 steps = 2400
+#usage: python benchmarks/bench_policy_loss.py [--hidden_size 256] [--n_timesteps_list 300 2400 9600] [--repeats 5]
+
+import argparse
+import os
+import sys
+import time
+import types
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SAC.sac import SAC_Agent
+
+def jacobian_norm_loss(weight_hh, rnn_out_r):
+
+    J_rnn_w = weight_hh.unsqueeze(0).repeat(rnn_out_r.size()[0], 1, 1)
+    R_j = torch.mul(J_rnn_w, (1 - torch.pow(rnn_out_r, 2)).unsqueeze(-1))
+    return torch.norm(R_j)**2
+
+def closed_form_loss(weight_hh, rnn_out_r):
+
+    agent = types.SimpleNamespace(actor=types.SimpleNamespace(rnn=types.SimpleNamespace(weight_hh_l0=weight_hh)))
+    return SAC_Agent._policy_loss_2(agent, rnn_out_r)
+
+def time_loss_backward(loss_fn, weight_hh, rnn_out_r, repeats):
+
+    #Best of repeats, in ms
+    times = []
+    for _ in range(repeats):
+        weight_hh.grad = None
+        rnn_out_r.grad = None
+        t_start = time.perf_counter()
+        loss_fn(weight_hh, rnn_out_r).backward()
+        times.append((time.perf_counter() - t_start) * 1e3)
+
+    return min(times)
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hidden_size', type=int, default=256)
+    parser.add_argument('--n_timesteps_list', type=int, nargs='+', default=[300, 2400, 9600])
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--max_jacobian_mb', type=float, default=1024)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    for n_timesteps in args.n_timesteps_list:
+        weight_hh = torch.randn(args.hidden_size, args.hidden_size, requires_grad=True)
+        rnn_out_r = torch.tanh(torch.randn(n_timesteps, args.hidden_size)).requires_grad_()
+
+        closed_form_ms = time_loss_backward(closed_form_loss, weight_hh, rnn_out_r, args.repeats)
+
+        jacobian_mb = n_timesteps * args.hidden_size**2 * 4 / 2**20
+        if jacobian_mb <= args.max_jacobian_mb:
+            jacobian_ms = '{:.2f} ms'.format(time_loss_backward(jacobian_norm_loss, weight_hh, rnn_out_r, args.repeats))
+        else:
+            jacobian_ms = 'skipped ({:.0f} MB tensor)'.format(jacobian_mb)
+
+        print('timesteps {} hidden {}: closed form {:.2f} ms, jacobian norm {}'.format(n_timesteps, args.hidden_size, closed_form_ms, jacobian_ms))
+
+if __name__ == '__main__':
+    main()
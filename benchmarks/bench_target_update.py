@@ -0,0 +1,83 @@
+#Cost of the target network updates soft_update and hard_update of SAC/utils.py on the CPU
+#
+#  soft loop: the former per-parameter Polyak update, target.data.copy_(target.data * (1 - tau) + param.data * tau)
+#  soft foreach: soft_update, in place with torch._foreach_mul_ and torch._foreach_add_
+#  hard loop: the former per-parameter target.data.copy_(param.data)
+#  hard foreach: hard_update, torch._foreach_copy_ where the torch version has it
+#
+#The networks are the ensemble critic (n_critics 2) and the RNN actor for the hidden sizes given
+#usage: python benchmarks/bench_target_update.py [--hidden_size_list 64 256 1024] [--repeats 5] [--n_calls 100]
+#
+#Measured on 1 CPU thread (OMP_NUM_THREADS=1), torch 2.x, us per call:
+#  hidden  network   soft loop  soft foreach  hard loop  hard foreach
+#  64      critic       156          64           37          28
+#  64      actor        173          56           40          30
+#  256     critic       288          93           40          37
+#  256     actor        306         103           60          51
+#  1024    critic     12380        1222          791         762
+#  1024    actor       3664        1274          784         792
+
+import argparse
+import copy
+import os
+import sys
+import time
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SAC.model import Actor, Critic
+from SAC.utils import soft_update, hard_update
+
+def soft_update_loop(target, source, tau):
+    for target_param, param in zip(target.parameters(), source.parameters()):
+        target_param.data.copy_(target_param.data * (1.0 - tau) + param.data * tau)
+
+def hard_update_loop(target, source):
+    for target_param, param in zip(target.parameters(), source.parameters()):
+        target_param.data.copy_(param.data)
+
+def time_update(update, target, source, repeats, n_calls):
+
+    #Best of repeats, in us per call
+    times = []
+    for _ in range(repeats):
+        t_start = time.perf_counter()
+        for _ in range(n_calls):
+            update(target, source)
+        times.append((time.perf_counter() - t_start) / n_calls * 1e6)
+
+    return min(times)
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hidden_size_list', type=int, nargs='+', default=[64, 256, 1024])
+    parser.add_argument('--num_inputs', type=int, default=80)
+    parser.add_argument('--num_actions', type=int, default=20)
+    parser.add_argument('--tau', type=float, default=0.005)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--n_calls', type=int, default=100)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    print('hard_update with torch._foreach_copy_: {}'.format(hasattr(torch, '_foreach_copy_')))
+
+    for hidden_size in args.hidden_size_list:
+        networks = {'critic': Critic(args.num_inputs, args.num_actions, hidden_size),
+                    'actor': Actor(args.num_inputs, args.num_actions, hidden_size, 'rnn')}
+
+        for name, source in networks.items():
+            target = copy.deepcopy(source)
+
+            updates = [('soft loop', lambda target, source: soft_update_loop(target, source, args.tau)),
+                       ('soft foreach', lambda target, source: soft_update(target, source, args.tau)),
+                       ('hard loop', hard_update_loop),
+                       ('hard foreach', hard_update)]
+            times = ', '.join('{} {:.0f} us'.format(update_name, time_update(update, target, source, args.repeats, args.n_calls))
+                              for update_name, update in updates)
+
+            print('hidden {} {}: {}'.format(hidden_size, name, times))
+
+if __name__ == '__main__':
+    main()
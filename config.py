@@ -72,11 +72,78 @@ def config_parser():
                         default=256, 
                         help='hidden size (default: 1000)')
 
+    parser.add_argument('--n_critics', 
+                        type=int, 
+                        default=2, 
+                        help='number of Q-networks of the critic ensemble (default: 2)')
+
+    parser.add_argument('--critic_target_heads', 
+                        type=int, 
+                        default=2, 
+                        help='size of the random subset of target Q-networks whose min gives the target Q-value (default: 2)')
+
     parser.add_argument('--policy_replay_size', 
                         type=int, 
                         default=50000, 
                         help='size of replay buffer (default: 2800)')
 
+    parser.add_argument('--policy_replay_transitions', 
+                        type=int, 
+                        default=0, 
+                        help='maximum number of transitions stored in the replay buffer, 0 limits the replay by policy_replay_size only (default: 0)')
+
+    parser.add_argument('--replay_dir', 
+                        type=str, 
+                        default='', 
+                        help='folder for a memory-mapped replay buffer that persists across runs, requires policy_replay_transitions (default: in RAM)')
+
+    parser.add_argument('--shared_replay', 
+                        type=boolean_string, 
+                        default=False, 
+                        help='with n_rollout_workers, the workers push their episodes into a replay buffer in shared memory, requires policy_replay_transitions (default: False)')
+
+    parser.add_argument('--prioritized_replay', 
+                        type=boolean_string, 
+                        default=False, 
+                        help='sample episodes by priority from the critic TD errors (default: False)')
+
+    parser.add_argument('--priority_alpha', 
+                        type=float, 
+                        default=0.6, 
+                        help='exponent of the episode priorities, 0 samples uniformly (default: 0.6)')
+
+    parser.add_argument('--priority_beta', 
+                        type=float, 
+                        default=0.4, 
+                        help='exponent of the importance-sampling weights of the critic loss (default: 0.4)')
+
+    parser.add_argument('--h_replay_codec', 
+                        type=str, 
+                        default='float32', 
+                        choices=['float32', 'float16', 'bfloat16', 'uint8'],
+                        help='storage of the hidden states in the replay buffer, uint8 is a per-episode affine quantization (default: float32)')
+
+    parser.add_argument('--obs_replay_codec', 
+                        type=str, 
+                        default='float32', 
+                        choices=['float32', 'float16', 'bfloat16', 'uint8'],
+                        help='storage of the observations in the replay buffer, uint8 is a per-episode affine quantization (default: float32)')
+
+    parser.add_argument('--sequence_window', 
+                        type=int, 
+                        default=0, 
+                        help='sample windows of at most this many transitions from the episodes for the updates, 0 samples whole episodes (default: 0)')
+
+    parser.add_argument('--burn_in', 
+                        type=int, 
+                        default=0, 
+                        help='number of transitions before each sampled window used to warm up the RNN state without gradients (default: 0)')
+
+    parser.add_argument('--prefetch_batches', 
+                        type=int, 
+                        default=0, 
+                        help='number of update batches sampled ahead by a background thread, 0 samples in the training loop (default: 0)')
+
     parser.add_argument('--multi_policy_loss', 
                         type=boolean_string, 
                         default=False, 
@@ -91,11 +158,51 @@ def config_parser():
                         action="store_true",
                         help='run on CUDA (default: False)')
 
+    parser.add_argument('--n_envs', 
+                        type=int, 
+                        default=1, 
+                        help='number of environments stepped in lockstep with batched actor inference during training (default: 1)')
+
+    parser.add_argument('--n_env_workers', 
+                        type=int, 
+                        default=0, 
+                        help='number of processes stepping the n_envs environments in parallel, 0 steps them in the training process (default: 0)')
+
+    parser.add_argument('--n_rollout_workers', 
+                        type=int, 
+                        default=0, 
+                        help='number of rollout worker processes feeding a central learner, 0 trains in a single process (default: 0)')
+
+    parser.add_argument('--weight_sync_iter', 
+                        type=int, 
+                        default=100, 
+                        help='number of learner updates between actor weight broadcasts to the rollout workers (default: 100)')
+
     parser.add_argument('--visualize', 
                         type=boolean_string, 
                         default=False,
                         help='visualize monkey/mouse')
 
+    parser.add_argument('--record_video', 
+                        type=boolean_string, 
+                        default=False,
+                        help='record a video of each condition during testing using offscreen rendering')
+
+    parser.add_argument('--video_stride', 
+                        type=int, 
+                        default=1,
+                        help='number of timepoints between the recorded video frames (default: 1)')
+
+    parser.add_argument('--video_width', 
+                        type=int, 
+                        default=500,
+                        help='width of the recorded video frames in pixels (default: 500)')
+
+    parser.add_argument('--video_height', 
+                        type=int, 
+                        default=500,
+                        help='height of the recorded video frames in pixels (default: 500)')
+
     parser.add_argument('--root_dir', 
                         type=str, 
                         default='',
@@ -142,6 +249,11 @@ def config_parser():
                         default=False,
                         help='select whether to train or test a model (train, test)')
 
+    parser.add_argument('--snapshot_replay', 
+                        type=boolean_string, 
+                        default=False,
+                        help='snapshot the replay buffer with the checkpoints and restore it with load_saved_nets_for_training')
+
     parser.add_argument('--musculoskeletal_model_path', 
                         type=str, 
                         default='musculoskeletal_model/musculoskeletal_model.xml',
@@ -187,6 +299,16 @@ def config_parser():
                         default=5,
                         help='The frames/timepoints for which the same action should be repeated during training of the agent')
 
+    parser.add_argument('--lean_stepping', 
+                        type= boolean_string,
+                        default= False,
+                        help='Skip the redundant forward passes while stepping the simulation')
+
+    parser.add_argument('--profile_env_step', 
+                        type= boolean_string,
+                        default= False,
+                        help='Time the phases of the environment step and save per-episode summaries with the training statistics')
+
     parser.add_argument('--n_fixedsteps', 
                         type=int, 
                         default=25,
@@ -257,6 +379,12 @@ def config_parser():
                         default= 0,
                         help='Specify the delay in the sensory feedback in terms of the timepoints')
 
+    parser.add_argument('--channel_delay_timepoints', 
+                        type= list_of_tuples_of_strings,
+                        nargs= '*',
+                        default= None,
+                        help='Specify the delays of individual sensory feedback channels as tuples of channel name and timepoints')
+
     parser.add_argument('--alpha_usim', 
                         type= float,
                         default= 0.1,
@@ -93,6 +93,17 @@ class SACRNN(SAC):
 
         return action.detach().cpu().numpy()[0], h_current.detach(), c_current.detach(), lstm_out.detach().cpu().numpy()
 
+    #This loss encourages the simple low-dimensional dynamics in the RNN activity
+    def _policy_loss_2(self, lstm_out_r):
+
+        # Sample the hidden weights of the RNN
+        J_lstm_w = self.policy.lstm.weight_hh_l0        #These weights would be of the size (hidden_dim, hidden_dim)
+
+        #||J_lstm_w * (1 - r_t^2)[:, None]||^2 summed over the timesteps t, reduced without the (timesteps, hidden_dim, hidden_dim) tensor
+        lstm_out_r = 1 - torch.pow(lstm_out_r, 2)
+
+        return torch.dot(torch.pow(lstm_out_r, 2).sum(0), torch.pow(J_lstm_w, 2).sum(1))
+
     def update_parameters(self, policy_memory, policy_batch_size):
         # Sample a batch from memory
         state_batch, action_batch, reward_batch, next_state_batch, mask_batch, h_batch, c_batch, policy_state_batch = policy_memory.sample(batch_size=policy_batch_size)
@@ -136,20 +147,11 @@ class SACRNN(SAC):
 
         policy_loss = ((self.alpha * log_prob_bat) - min_qf_pi).mean() # Jπ = 𝔼st∼D,εt∼N[α * logπ(f(εt;st)|st) − Q(st,f(εt;st))]
 
-        # Sample the hidden weights of the RNN
-        J_lstm_w = self.policy.lstm.weight_hh_l0        #These weights would be of the size (hidden_dim, hidden_dim)
-
         #Sample the output of the RNN for the policy_state_batch
         lstm_out_r, _ = self.policy.forward_for_simple_dynamics(policy_state_batch, h0, c0, sampling=False, len_seq= len_seq)
         lstm_out_r = lstm_out_r.reshape(-1, lstm_out_r.size()[-1])[mask_seq]
 
-        #Reshape the policy hidden weights vector
-        J_lstm_w = J_lstm_w.unsqueeze(0).repeat(lstm_out_r.size()[0], 1, 1)
-        lstm_out_r = 1 - torch.pow(lstm_out_r, 2)
-
-        R_j = torch.mul(J_lstm_w, lstm_out_r.unsqueeze(-1))
-
-        policy_loss_2 = torch.norm(R_j)**2
+        policy_loss_2 = self._policy_loss_2(lstm_out_r)
 
         #Find the loss encouraging the minimization of the firing rates for the linear and the RNN layer
         #Sample the output of the RNN for the policy_state_batch
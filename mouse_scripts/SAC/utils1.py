@@ -20,9 +20,18 @@ def logsumexp(inputs, dim=None, keepdim=False):
     return outputs
 
 def soft_update(target, source, tau):
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(target_param.data * (1.0 - tau) + param.data * tau)
+    #Polyak update in place with the multi-tensor kernels, no temporaries per parameter
+    with torch.no_grad():
+        target_params = list(target.parameters())
+        torch._foreach_mul_(target_params, 1.0 - tau)
+        torch._foreach_add_(target_params, list(source.parameters()), alpha=tau)
 
 def hard_update(target, source):
+    #One multi-tensor copy where the torch version has it (torch._foreach_copy_ is not in torch 1.13)
+    if hasattr(torch, "_foreach_copy_"):
+        with torch.no_grad():
+            torch._foreach_copy_(list(target.parameters()), list(source.parameters()))
+        return
+
     for target_param, param in zip(target.parameters(), source.parameters()):
         target_param.data.copy_(param.data)
@@ -1,11 +1,16 @@
 import numpy as np
 import torch
 from SAC.sac import SAC_Agent
-from SAC.replay_memory import PolicyReplayMemory
-from SAC.RL_Framework_Mujoco import Muscle_Env
+from SAC.model import twin_critic_state_dict, twin_critic_optimizer_state
+from SAC.replay_memory import PolicyReplayMemory, PrioritizedPolicyReplayMemory, MemmapPolicyReplayMemory, SharedPolicyReplayMemory
+from SAC.RL_Framework_Mujoco import Muscle_Env, VectorMuscleEnv
+from SAC.actor_learner import RolloutWorkers, transition_fields
+from SAC.replay_prefetcher import ReplayPrefetcher
+from SAC.utils import VideoRecorder
 from SAC import sensory_feedback_specs, kinematics_preprocessing_specs, perturbation_specs
 import pickle
 import os
+import shutil
 from numpy.core.records import fromarrays
 from scipy.io import savemat
 
@@ -13,6 +18,62 @@ from scipy.io import savemat
 #Set the current working directory
 os.chdir(os.getcwd())
 
+class ConditionSelector():
+
+    """Select the experimental condition to simulate for the next training episode
+
+        With the "reward" strategy conditions with a lower average reward are repeated more often,
+        otherwise the conditions are cycled through in order.
+    """
+
+    def __init__(self, n_exp_conds, strategy):
+
+        self.n_exp_conds = n_exp_conds
+        self.strategy = strategy
+
+        #Average reward across conditions initialization
+        self.cond_train_count= np.ones((self.n_exp_conds,))
+        self.cond_avg_reward = np.zeros((self.n_exp_conds,))
+        self.cond_cum_reward = np.zeros((self.n_exp_conds,))
+        self.cond_cum_count = np.zeros((self.n_exp_conds,))
+
+    def next(self, episode):
+
+        if self.strategy != "reward":
+            return episode % self.n_exp_conds
+
+        #With several episodes in flight the counts can run out before the finished episodes are recorded
+        if not np.any(self.cond_train_count > 0):
+            self._update_train_count()
+
+        cond_indx = np.nonzero(self.cond_train_count>0)[0][0]
+        self.cond_train_count[cond_indx] = self.cond_train_count[cond_indx] - 1
+
+        return cond_indx
+
+    def record(self, cond_indx, episode_reward):
+
+        if self.strategy != "reward":
+            return
+
+        self.cond_cum_reward[cond_indx] = self.cond_cum_reward[cond_indx] + episode_reward
+        self.cond_cum_count[cond_indx] = self.cond_cum_count[cond_indx] + 1
+
+        #Check if there are all zeros in the cond_train_count array
+        if np.all((self.cond_train_count == 0)):
+            self._update_train_count()
+
+    def _update_train_count(self):
+
+        #Repeat every condition once until all of them have finished at least one episode
+        if np.any(self.cond_cum_count == 0):
+            self.cond_train_count = np.ones((self.n_exp_conds,))
+            return
+
+        self.cond_avg_reward = self.cond_cum_reward / self.cond_cum_count
+        self.cond_train_count = np.ceil((np.max(self.cond_avg_reward)*np.ones((self.n_exp_conds,)))/self.cond_avg_reward)
+
+
 class Simulate():
 
     def __init__(self, env:Muscle_Env, args):
@@ -41,8 +102,34 @@ class Simulate():
             the number of episodes used in a batch during training
         hidden_size: int
             number of hidden neurons in the actor and critic
+        n_critics: int
+            number of Q-networks of the critic ensemble
+        critic_target_heads: int
+            size of the random subset of target Q-networks whose min gives the target Q-value
         policy_replay_size: int
             number of episodes to store in the replay
+        policy_replay_transitions: int
+            number of transitions to store in the replay (0 limits the replay by policy_replay_size only)
+        replay_dir: str
+            folder for a memory-mapped replay that persists across runs (empty keeps the replay in RAM)
+        prioritized_replay: bool
+            sample episodes by priority from the critic TD errors
+        priority_alpha: float
+            exponent of the episode priorities
+        priority_beta: float
+            exponent of the importance-sampling weights of the critic loss
+        h_replay_codec: str
+            storage of the hidden states in the replay (float32, float16, bfloat16 or uint8)
+        obs_replay_codec: str
+            storage of the observations in the replay (float32, float16, bfloat16 or uint8)
+        shared_replay: bool
+            rollout workers push their episodes into a replay in shared memory (requires policy_replay_transitions)
+        sequence_window: int
+            number of transitions of the windows sampled from the episodes for the updates (0 samples whole episodes)
+        burn_in: int
+            number of transitions before each window used to warm up the RNN state without gradients
+        prefetch_batches: int
+            number of update batches sampled ahead by a background thread (0 samples in the training loop)
         multi_policy_loss: bool
             use additional policy losses during updates (reduce norm of weights)
             ONLY USE WITH RNN, NOT IMPLEMENTED WITH GATING
@@ -51,8 +138,20 @@ class Simulate():
             each update
         cuda: bool
             use cuda gpu
+        n_envs: int
+            number of environments stepped in lockstep during training
+        n_env_workers: int
+            number of processes the n_envs environments are stepped in parallel by (0 steps them in this process)
+        n_rollout_workers: int
+            number of rollout worker processes feeding the learner (0 disables the actor/learner mode)
+        weight_sync_iter: int
+            number of learner updates between actor weight broadcasts to the rollout workers
         visualize: bool
             visualize model
+        record_video: bool
+            record a video of every condition during testing with offscreen rendering
+        video_stride: int
+            number of timepoints between the recorded video frames
         model_save_name: str
             specify the name of the model to save
         episodes: int
@@ -61,6 +160,8 @@ class Simulate():
             number of iterations before saving the model
         checkpoint_path: str
             specify path to save and load model
+        snapshot_replay: bool
+            snapshot the replay with the checkpoints and restore it when resuming the training
         muscle_path: str
             path for the musculoskeletal model
         muscle_params_path: str
@@ -72,6 +173,10 @@ class Simulate():
         self.hidden_size = args.hidden_size
         self.policy_batch_size = args.policy_batch_size
         self.visualize = args.visualize
+        self.record_video = args.record_video
+        self.video_stride = args.video_stride
+        self.video_width = args.video_width
+        self.video_height = args.video_height
         self.root_dir = args.root_dir
         self.checkpoint_file = args.checkpoint_file
         self.checkpoint_folder = args.checkpoint_folder
@@ -82,12 +187,22 @@ class Simulate():
         self.condition_selection_strategy = args.condition_selection_strategy
         self.load_saved_nets_for_training = args.load_saved_nets_for_training
         self.verbose_training = args.verbose_training
+        self.snapshot_replay = args.snapshot_replay
+        self.replay_snapshot_folder = self.checkpoint_folder + '/replay_snapshot'
 
         ### ENSURE SAVING FILES ARE ACCURATE ###
         assert isinstance(self.root_dir, str)
         assert isinstance(self.checkpoint_folder, str)
         assert isinstance(self.checkpoint_file, str)
 
+        ### VECTORIZED ENVIRONMENTS / ROLLOUT WORKERS ###
+        self.n_envs = args.n_envs
+        self.n_env_workers = args.n_env_workers
+        self.n_rollout_workers = args.n_rollout_workers
+        self.weight_sync_iter = args.weight_sync_iter
+        self.env_class = env
+        self.args = args
+
         ### SEED ###
         torch.manual_seed(args.seed)
         np.random.seed(args.seed)
@@ -95,10 +210,12 @@ class Simulate():
 
         ### LOAD CUSTOM GYM ENVIRONMENT ###
         if self.mode_to_sim in ["musculo_properties"]:
-            self.env = env(args.musculoskeletal_model_path[:-len('musculoskeletal_model.xml')] + 'musculo_targets_pert.xml', 1, args)
+            self.model_file = args.musculoskeletal_model_path[:-len('musculoskeletal_model.xml')] + 'musculo_targets_pert.xml'
 
         else:
-            self.env = env(args.musculoskeletal_model_path[:-len('musculoskeletal_model.xml')] + 'musculo_targets.xml', 1, args)
+            self.model_file = args.musculoskeletal_model_path[:-len('musculoskeletal_model.xml')] + 'musculo_targets.xml'
+
+        self.env = env(self.model_file, 1, args)
 
         self.observation_shape = self.env.observation_space.shape[0]+len(self.env.sfs_visual_velocity)*3+1
 
@@ -117,10 +234,38 @@ class Simulate():
                                args.beta_usim,
                                args.gamma_usim,
                                args.zeta_nusim,
-                               args.cuda)
+                               args.cuda,
+                               args.n_critics,
+                               args.critic_target_heads)
 
         ### REPLAY MEMORY ###
-        self.policy_memory = PolicyReplayMemory(args.policy_replay_size, args.seed)
+        #Storage codecs of the hidden states and the observations
+        replay_codecs = {"h_current": args.h_replay_codec, "state": args.obs_replay_codec, "next_state": args.obs_replay_codec}
+        self.shared_replay = args.shared_replay and self.n_rollout_workers > 0
+        if self.shared_replay:
+            #The rollout workers push their episodes straight into the replay
+            assert not args.prioritized_replay and len(args.replay_dir) == 0, "shared_replay is not supported with prioritized_replay or replay_dir"
+            fields = transition_fields(self.observation_shape, self.env.action_space.shape[0], self.hidden_size, np.shape(self.env.na_to_sim[0][0]))
+            self.policy_memory = SharedPolicyReplayMemory(args.policy_replay_size, args.seed, args.policy_replay_transitions, fields, codecs= replay_codecs,
+                                                          sequence_window= args.sequence_window, burn_in= args.burn_in)
+        elif args.prioritized_replay:
+            assert len(args.replay_dir) == 0, "prioritized_replay is not supported with replay_dir"
+            self.policy_memory = PrioritizedPolicyReplayMemory(args.policy_replay_size, args.seed, transition_capacity= args.policy_replay_transitions or None,
+                                                               codecs= replay_codecs, sequence_window= args.sequence_window, burn_in= args.burn_in,
+                                                               alpha= args.priority_alpha, beta= args.priority_beta)
+        elif len(args.replay_dir) != 0:
+            #Keep the replay in memory-mapped files, reopened if replay_dir already holds a replay
+            self.policy_memory = MemmapPolicyReplayMemory(args.policy_replay_size, args.seed, args.policy_replay_transitions, args.replay_dir, codecs= replay_codecs,
+                                                         sequence_window= args.sequence_window, burn_in= args.burn_in)
+        else:
+            self.policy_memory = PolicyReplayMemory(args.policy_replay_size, args.seed, transition_capacity= args.policy_replay_transitions or None, codecs= replay_codecs,
+                                                    sequence_window= args.sequence_window, burn_in= args.burn_in)
+
+        #Sample the update batches in a background thread
+        if args.prefetch_batches > 0:
+            self.replay_sampler = ReplayPrefetcher(self.policy_memory, self.policy_batch_size, self.agent.device, args.prefetch_batches, args.seed)
+        else:
+            self.replay_sampler = self.policy_memory
 
 
     def test(self, save_name):
@@ -171,6 +316,14 @@ class Simulate():
         kin_mt = {}
         rnn_input_fp = {}
 
+        #Testing goes on without the videos if they cannot be recorded
+        record_video = self.record_video
+        if record_video:
+            skip_reason = VideoRecorder.unavailable_reason(self.env, self.video_width, self.video_height)
+            if skip_reason is not None:
+                print('record_video: no video is recorded, {}'.format(skip_reason))
+                record_video = False
+
         for i_cond_sim in range(self.env.n_exp_conds):
 
             ### TRACKING VARIABLES ###
@@ -198,6 +351,10 @@ class Simulate():
             # Num_layers specified in the policy model 
             h_prev = torch.zeros(size=(1, 1, self.hidden_size))
 
+            #Frames are encoded in a background thread
+            if record_video:
+                video_recorder = VideoRecorder(save_name + '/video_cond_{}.mp4'.format(i_cond_sim), 1/(self.env.dt*self.video_stride))
+
             ### STEPS PER EPISODE ###
             for timestep in range(self.env.timestep_limit):
 
@@ -248,8 +405,15 @@ class Simulate():
                 if self.visualize == True:
                     self.env.render()
 
+                ### RECORD VIDEO ###
+                if record_video and timestep % self.video_stride == 0:
+                    video_recorder.add_frame(self.env.render(mode='rgb_array', width=self.video_width, height=self.video_height))
+
                 state = next_state
                 h_prev = h_current
+
+            if record_video:
+                video_recorder.close()
             
             #Append the testing data
             emg[i_cond_sim] = np.array(emg_cond)  # [timepoints, muscles]
@@ -295,21 +459,32 @@ class Simulate():
         if self.load_saved_nets_for_training:
             self.load_saved_nets_from_checkpoint(load_best= False)
 
-        ### TRAINING DATA DICTIONARY ###
-        Statistics = {
-            "rewards": [],
-            "steps": [],
-            "policy_loss": [],
-            "critic_loss": []
-        }
+        #Restore the replay from the snapshot of the last training, or start a new snapshot
+        if self.snapshot_replay and len(self.checkpoint_folder) != 0:
+            if self.load_saved_nets_for_training and len(self.policy_memory) == 0:
+                n_restored = self.policy_memory.load_snapshot(self.replay_snapshot_folder)
+                if self.verbose_training:
+                    print('restored {} episodes from the replay snapshot'.format(n_restored))
+            elif not self.load_saved_nets_for_training:
+                shutil.rmtree(self.replay_snapshot_folder, ignore_errors=True)
+
+        #Collect the episodes in rollout worker processes
+        if self.n_rollout_workers > 0:
+            self.train_actor_learner()
+            self._close_replay_sampler()
+            return
+
+        #Step several environments in lockstep with batched actor inference
+        if self.n_envs > 1:
+            self.train_vectorized()
+            self._close_replay_sampler()
+            return
 
-        highest_reward = -float("inf") # used for storing highest reward throughout training
+        ### TRAINING DATA DICTIONARY ###
+        self._init_training_statistics()
 
-        #Average reward across conditions initialization
-        cond_train_count= np.ones((self.env.n_exp_conds,))
-        cond_avg_reward = np.zeros((self.env.n_exp_conds,))
-        cond_cum_reward = np.zeros((self.env.n_exp_conds,))
-        cond_cum_count = np.zeros((self.env.n_exp_conds,))
+        #Condition selection across the experimental conditions
+        cond_selector = ConditionSelector(self.env.n_exp_conds, self.condition_selection_strategy)
 
         ### BEGIN TRAINING ###
         for episode in range(self.episodes):
@@ -322,15 +497,8 @@ class Simulate():
             done = False                # determines if episode is terminated
 
             ### GET INITAL STATE + RESET MODEL BY POSE
-            if self.condition_selection_strategy != "reward":
-                cond_to_select = episode % self.env.n_exp_conds
-                state = self.env.reset(cond_to_select)
-
-            else:
-
-                cond_indx = np.nonzero(cond_train_count>0)[0][0]
-                cond_train_count[cond_indx] = cond_train_count[cond_indx] - 1
-                state = self.env.reset(cond_indx)
+            cond_indx = cond_selector.next(episode)
+            state = self.env.reset(cond_indx)
 
             #Append the high-level task scalar signal
             state = [*state, self.env.condition_scalar]
@@ -350,9 +518,9 @@ class Simulate():
                     na_idx= self.env.coord_idx
 
                 ### UPDATE MODEL PARAMETERS ###
-                if len(self.policy_memory.buffer) > self.policy_batch_size:
+                if len(self.policy_memory) > self.policy_batch_size:
                     for _ in range(self.batch_iters):
-                        critic_1_loss, critic_2_loss, policy_loss = self.agent.update_parameters(self.policy_memory, self.policy_batch_size)
+                        critic_1_loss, critic_2_loss, policy_loss = self.agent.update_parameters(self.replay_sampler, self.policy_batch_size)
                         ### STORE LOSSES ###
                         policy_loss_tracker.append(policy_loss)
                         critic1_loss_tracker.append(critic_1_loss)
@@ -399,69 +567,290 @@ class Simulate():
             ### PUSH TO REPLAY ###
             self.policy_memory.push(ep_trajectory)
 
-            if self.condition_selection_strategy == "reward":
+            cond_selector.record(cond_indx, episode_reward)
 
-                cond_cum_reward[cond_indx] = cond_cum_reward[cond_indx] + episode_reward
-                cond_cum_count[cond_indx] = cond_cum_count[cond_indx] + 1
+            step_profile = self.env.step_profiler.pop_summary() if self.env.step_profiler is not None else None
+            self._end_episode(episode, episode_reward, episode_steps, policy_loss_tracker, critic1_loss_tracker, step_profile)
 
-                #Check if there are all zeros in the cond_train_count array
-                if np.all((cond_train_count == 0)):
-                    cond_avg_reward = cond_cum_reward / cond_cum_count
-                    cond_train_count = np.ceil((np.max(cond_avg_reward)*np.ones((self.env.n_exp_conds,)))/cond_avg_reward)
+        self._close_replay_sampler()
 
-            ### TRACKING ###
-            Statistics["rewards"].append(episode_reward)
-            Statistics["steps"].append(episode_steps)
-            Statistics["policy_loss"].append(np.mean(np.array(policy_loss_tracker)))
-            Statistics["critic_loss"].append(np.mean(np.array(critic1_loss_tracker)))
+    def _close_replay_sampler(self):
 
-            ### SAVE DATA TO FILE (in root project folder) ###
-            if len(self.statistics_folder) != 0:
-                np.save(self.statistics_folder + f'/stats_rewards.npy', Statistics['rewards'])
-                np.save(self.statistics_folder + f'/stats_steps.npy', Statistics['steps'])
-                np.save(self.statistics_folder + f'/stats_policy_loss.npy', Statistics['policy_loss'])
-                np.save(self.statistics_folder + f'/stats_critic_loss.npy', Statistics['critic_loss'])
+        #Stop the prefetching thread
+        if self.replay_sampler is not self.policy_memory:
+            self.replay_sampler.close()
 
+    def train_vectorized(self):
 
-            ### SAVING STATE DICT OF TRAINING ###
-            if len(self.checkpoint_folder) != 0 and len(self.checkpoint_file) != 0:
-                if episode % self.save_iter == 0 and len(self.policy_memory.buffer) > self.policy_batch_size:
-                    
-                    #Save the state dicts
-                    torch.save({
-                         'iteration': episode,
-                         'agent_state_dict': self.agent.actor.state_dict(),
-                         'critic_state_dict': self.agent.critic.state_dict(),
-                         'critic_target_state_dict': self.agent.critic_target.state_dict(),
-                         'agent_optimizer_state_dict': self.agent.actor_optim.state_dict(),
-                         'critic_optimizer_state_dict': self.agent.critic_optim.state_dict(),
-                     }, self.checkpoint_folder + f'/{self.checkpoint_file}.pth')
-
-                    #Save the pickled model for fixedpoint finder analysis
-                    torch.save(self.agent.actor.rnn, self.checkpoint_folder + f'/actor_rnn_fpf.pth')
+        """ Train the SAC agent on n_envs environments stepped in lockstep
+
+            A single batched actor forward pass selects the actions of all the environments,
+            finished environments are reset automatically to the next selected condition.
+            Every lockstep collects n_envs steps and runs n_envs*batch_iters updates, so the ratio of updates
+            to collected steps is kept at batch_iters as in the single environment training.
+        """
+
+        ### TRAINING DATA DICTIONARY ###
+        self._init_training_statistics()
+
+        cond_selector = ConditionSelector(self.env.n_exp_conds, self.condition_selection_strategy)
+        episodes_started = [0]
+
+        #Called by the vectorized environment whenever one of its environments is reset
+        def next_condition(i_env):
+            cond_to_select = cond_selector.next(episodes_started[0])
+            episodes_started[0] += 1
+            return cond_to_select
+
+        vec_env = VectorMuscleEnv(self.env_class, self.model_file, 1, self.args, self.n_envs, cond_selector= next_condition, n_workers= self.n_env_workers)
+
+        states = vec_env.reset()
+        h_prev = torch.zeros(size=(1, self.n_envs, self.hidden_size))
+
+        ep_trajectories = [[] for _ in range(self.n_envs)]
+        policy_loss_tracker = []
+        critic1_loss_tracker = []
+        episode = 0
+
+        ### BEGIN TRAINING ###
+        while episode < self.episodes:
+
+            ### SELECT ACTIONS ###
+            with torch.no_grad():
+                actions, h_current = self.agent.select_action_batch(states, h_prev, evaluate=False)
 
+            #Query the neural activity before stepping, finished environments are reset inside step
+            na_idxs = vec_env.coord_idx
+            neural_activities = list(vec_env.neural_activities)
+
+            ### UPDATE MODEL PARAMETERS ###
+            if len(self.policy_memory) > self.policy_batch_size:
+                for _ in range(self.n_envs*self.batch_iters):
+                    critic_1_loss, critic_2_loss, policy_loss = self.agent.update_parameters(self.replay_sampler, self.policy_batch_size)
+                    ### STORE LOSSES ###
+                    policy_loss_tracker.append(policy_loss)
+                    critic1_loss_tracker.append(critic_1_loss)
+
+            ### SIMULATION ###
+            next_states, rewards, dones, infos = vec_env.step(actions)
+
+            h_numpy = h_current.cpu().numpy()
+            for i_env in range(self.n_envs):
+
+                if dones[i_env]:
+                    next_state = infos[i_env]["terminal_observation"]
+                    mask = 1 if infos[i_env]["episode_steps"] == infos[i_env]["max_episode_steps"] else 0.0 # ensure mask is not 0 if episode ends
+                else:
+                    next_state = next_states[i_env]
+                    mask = 1.0
+
+                ep_trajectories[i_env].append((states[i_env],
+                                                actions[i_env],
+                                                rewards[i_env],
+                                                next_state,
+                                                mask,
+                                                h_numpy[:, i_env],
+                                                neural_activities[i_env],
+                                                np.array([na_idxs[i_env]])))
+
+                if dones[i_env]:
+
+                    ### PUSH TO REPLAY ###
+                    self.policy_memory.push(ep_trajectories[i_env])
+                    ep_trajectories[i_env] = []
+
+                    cond_selector.record(infos[i_env]["condition"], infos[i_env]["episode_reward"])
+
+                    self._end_episode(episode, infos[i_env]["episode_reward"], infos[i_env]["episode_steps"], policy_loss_tracker, critic1_loss_tracker,
+                                      infos[i_env].get("step_profile"))
+                    policy_loss_tracker = []
+                    critic1_loss_tracker = []
+                    episode += 1
+
+                    if episode == self.episodes:
+                        break
+
+            ### MOVE TO NEXT STATE ###
+            states = next_states
+            h_prev = h_current
+
+            #Start the recurrent state of the reset environments from zero
+            if dones.any():
+                h_prev = h_current * torch.FloatTensor(np.logical_not(dones)).to(h_current.device).view(1, -1, 1)
+
+        vec_env.close()
+
+    def train_actor_learner(self):
+
+        """ Train the SAC agent as the learner of n_rollout_workers rollout worker processes
+
+            The workers collect whole episodes with a CPU copy of the actor and write them to shared memory,
+            this process pushes them to the replay, updates the networks and periodically broadcasts the actor weights.
+            The ratio of updates to collected steps is kept at batch_iters as in the single environment training.
+        """
+
+        ### TRAINING DATA DICTIONARY ###
+        self._init_training_statistics()
+
+        cond_selector = ConditionSelector(self.env.n_exp_conds, self.condition_selection_strategy)
+
+        workers = RolloutWorkers(self.n_rollout_workers,
+                                 self.env_class,
+                                 self.model_file,
+                                 self.args,
+                                 self.observation_shape,
+                                 self.env.action_space.shape[0],
+                                 np.shape(self.env.na_to_sim[0][0]),
+                                 self.policy_memory if self.shared_replay else None)
+        workers.start(self.agent.actor)
+
+        #Keep two episodes requested per worker
+        episodes_requested = 0
+        for _ in range(2*self.n_rollout_workers):
+            workers.request_episode(cond_selector.next(episodes_requested))
+            episodes_requested += 1
+
+        policy_loss_tracker = []
+        critic1_loss_tracker = []
+        steps_collected = 0
+        n_updates = 0
+        episode = 0
+
+        ### BEGIN TRAINING ###
+        while episode < self.episodes:
+
+            can_update = len(self.policy_memory) > self.policy_batch_size and n_updates < steps_collected*self.batch_iters
+
+            ### RECEIVE FINISHED EPISODES ###
+            #Wait for the workers only if there is no update left to do
+            received = workers.get_episode(block= not can_update)
+            if received is not None:
+                worker_id, i_slot, n_transitions, episode_reward, episode_steps, cond_indx = received
+
+                ### PUSH TO REPLAY ###
+                #Episodes are already in a shared replay
+                if i_slot is not None:
+                    ep_arrays = [array.copy() for array in workers.slots[i_slot].arrays(n_transitions)]
+                    workers.release(worker_id, i_slot)
+                    self.policy_memory.push_columns(ep_arrays)
+
+                steps_collected += n_transitions
+
+                cond_selector.record(cond_indx, episode_reward)
+                workers.request_episode(cond_selector.next(episodes_requested))
+                episodes_requested += 1
+
+                self._end_episode(episode, episode_reward, episode_steps, policy_loss_tracker, critic1_loss_tracker)
+                policy_loss_tracker = []
+                critic1_loss_tracker = []
+                episode += 1
+                continue
+
+            ### UPDATE MODEL PARAMETERS ###
+            critic_1_loss, critic_2_loss, policy_loss = self.agent.update_parameters(self.replay_sampler, self.policy_batch_size)
+            policy_loss_tracker.append(policy_loss)
+            critic1_loss_tracker.append(critic_1_loss)
+            n_updates += 1
+
+            ### BROADCAST THE ACTOR WEIGHTS ###
+            if n_updates % self.weight_sync_iter == 0:
+                workers.broadcast(self.agent.actor)
+
+        workers.close()
+
+        if self.shared_replay:
+            self.policy_memory.close()
+
+    def _init_training_statistics(self):
+
+        ### TRAINING DATA DICTIONARY ###
+        self.statistics = {
+            "rewards": [],
+            "steps": [],
+            "policy_loss": [],
+            "critic_loss": [],
+            "step_profile": [],
+            "replay": []
+        }
+
+        self.highest_reward = -float("inf") # used for storing highest reward throughout training
+
+    def _end_episode(self, episode, episode_reward, episode_steps, policy_loss_tracker, critic1_loss_tracker, step_profile=None):
+
+        ### TRACKING ###
+        Statistics = self.statistics
+        Statistics["rewards"].append(episode_reward)
+        Statistics["steps"].append(episode_steps)
+        Statistics["policy_loss"].append(np.mean(np.array(policy_loss_tracker)))
+        Statistics["critic_loss"].append(np.mean(np.array(critic1_loss_tracker)))
+
+        #Per-phase timings of the environment steps in this episode
+        if step_profile is not None:
+            Statistics["step_profile"].append(step_profile)
+
+        #Replay occupancy, memory, and age and latency of the samples drawn during this episode
+        Statistics["replay"].append(self.policy_memory.statistics())
+        self.policy_memory.reset_statistics()
+
+        ### SAVE DATA TO FILE (in root project folder) ###
+        if len(self.statistics_folder) != 0:
+            np.save(self.statistics_folder + f'/stats_rewards.npy', Statistics['rewards'])
+            np.save(self.statistics_folder + f'/stats_steps.npy', Statistics['steps'])
+            np.save(self.statistics_folder + f'/stats_policy_loss.npy', Statistics['policy_loss'])
+            np.save(self.statistics_folder + f'/stats_critic_loss.npy', Statistics['critic_loss'])
+
+            if len(Statistics['step_profile']) != 0:
+                with open(self.statistics_folder + f'/stats_step_profile.pkl', 'wb') as f:
+                    pickle.dump(Statistics['step_profile'], f)
+
+            #The record of this episode is appended to the file of this run, read back with read_replay_statistics
+            with open(self.statistics_folder + f'/stats_replay.pkl', 'ab' if len(Statistics['replay']) > 1 else 'wb') as f:
+                pickle.dump(Statistics['replay'][-1], f)
+
+
+        ### SAVING STATE DICT OF TRAINING ###
+        if len(self.checkpoint_folder) != 0 and len(self.checkpoint_file) != 0:
+            if episode % self.save_iter == 0 and len(self.policy_memory) > self.policy_batch_size:
                 
-                if episode_reward > highest_reward:
-                    torch.save({
-                            'iteration': episode,
-                            'agent_state_dict': self.agent.actor.state_dict(),
-                            'critic_state_dict': self.agent.critic.state_dict(),
-                            'critic_target_state_dict': self.agent.critic_target.state_dict(),
-                            'agent_optimizer_state_dict': self.agent.actor_optim.state_dict(),
-                            'critic_optimizer_state_dict': self.agent.critic_optim.state_dict(),
-                        }, self.checkpoint_folder + f'/{self.checkpoint_file}_best.pth')
-
-                    #Save the pickled model for fixedpoint finder analysis
-                    torch.save(self.agent.actor.rnn, self.checkpoint_folder + f'/actor_rnn_best_fpf.pth')
-
-            if episode_reward > highest_reward:
-                highest_reward = episode_reward
-
-            ### PRINT TRAINING OUTPUT ###
-            if self.verbose_training:
-                print('-----------------------------------')
-                print('highest reward: {} | reward: {} | timesteps completed: {}'.format(highest_reward, episode_reward, episode_steps))
-                print('-----------------------------------\n')
+                #Save the state dicts
+                torch.save({
+                     'iteration': episode,
+                     'agent_state_dict': self.agent.actor.state_dict(),
+                     'critic_state_dict': self.agent.critic.state_dict(),
+                     'critic_target_state_dict': self.agent.critic_target.state_dict(),
+                     'agent_optimizer_state_dict': self.agent.actor_optim.state_dict(),
+                     'critic_optimizer_state_dict': self.agent.critic_optim.state_dict(),
+                 }, self.checkpoint_folder + f'/{self.checkpoint_file}.pth')
+
+                #Save the pickled model for fixedpoint finder analysis
+                torch.save(self.agent.actor.rnn, self.checkpoint_folder + f'/actor_rnn_fpf.pth')
+
+                #Add the episodes since the last checkpoint to the replay snapshot
+                if self.snapshot_replay:
+                    self.policy_memory.save_snapshot(self.replay_snapshot_folder)
+
+            
+            if episode_reward > self.highest_reward:
+                torch.save({
+                        'iteration': episode,
+                        'agent_state_dict': self.agent.actor.state_dict(),
+                        'critic_state_dict': self.agent.critic.state_dict(),
+                        'critic_target_state_dict': self.agent.critic_target.state_dict(),
+                        'agent_optimizer_state_dict': self.agent.actor_optim.state_dict(),
+                        'critic_optimizer_state_dict': self.agent.critic_optim.state_dict(),
+                    }, self.checkpoint_folder + f'/{self.checkpoint_file}_best.pth')
+
+                #Save the pickled model for fixedpoint finder analysis
+                torch.save(self.agent.actor.rnn, self.checkpoint_folder + f'/actor_rnn_best_fpf.pth')
+
+        if episode_reward > self.highest_reward:
+            self.highest_reward = episode_reward
+
+        ### PRINT TRAINING OUTPUT ###
+        if self.verbose_training:
+            print('-----------------------------------')
+            print('highest reward: {} | reward: {} | timesteps completed: {}'.format(self.highest_reward, episode_reward, episode_steps))
+            print('-----------------------------------\n')
 
     def load_saved_nets_from_checkpoint(self, load_best: bool):
 
@@ -474,16 +863,16 @@ class Simulate():
             self.agent.actor.load_state_dict(torch.load(self.checkpoint_folder + f'/{self.checkpoint_file}.pth')['agent_state_dict'])
 
             #Load the critic network
-            self.agent.critic.load_state_dict(torch.load(self.checkpoint_folder + f'/{self.checkpoint_file}.pth')['critic_state_dict'])
+            self.agent.critic.load_state_dict(twin_critic_state_dict(torch.load(self.checkpoint_folder + f'/{self.checkpoint_file}.pth')['critic_state_dict']))
 
             #Load the critic target network
-            self.agent.critic_target.load_state_dict(torch.load(self.checkpoint_folder + f'/{self.checkpoint_file}.pth')['critic_target_state_dict'])
+            self.agent.critic_target.load_state_dict(twin_critic_state_dict(torch.load(self.checkpoint_folder + f'/{self.checkpoint_file}.pth')['critic_target_state_dict']))
 
             #Load the policy optimizer 
             self.agent.actor_optim.load_state_dict(torch.load(self.checkpoint_folder + f'/{self.checkpoint_file}.pth')['agent_optimizer_state_dict'])
 
             #Load the critic optimizer
-            self.agent.critic_optim.load_state_dict(torch.load(self.checkpoint_folder + f'/{self.checkpoint_file}.pth')['critic_optimizer_state_dict'])
+            self.agent.critic_optim.load_state_dict(twin_critic_optimizer_state(torch.load(self.checkpoint_folder + f'/{self.checkpoint_file}.pth')['critic_optimizer_state_dict']))
 
         else:
 
@@ -491,13 +880,13 @@ class Simulate():
             self.agent.actor.load_state_dict(torch.load(self.checkpoint_folder + f'/{self.checkpoint_file}_best.pth')['agent_state_dict'])
 
             #Load the critic network
-            self.agent.critic.load_state_dict(torch.load(self.checkpoint_folder + f'/{self.checkpoint_file}_best.pth')['critic_state_dict'])
+            self.agent.critic.load_state_dict(twin_critic_state_dict(torch.load(self.checkpoint_folder + f'/{self.checkpoint_file}_best.pth')['critic_state_dict']))
 
             #Load the critic target network
-            self.agent.critic_target.load_state_dict(torch.load(self.checkpoint_folder + f'/{self.checkpoint_file}_best.pth')['critic_target_state_dict'])
+            self.agent.critic_target.load_state_dict(twin_critic_state_dict(torch.load(self.checkpoint_folder + f'/{self.checkpoint_file}_best.pth')['critic_target_state_dict']))
 
             #Load the policy optimizer 
             self.agent.actor_optim.load_state_dict(torch.load(self.checkpoint_folder + f'/{self.checkpoint_file}_best.pth')['agent_optimizer_state_dict'])
 
             #Load the critic optimizer
-            self.agent.critic_optim.load_state_dict(torch.load(self.checkpoint_folder + f'/{self.checkpoint_file}_best.pth')['critic_optimizer_state_dict'])
+            self.agent.critic_optim.load_state_dict(twin_critic_optimizer_state(torch.load(self.checkpoint_folder + f'/{self.checkpoint_file}_best.pth')['critic_optimizer_state_dict']))
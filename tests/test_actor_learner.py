@@ -0,0 +1,44 @@
+#RolloutWorkers.get_episode surfaces the failure of a rollout worker process instead of blocking forever
+
+import os
+import types
+import pytest
+
+from SAC.actor_learner import RolloutWorkers
+
+class FailingEnv():
+
+    #Raises while the worker builds its environment
+    def __init__(self, model_path, frame_skip, args):
+        raise ValueError("musculo_targets.xml not found")
+
+class ExitingEnv():
+
+    #Kills the worker process without any report
+    def __init__(self, model_path, frame_skip, args):
+        os._exit(3)
+
+def make_workers(env_class):
+
+    args = types.SimpleNamespace(hidden_size=8, timestep_limit=10, model="rnn", seed=0)
+    return RolloutWorkers(1, env_class, "", args, 4, 2, (3,))
+
+def test_get_episode_raises_the_worker_traceback():
+
+    workers = make_workers(FailingEnv)
+    workers.start(workers.shared_actor)
+
+    with pytest.raises(RuntimeError, match="musculo_targets.xml not found"):
+        workers.get_episode(block=True, poll_timeout=0.1)
+
+    workers.close()
+
+def test_get_episode_raises_if_a_worker_exits():
+
+    workers = make_workers(ExitingEnv)
+    workers.start(workers.shared_actor)
+
+    with pytest.raises(RuntimeError, match="exited with code 3"):
+        workers.get_episode(block=True, poll_timeout=0.1)
+
+    workers.close()
@@ -0,0 +1,104 @@
+#Critic checkpoints of the former twin critic (two nn.Linear Q-networks) are converted to the ensemble critic
+#with twin_critic_state_dict and twin_critic_optimizer_state
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import pytest
+
+from SAC.model import Critic, weights_init_, twin_critic_state_dict, twin_critic_optimizer_state
+
+class TwinCritic(nn.Module):
+
+    #The critic before the ensemble, as saved in the older checkpoints
+    def __init__(self, num_inputs, num_actions, hidden_dim):
+        super(TwinCritic, self).__init__()
+
+        self.linear1 = nn.Linear(num_inputs + num_actions, hidden_dim)
+        self.linear2 = nn.Linear(hidden_dim, hidden_dim)
+        self.linear3 = nn.Linear(hidden_dim, 1)
+
+        self.linear4 = nn.Linear(num_inputs + num_actions, hidden_dim)
+        self.linear5 = nn.Linear(hidden_dim, hidden_dim)
+        self.linear6 = nn.Linear(hidden_dim, 1)
+
+        self.apply(weights_init_)
+
+    def forward(self, state, action):
+
+        xu = torch.cat([state, action], 1)
+
+        x1 = self.linear3(F.relu(self.linear2(F.relu(self.linear1(xu)))))
+        x2 = self.linear6(F.relu(self.linear5(F.relu(self.linear4(xu)))))
+
+        return x1, x2
+
+def critic_loss(q_values, target):
+    return sum(F.mse_loss(q, target) for q in q_values)
+
+def make_batch(seed):
+
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(16, 6, generator=generator), torch.randn(16, 3, generator=generator), torch.randn(16, 1, generator=generator)
+
+def test_twin_checkpoint_loads_into_the_ensemble(tmp_path):
+
+    torch.manual_seed(0)
+    twin = TwinCritic(6, 3, 32)
+
+    #Saved and reloaded like the checkpoints of simulate.py
+    torch.save({'critic_state_dict': twin.state_dict()}, str(tmp_path / 'agent.pth'))
+    checkpoint = torch.load(str(tmp_path / 'agent.pth'))
+
+    critic = Critic(6, 3, 32)
+    critic.load_state_dict(twin_critic_state_dict(checkpoint['critic_state_dict']))
+
+    state, action, _ = make_batch(1)
+    q_values = critic(state, action)
+    assert q_values.shape == (2, 16, 1)
+    for q, twin_q in zip(q_values, twin(state, action)):
+        assert torch.allclose(q, twin_q, atol=1e-6)
+
+    #The checkpoint is left untouched and ensemble state dicts are passed through
+    assert 'linear1.weight' in checkpoint['critic_state_dict']
+    assert set(twin_critic_state_dict(critic.state_dict())) == set(critic.state_dict())
+
+def test_twin_checkpoint_does_not_load_into_more_heads():
+
+    with pytest.raises(RuntimeError, match="size mismatch"):
+        Critic(6, 3, 32, n_critics=3).load_state_dict(twin_critic_state_dict(TwinCritic(6, 3, 32).state_dict()))
+
+def test_twin_optimizer_state_resumes_the_adam_steps():
+
+    torch.manual_seed(0)
+    twin = TwinCritic(6, 3, 32)
+    twin_optim = torch.optim.Adam(twin.parameters(), lr=1e-3)
+    for seed in range(3):
+        state, action, target = make_batch(seed)
+        twin_optim.zero_grad()
+        critic_loss(twin(state, action), target).backward()
+        twin_optim.step()
+
+    critic = Critic(6, 3, 32)
+    critic_optim = torch.optim.Adam(critic.parameters(), lr=1e-3)
+    critic.load_state_dict(twin_critic_state_dict(twin.state_dict()))
+    twin_optim_state = twin_optim.state_dict()
+    critic_optim.load_state_dict(twin_critic_optimizer_state(twin_optim_state))
+
+    #The source optimizer state is not modified
+    assert all(len(twin_optim_state['state'][param]) == 3 for param in range(12))
+
+    #The same Adam steps on the converted critic track the twin critic
+    for seed in range(3, 8):
+        state, action, target = make_batch(seed)
+        for model, optimizer in [(twin, twin_optim), (critic, critic_optim)]:
+            optimizer.zero_grad()
+            critic_loss(model(state, action), target).backward()
+            optimizer.step()
+
+    state, action, _ = make_batch(100)
+    for q, twin_q in zip(critic(state, action), twin(state, action)):
+        assert torch.allclose(q, twin_q, atol=1e-5)
+
+    #Optimizer states of the ensemble critic are returned unchanged
+    assert twin_critic_optimizer_state(critic_optim.state_dict())['param_groups'][0]['params'] == list(range(6))
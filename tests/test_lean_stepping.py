@@ -0,0 +1,135 @@
+#Equivalence of the lean_stepping path of Muscle_Env.do_simulation/upd_theta with the default stepping
+#
+#  test_lean_stepping_physics_is_bit_identical: the stepping sequences of both paths (forward after every frame and
+#      after the target qpos write, against one forward after the last frame and mj_kinematics after the target write)
+#      on the bundled monkey model with the targets appended, run with the official mujoco bindings
+#  test_lean_stepping_is_bit_identical: Muscle_Env itself, requires mujoco_py, the musculo_targets.xml model
+#      (append_musculo_targets.py) and the initial pose (find_init_pose.py)
+
+import os
+from xml.etree import ElementTree as ET
+import numpy as np
+import pytest
+
+import config
+from SAC import kinematics_preprocessing_specs
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_PATH = os.path.join(REPO_DIR, 'musculoskeletal_model', 'musculoskeletal_model.xml')
+
+#mjData fields read by the observation, the reward and is_done (xpos is body_xpos in mujoco_py)
+OBSERVED_FIELDS = ["time", "qpos", "qvel", "act", "xpos", "actuator_length", "actuator_velocity", "qfrc_actuator"]
+
+def musculo_targets_xml():
+
+    #Same target bodies as append_musculo_targets.py, with the meshes resolved from the model folder
+    tree = ET.parse(MODEL_PATH)
+    root = tree.getroot()
+    root.find('compiler').set('meshdir', os.path.dirname(MODEL_PATH))
+
+    worldbody = root.find('worldbody')
+    for i_target, xyz_target in enumerate(kinematics_preprocessing_specs.xyz_target):
+        target = ET.SubElement(worldbody, 'body', name=f'target{i_target}', pos='0.1 0.1 0.85')
+        ET.SubElement(target, 'geom', size='0.01 0.01 0.01', type='sphere')
+        for axis, coord, enabled in zip(['1 0 0', '0 0 1', '0 1 0'], 'xyz', xyz_target):
+            if enabled:
+                ET.SubElement(target, 'joint', axis=axis, name=f'box:{coord}{i_target}', type='slide', limited='false')
+
+    return ET.tostring(root, encoding='unicode')
+
+def physics_rollout(mujoco, model, lean_stepping, seed, n_steps, n_frames):
+
+    #Muscle_Env.step: do_simulation, then upd_theta writes the target qpos
+    rng = np.random.RandomState(seed)
+    data = mujoco.MjData(model)
+    data.qpos[:] = model.qpos0 + 0.01 * rng.randn(model.nq)
+    data.qvel[:] = 0.01 * rng.randn(model.nv)
+    mujoco.mj_forward(model, data)
+
+    target_addrs = [model.jnt_qposadr[mujoco.mj_name2id(model, mujoco.mjtObj.mjOBJ_JOINT, name)]
+                    for name in ['box:x0', 'box:y0', 'box:z0'] if mujoco.mj_name2id(model, mujoco.mjtObj.mjOBJ_JOINT, name) >= 0]
+    target_pos = 0.1 + 0.05 * np.cumsum(rng.randn(n_steps, len(target_addrs)) * 0.1, axis=0)
+
+    trajectory = []
+    for t in range(n_steps):
+        data.ctrl[:] = rng.rand(model.nu)
+
+        if lean_stepping:
+            for _ in range(n_frames):
+                mujoco.mj_step(model, data)
+            mujoco.mj_forward(model, data)
+        else:
+            for _ in range(n_frames):
+                mujoco.mj_step(model, data)
+                mujoco.mj_forward(model, data)
+
+        data.qpos[target_addrs] = target_pos[t]
+        if lean_stepping:
+            mujoco.mj_kinematics(model, data)
+        else:
+            mujoco.mj_forward(model, data)
+
+        trajectory.append({name: np.copy(getattr(data, name)) for name in OBSERVED_FIELDS})
+
+    return trajectory
+
+@pytest.mark.parametrize("n_frames", [1, 3])
+def test_lean_stepping_physics_is_bit_identical(n_frames):
+
+    mujoco = pytest.importorskip("mujoco")
+    model = mujoco.MjModel.from_xml_string(musculo_targets_xml())
+
+    for seed in range(3):
+        trajectory = physics_rollout(mujoco, model, False, seed, 300, n_frames)
+        trajectory_lean = physics_rollout(mujoco, model, True, seed, 300, n_frames)
+
+        for t, (fields, fields_lean) in enumerate(zip(trajectory, trajectory_lean)):
+            for name in OBSERVED_FIELDS:
+                assert np.array_equal(fields[name], fields_lean[name]), (seed, t, name)
+
+def make_env(lean_stepping):
+
+    from SAC.RL_Framework_Mujoco import Muscle_Env
+
+    args = config.config_parser().parse_args(['--config', 'configs/configs.txt', '--lean_stepping', str(lean_stepping)])
+    model_file = args.musculoskeletal_model_path[:-len('musculoskeletal_model.xml')] + 'musculo_targets.xml'
+
+    if not os.path.isfile(model_file) or not os.path.isfile(args.initial_pose_path + '/initial_qpos_opt.npy'):
+        pytest.skip("musculo_targets.xml or the initial pose is missing, run append_musculo_targets.py and find_init_pose.py")
+
+    return Muscle_Env(model_file, 1, args)
+
+def rollout(env, cond, seed, n_steps):
+
+    #Episode from a perturbed initial state with uniform random muscle excitations
+    rng = np.random.RandomState(seed)
+    env.reset(cond)
+    qpos = env.init_qpos + 0.01 * rng.randn(env.model.nq)
+    qvel = 0.01 * rng.randn(env.model.nv)
+    env.set_state(qpos, qvel)
+
+    obs, rewards, dones = [], [], []
+    for _ in range(n_steps):
+        ob, reward, done, _ = env.step(rng.rand(env.action_space.shape[0]))
+        obs.append(np.array(ob))
+        rewards.append(reward)
+        dones.append(done)
+        if done:
+            break
+
+    return np.array(obs), np.array(rewards), np.array(dones)
+
+def test_lean_stepping_is_bit_identical(monkeypatch):
+
+    pytest.importorskip("mujoco_py")
+    monkeypatch.chdir(REPO_DIR)
+    env = make_env(False)
+    env_lean = make_env(True)
+
+    for episode, cond in enumerate(range(min(3, len(env.kin_to_sim)))):
+        obs, rewards, dones = rollout(env, cond, episode, 200)
+        obs_lean, rewards_lean, dones_lean = rollout(env_lean, cond, episode, 200)
+
+        assert np.array_equal(obs, obs_lean)
+        assert np.array_equal(rewards, rewards_lean)
+        assert np.array_equal(dones, dones_lean)
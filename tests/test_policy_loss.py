@@ -0,0 +1,46 @@
+#Closed form of the simple-dynamics regularizer _policy_loss_2 against the Jacobian-norm expression,
+#for SAC_Agent and for the copy in mouse_scripts (SACRNN, requires the mouse_scripts dependencies)
+
+import types
+import pytest
+import torch
+
+from SAC.sac import SAC_Agent
+
+def jacobian_norm_loss(rnn_out_r, J_rnn_w):
+
+    #||J_rnn_w * (1 - r_t^2)[:, None]||^2 summed over the timesteps, with the (timesteps, hidden, hidden) tensor
+    J_rnn_w = J_rnn_w.unsqueeze(0).repeat(rnn_out_r.size()[0], 1, 1)
+    R_j = torch.mul(J_rnn_w, (1 - torch.pow(rnn_out_r, 2)).unsqueeze(-1))
+    return torch.norm(R_j)**2
+
+def sac_agent_policy_loss_2(weight_hh, rnn_out_r):
+
+    #_policy_loss_2 only uses the recurrent weights of the actor
+    agent = types.SimpleNamespace(actor=types.SimpleNamespace(rnn=types.SimpleNamespace(weight_hh_l0=weight_hh)))
+    return SAC_Agent._policy_loss_2(agent, rnn_out_r)
+
+def mouse_sacrnn_policy_loss_2(weight_hh, rnn_out_r):
+
+    pytest.importorskip("colorednoise")
+    from mouse_scripts.SAC.sac import SACRNN
+
+    agent = types.SimpleNamespace(policy=types.SimpleNamespace(lstm=types.SimpleNamespace(weight_hh_l0=weight_hh)))
+    return SACRNN._policy_loss_2(agent, rnn_out_r)
+
+@pytest.mark.parametrize("policy_loss_2", [sac_agent_policy_loss_2, mouse_sacrnn_policy_loss_2])
+@pytest.mark.parametrize("n_timesteps, hidden_size", [(1, 3), (17, 5), (300, 64)])
+def test_policy_loss_2_matches_jacobian_norm(policy_loss_2, n_timesteps, hidden_size):
+
+    generator = torch.Generator().manual_seed(n_timesteps)
+    weight_hh = torch.randn(hidden_size, hidden_size, dtype=torch.float64, generator=generator, requires_grad=True)
+    rnn_out_r = torch.tanh(torch.randn(n_timesteps, hidden_size, dtype=torch.float64, generator=generator)).requires_grad_()
+
+    loss = policy_loss_2(weight_hh, rnn_out_r)
+    expected = jacobian_norm_loss(rnn_out_r, weight_hh)
+    assert torch.allclose(loss, expected)
+
+    grads = torch.autograd.grad(loss, (weight_hh, rnn_out_r))
+    expected_grads = torch.autograd.grad(expected, (weight_hh, rnn_out_r))
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert torch.allclose(grad, expected_grad)
@@ -0,0 +1,157 @@
+#SumTree and PrioritizedPolicyReplayMemory: tree invariants, prefix-sum search, sampling proportional to priority,
+#importance-sampling weights and the zero-priority leaves of empty and evicted slots
+
+import numpy as np
+import pytest
+
+from SAC.replay_memory import SumTree, PrioritizedPolicyReplayMemory
+
+def make_episode(ep_id, n):
+    return [(np.full(5, ep_id, np.float32), np.zeros(3), float(ep_id), np.zeros(5), 1.0, np.zeros((1, 4)), np.zeros(7), np.array([t]))
+            for t in range(n)]
+
+def check_tree(tree):
+
+    #Every internal node is the sum of its children
+    for node in range(1, tree.n_leaves):
+        assert np.isclose(tree.tree[node], tree.tree[2*node] + tree.tree[2*node + 1], rtol=1e-9, atol=1e-12)
+
+@pytest.mark.parametrize("n_leaves", [1, 5, 8, 100])
+def test_sum_tree_invariants(n_leaves):
+
+    rng = np.random.RandomState(n_leaves)
+    tree = SumTree(n_leaves)
+    assert tree.n_leaves >= n_leaves and tree.n_leaves & (tree.n_leaves - 1) == 0
+
+    priorities = np.zeros(tree.n_leaves)
+    for i_update in range(5 * tree.n_leaves + 3):
+        leaf = rng.randint(n_leaves)
+        priorities[leaf] = rng.uniform() * 10 ** rng.uniform(-3, 3) if rng.uniform() < 0.8 else 0
+        tree.update(leaf, priorities[leaf])
+
+        #The internal nodes are recomputed from the leaves every n_leaves updates
+        assert tree.n_updates < tree.n_leaves
+        assert np.array_equal(tree.get(np.arange(tree.n_leaves)), priorities)
+        assert np.isclose(tree.total, priorities.sum())
+        check_tree(tree)
+
+def test_sum_tree_find():
+
+    tree = SumTree(5)
+    for leaf, priority in enumerate([1, 0, 3, 0, 6]):
+        tree.update(leaf, priority)
+
+    assert tree.total == 10
+    assert tree.find(np.array([1e-9, 0.5, 1, 1.01, 4, 4.5, 10])).tolist() == [0, 0, 0, 2, 2, 4, 4]
+
+    #Against the prefix sums of the leaves
+    rng = np.random.RandomState(0)
+    tree = SumTree(37)
+    for leaf in range(37):
+        tree.update(leaf, rng.uniform() if leaf % 3 else 0)
+    values = rng.uniform(size=1000) * tree.total
+    expected = np.searchsorted(np.cumsum(tree.get(np.arange(37))), values)
+    assert np.array_equal(tree.find(values), expected)
+
+def test_sum_tree_find_skips_zero_leaves_after_drift():
+
+    #Rounding drift of the internal nodes can leave a value past the sum of the live leaves,
+    #the search must still end in a leaf of nonzero priority
+    rng = np.random.RandomState(1)
+    for _ in range(200):
+        tree = SumTree(8)
+        for _ in range(rng.randint(1, 8)):
+            for leaf in range(8):
+                tree.update(leaf, rng.uniform() * 10 ** rng.uniform(-3, 6))
+        for leaf in range(1, 8):
+            tree.update(leaf, 0)
+        tree.update(0, 1e-3)
+
+        leaves = tree.find(np.array([tree.total, tree.total * (1 - 1e-12), tree.total * 0.999999, tree.total * 2]))
+        assert (leaves == 0).all()
+
+def test_sampling_is_proportional_to_priority():
+
+    memory = PrioritizedPolicyReplayMemory(8, 0, alpha=0.6)
+    for ep_id in range(8):
+        memory.push(make_episode(ep_id, 5))
+
+    positions = memory._positions()
+    td_errors = np.array([0.1, 0.5, 1, 2, 4, 0.1, 8, 0.3])
+    memory.update_priorities((positions, memory.ep_id[positions]), td_errors)
+
+    expected = (td_errors + memory.epsilon)**0.6
+    expected /= expected.sum()
+
+    rng = np.random.RandomState(0)
+    counts = np.zeros(8)
+    n_batches, batch_size = 4000, 4
+    for _ in range(n_batches):
+        sampled, _ = memory._sample_episodes(batch_size, rng)
+        counts += np.bincount(sampled, minlength=8)
+
+    #Stratified sampling has a lower variance than independent draws, the binomial bound is conservative
+    frequencies = counts / (n_batches * batch_size)
+    assert np.all(np.abs(frequencies - expected) < 4 * np.sqrt(expected * (1 - expected) / (n_batches * batch_size)))
+
+def test_importance_sampling_weights():
+
+    memory = PrioritizedPolicyReplayMemory(16, 0, beta=0.4)
+    for ep_id in range(10):
+        memory.push(make_episode(ep_id, ep_id + 1))
+
+    positions = memory._positions()
+    memory.update_priorities((positions, memory.ep_id[positions]), np.linspace(0.01, 3, 10))
+
+    rng = np.random.RandomState(0)
+    for _ in range(50):
+        sampled, weights = memory._sample_episodes(6, rng)
+
+        #(N*P(i))**-beta normalized by the maximum in the batch
+        probabilities = memory.sum_tree.get(sampled) / memory.sum_tree.total
+        expected = (len(memory) * probabilities) ** -0.4
+        assert np.allclose(weights, expected / expected.max())
+        assert weights.max() == 1 and (weights > 0).all()
+
+    #The batch carries the weight of each transition, in the order of the sampled sequences
+    batch = memory.sample(6)
+    lengths, weights, (sampled, ep_ids) = batch[7][0], batch[10], batch[11]
+    assert np.array_equal(memory.ep_id[sampled], ep_ids)
+    assert len(weights) == lengths.sum() == len(batch[0])
+    assert np.isclose(weights.max(), 1)
+
+def test_evicted_episodes_are_never_sampled():
+
+    rng = np.random.RandomState(0)
+    memory = PrioritizedPolicyReplayMemory(20, 0, transition_capacity=300)
+    for ep_id in range(300):
+        memory.push(make_episode(ep_id, rng.randint(1, 40)))
+
+        positions = memory._positions()
+        assert np.isclose(memory.sum_tree.total, memory.sum_tree.get(positions).sum())
+
+        #Only the stored episodes have a nonzero priority
+        live = np.zeros(memory.sum_tree.n_leaves, dtype=bool)
+        live[positions] = True
+        assert (memory.sum_tree.get(np.flatnonzero(~live)) == 0).all()
+
+        if len(memory) >= 2:
+            _, _, _, _, _, _, _, _, _, _, weights, (sampled, ep_ids), _ = memory.sample(8)
+            assert np.isin(sampled, positions).all()
+            assert np.array_equal(memory.ep_id[sampled], ep_ids)
+            memory.update_priorities((sampled, ep_ids), rng.uniform(size=len(sampled)) * 10)
+
+def test_stale_priority_updates_are_ignored():
+
+    memory = PrioritizedPolicyReplayMemory(4, 0)
+    for ep_id in range(4):
+        memory.push(make_episode(ep_id, 3))
+    sampled = memory._positions()[:1]
+    ep_ids = memory.ep_id[sampled]
+
+    #The sampled episode is evicted and its slot reused before the update
+    memory.push(make_episode(4, 3))
+    tree = memory.sum_tree.tree.copy()
+    memory.update_priorities((sampled, ep_ids), [100.])
+
+    assert np.array_equal(memory.sum_tree.tree, tree)
@@ -0,0 +1,142 @@
+#PolicyReplayMemory storage: contiguous per-field arrays, FIFO eviction, growth, the schema checks on push and the staleness statistics
+
+import pickle
+import numpy as np
+import pytest
+
+from SAC.replay_memory import PolicyReplayMemory, TRANSITION_FIELDS, read_replay_statistics
+from SAC.actor_learner import EpisodeSlot, transition_fields
+
+def make_episode(ep_id, n):
+
+    #Transition t of episode ep_id is recognizable from its state and na_idx
+    return [(np.full(5, ep_id + t / 1000., np.float64), np.full(3, ep_id, np.float32), float(ep_id), np.full(5, -ep_id), 1.0,
+             np.full((1, 4), ep_id, np.float32), np.full(7, t, np.float64), np.array([t])) for t in range(n)]
+
+def check_contents(memory, expected):
+
+    #expected: [(ep_id, n)] of the stored episodes, oldest first
+    positions = memory._positions()
+    assert [(int(memory.ep_id[p]), int(memory.ep_len[p])) for p in positions] == expected
+    assert memory.n_transitions == sum(n for _, n in expected)
+
+    for position in positions:
+        start, n, ep_id = memory.ep_start[position], memory.ep_len[position], memory.ep_id[position]
+        assert np.allclose(memory.storage["state"][start:start + n, 0], ep_id + np.arange(n) / 1000.)
+        assert np.array_equal(memory.storage["na_idx"][start:start + n, 0], np.arange(n))
+
+def test_push_and_sample_round_trip():
+
+    memory = PolicyReplayMemory(10, 0)
+    episodes = [make_episode(ep_id, n) for ep_id, n in enumerate([4, 1, 7])]
+    for episode in episodes:
+        memory.push(episode)
+
+    assert {name: memory.storage[name].dtype for name in TRANSITION_FIELDS} == {
+        **{name: np.dtype(np.float32) for name in TRANSITION_FIELDS}, "na_idx": np.dtype(np.int64)}
+    check_contents(memory, [(0, 4), (1, 1), (2, 7)])
+
+    #Sampling all the episodes returns every transition, the sequences are ordered by decreasing length
+    state, action, reward, next_state, mask, h_current, policy_state_batch, (lengths, _, _), neural_activity, na_idx, weights, _, _ = memory.sample(3)
+    assert lengths.tolist() == [7, 4, 1]
+    expected = [transition for i_episode in [2, 0, 1] for transition in episodes[i_episode]]
+    for i_field, column in enumerate([state, action, reward, next_state, mask, h_current, neural_activity, na_idx]):
+        assert np.allclose(column, np.array([transition[i_field] for transition in expected], dtype=np.float32))
+    assert np.array_equal(policy_state_batch[0], state[:7])
+    assert weights is None
+
+@pytest.mark.parametrize("capacity, transition_capacity", [(3, None), (10, 300), (50, 500)])
+def test_eviction_keeps_the_newest_episodes(capacity, transition_capacity):
+
+    rng = np.random.RandomState(capacity)
+    memory = PolicyReplayMemory(capacity, 0, transition_capacity=transition_capacity)
+
+    stored = []
+    for ep_id in range(200):
+        n = rng.randint(1, 80)
+        memory.push(make_episode(ep_id, n))
+        stored = (stored + [(ep_id, n)])[-capacity:]
+
+        #Episodes are evicted oldest first, by count and by the rows needed for the new episode
+        positions = memory._positions()
+        check_contents(memory, stored[len(stored) - len(positions):])
+        if transition_capacity:
+            assert memory.n_rows == transition_capacity
+            assert memory.n_transitions <= transition_capacity
+        else:
+            assert len(memory) == len(stored)
+
+def test_storage_grows_without_transition_capacity():
+
+    memory = PolicyReplayMemory(100, 0)
+    memory.push(make_episode(0, 10))
+    n_rows = memory.n_rows
+
+    #Longer episodes than the rows allocated for the first one grow the arrays without losing episodes
+    stored = [(0, 10)]
+    for ep_id, n in enumerate([600, 900, 2500], start=1):
+        memory.push(make_episode(ep_id, n))
+        stored.append((ep_id, n))
+        check_contents(memory, stored)
+
+    assert memory.n_rows > n_rows
+    assert memory.n_rows >= memory.n_transitions
+
+def test_episode_longer_than_transition_capacity_is_rejected():
+
+    memory = PolicyReplayMemory(10, 0, transition_capacity=50)
+    with pytest.raises(ValueError, match="does not fit"):
+        memory.push(make_episode(0, 51))
+
+@pytest.mark.parametrize("i_field, value, message", [(0, np.zeros(6), "state pushed with shape"),
+                                                      (5, np.zeros((2, 4)), "h_current pushed with shape"),
+                                                      (7, np.array([0.5]), "na_idx pushed with dtype float64")])
+def test_push_checks_the_schema(i_field, value, message):
+
+    memory = PolicyReplayMemory(10, 0)
+    memory.push(make_episode(0, 3))
+
+    episode = [tuple(value if i == i_field else field for i, field in enumerate(transition)) for transition in make_episode(1, 3)]
+    with pytest.raises(ValueError, match=message):
+        memory.push(episode)
+
+    #The rejected episode is not stored
+    check_contents(memory, [(0, 3)])
+
+def test_episode_slot_na_idx_matches_the_replay_dtype():
+
+    #Episodes written by the rollout workers store na_idx as int64 like the single process training
+    slot = EpisodeSlot(transition_fields(5, 3, 4, (7,)), 10)
+    for array, value in zip(slot.arrays(), make_episode(0, 1)[0]):
+        array[:3] = value
+
+    memory = PolicyReplayMemory(10, 0)
+    memory.push_columns(slot.arrays(3))
+    memory.push(make_episode(1, 2))
+
+    assert memory.storage["na_idx"].dtype == np.int64
+
+def test_staleness_counts_the_updates(tmp_path):
+
+    memory = PolicyReplayMemory(10, 0)
+    for ep_id in range(3):
+        memory.push(make_episode(ep_id, 4))
+        for _ in range(ep_id + 1):
+            memory.count_update()
+
+    #Episodes 0, 1 and 2 were pushed after 0, 1 and 3 updates, 6 updates were counted
+    memory.sample(3)
+    stats = memory.statistics()
+    assert sorted(memory.sampled_staleness[0].tolist()) == [3, 5, 6]
+    assert stats["staleness"]["max"] == 6 and stats["staleness_histogram"].tolist() == [0, 0, 3]
+
+    #The per-episode records appended to a file are read back in order
+    file_name = str(tmp_path / "stats_replay.pkl")
+    records = []
+    for i_episode in range(3):
+        records.append(memory.statistics())
+        memory.reset_statistics()
+        with open(file_name, 'ab' if i_episode > 0 else 'wb') as f:
+            pickle.dump(records[-1], f)
+
+    assert [record["samples"] for record in read_replay_statistics(file_name)] == [1, 0, 0]
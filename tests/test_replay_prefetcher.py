@@ -0,0 +1,90 @@
+#ReplayPrefetcher: the batches only depend on the seed and the replay contents, not on the thread timing,
+#and close() stops and joins the sampling thread
+
+import numpy as np
+import torch
+
+from SAC.replay_memory import PolicyReplayMemory
+from SAC.replay_prefetcher import ReplayPrefetcher, batch_to_tensors
+
+def make_columns(ep_id, n):
+
+    rng = np.random.RandomState(ep_id)
+    return [rng.randn(n, 5).astype(np.float32), rng.randn(n, 3), rng.randn(n), rng.randn(n, 5), np.ones(n),
+            rng.rand(n, 1, 4), rng.randn(n, 7), np.arange(n)[:, None]]
+
+def make_replay(n_episodes):
+
+    memory = PolicyReplayMemory(50, 0)
+    for ep_id in range(n_episodes):
+        memory.push_columns(make_columns(ep_id, 5 + ep_id % 30))
+
+    return memory
+
+def flatten(batch):
+
+    #The tensors and arrays of a batch in order, the nested layout tuples are expanded
+    if isinstance(batch, (tuple, list)):
+        return [item for element in batch for item in flatten(element)]
+
+    return [batch]
+
+def assert_same_batch(batch, other):
+
+    batch, other = flatten(batch), flatten(other)
+    assert len(batch) == len(other)
+    for item, other_item in zip(batch, other):
+        if isinstance(item, torch.Tensor):
+            assert torch.equal(item, other_item)
+        elif isinstance(item, np.ndarray):
+            assert np.array_equal(item, other_item)
+        else:
+            assert item == other_item
+
+def test_same_seed_gives_the_same_batches():
+
+    #Different queue lengths change the thread timing and the number of batches dropped when the replay changes
+    memories = [make_replay(10), make_replay(10)]
+    prefetchers = [ReplayPrefetcher(memories[0], 4, "cpu", 1, 7), ReplayPrefetcher(memories[1], 4, "cpu", 6, 7)]
+
+    ep_id = 10
+    for i_update in range(40):
+        batches = [prefetcher.sample_tensors(4, "cpu") for prefetcher in prefetchers]
+        assert_same_batch(*batches)
+
+        #Batch k is sampled with RandomState([seed, k]) from the replay as it is when the batch is requested
+        assert_same_batch(batches[0], batch_to_tensors(memories[0].sample(4, rng=np.random.RandomState([7, i_update])), "cpu"))
+
+        if i_update % 7 == 3:
+            for memory in memories:
+                memory.push_columns(make_columns(ep_id, 12))
+            ep_id += 1
+
+    for prefetcher in prefetchers:
+        prefetcher.close()
+
+def test_close_joins_the_thread():
+
+    prefetcher = ReplayPrefetcher(make_replay(10), 4, "cpu", 3, 0)
+    prefetcher.sample_tensors(4, "cpu")
+    thread = prefetcher.thread
+    assert thread.is_alive()
+
+    #The thread is waiting for room in the full queue when it is closed
+    with prefetcher.cond:
+        prefetcher.cond.wait_for(lambda: len(prefetcher.ready) == 3)
+    prefetcher.close()
+    assert not thread.is_alive()
+    assert prefetcher.thread is None and len(prefetcher.ready) == 0
+
+    #Or sampling a batch, which is dropped
+    prefetcher = ReplayPrefetcher(make_replay(10), 4, "cpu", 3, 0)
+    prefetcher.sample_tensors(4, "cpu")
+    thread = prefetcher.thread
+    prefetcher.close()
+    assert not thread.is_alive()
+    assert prefetcher.thread is None and len(prefetcher.ready) == 0
+
+    #Closing twice or without a thread is a no-op
+    prefetcher.close()
+    ReplayPrefetcher(make_replay(2), 4, "cpu", 3, 0).close()
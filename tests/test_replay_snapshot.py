@@ -0,0 +1,141 @@
+#Replay snapshots: save_snapshot/load_snapshot round trip for each storage and codec, the slicing to the last
+#capacity episodes on load and snapshots taken while another thread pushes
+
+import os
+import threading
+import numpy as np
+import pytest
+
+from SAC.replay_memory import PolicyReplayMemory, PrioritizedPolicyReplayMemory, MemmapPolicyReplayMemory, TRANSITION_FIELDS
+
+def make_columns(ep_id, n):
+
+    #Transition t of episode ep_id is recognizable from its state and na_idx
+    rng = np.random.RandomState(ep_id)
+    return [(ep_id + np.arange(n)[:, None] / 1000. + np.zeros((n, 5))).astype(np.float32), rng.randn(n, 3), rng.randn(n), rng.randn(n, 5),
+            np.ones(n), rng.rand(n, 1, 4), rng.randn(n, 7), np.arange(n)[:, None]]
+
+def contents(memory):
+
+    #[(ep_id, {field: decoded rows})] of the stored episodes, oldest first
+    episodes = []
+    for position in memory._positions():
+        start, n = memory.ep_start[position], memory.ep_len[position]
+        rows, row_positions = np.arange(start, start + n), np.full(n, position)
+        episodes.append((int(memory.ep_id[position]), {name: memory._decode(name, rows, row_positions) for name in TRANSITION_FIELDS}))
+
+    return episodes
+
+def check_same_contents(memory, restored):
+
+    expected, actual = contents(memory), contents(restored)
+    assert [ep_id for ep_id, _ in actual] == [ep_id for ep_id, _ in expected]
+    for (_, fields), (_, restored_fields) in zip(expected, actual):
+        for name in TRANSITION_FIELDS:
+            assert np.array_equal(fields[name], restored_fields[name])
+
+def make_memory(kind, tmp_path, name, capacity=10):
+
+    if kind == "memmap":
+        return MemmapPolicyReplayMemory(capacity, 0, 400, str(tmp_path / name))
+    if kind == "prioritized":
+        return PrioritizedPolicyReplayMemory(capacity, 0, transition_capacity=400, codecs={"h_current": "uint8"})
+    if kind == "codecs":
+        return PolicyReplayMemory(capacity, 0, codecs={"state": "float16", "h_current": "uint8", "action": "bfloat16"})
+
+    return PolicyReplayMemory(capacity, 0, transition_capacity=400)
+
+@pytest.mark.parametrize("kind", ["plain", "codecs", "prioritized", "memmap"])
+def test_snapshot_round_trip(kind, tmp_path):
+
+    snapshot_dir = str(tmp_path / "snapshot")
+    rng = np.random.RandomState(0)
+    memory = make_memory(kind, tmp_path, "replay")
+
+    #Incremental snapshots while episodes are pushed and evicted
+    ep_id = 0
+    for _ in range(12):
+        for _ in range(rng.randint(0, 6)):
+            memory.push_columns(make_columns(ep_id, rng.randint(5, 60)))
+            ep_id += 1
+        memory.save_snapshot(snapshot_dir)
+
+    restored = make_memory(kind, tmp_path, "restored")
+    assert restored.load_snapshot(snapshot_dir) == len(memory)
+    check_same_contents(memory, restored)
+
+    #The restored replay only writes its new episodes to the next snapshot
+    restored.push_columns(make_columns(ep_id, 20))
+    restored.save_snapshot(snapshot_dir)
+    restored_again = make_memory(kind, tmp_path, "restored_again")
+    restored_again.load_snapshot(snapshot_dir)
+    check_same_contents(restored, restored_again)
+
+    if kind == "prioritized":
+        positions = restored_again._positions()
+        assert restored_again.sum_tree.total > 0
+        assert np.isclose(restored_again.sum_tree.total, restored_again.sum_tree.get(positions).sum())
+
+def test_load_snapshot_with_different_codecs_is_rejected(tmp_path):
+
+    memory = make_memory("codecs", tmp_path, "replay")
+    memory.push_columns(make_columns(0, 10))
+    memory.save_snapshot(str(tmp_path))
+
+    with pytest.raises(ValueError, match="different codecs"):
+        PolicyReplayMemory(10, 0).load_snapshot(str(tmp_path))
+
+def test_load_snapshot_copies_only_the_last_capacity_episodes(tmp_path):
+
+    memory = PolicyReplayMemory(20, 0)
+    for ep_id in range(20):
+        memory.push_columns(make_columns(ep_id, 10))
+        if ep_id % 4 == 3:
+            memory.save_snapshot(str(tmp_path))
+
+    #The chunks of the episodes that would be evicted right away are not read
+    os.remove(str(tmp_path / "chunk_00000003" / "state.npy"))
+
+    restored = PolicyReplayMemory(5, 0)
+    assert restored.load_snapshot(str(tmp_path)) == 5
+    assert [ep_id for ep_id, _ in contents(restored)] == list(range(15, 20))
+    assert restored.snapshot_last_id == 19
+    assert restored.n_transitions == 50
+
+    #Episodes already in the replay are not restored again
+    assert restored.load_snapshot(str(tmp_path)) == 0
+    assert len(restored) == 5
+
+def test_snapshot_during_concurrent_pushes(tmp_path):
+
+    memory = PolicyReplayMemory(50, 0, transition_capacity=2000)
+    memory.push_columns(make_columns(0, 10))
+
+    #A thread pushes episodes while the snapshots are taken, like a ReplayPrefetcher or the rollout workers
+    stop = threading.Event()
+    def push_episodes():
+        ep_id = 1
+        while not stop.is_set():
+            memory.push_columns(make_columns(ep_id, 1 + ep_id % 40))
+            ep_id += 1
+
+    thread = threading.Thread(target=push_episodes)
+    thread.start()
+    try:
+        for _ in range(20):
+            memory.save_snapshot(str(tmp_path))
+    finally:
+        stop.set()
+        thread.join()
+
+    restored = PolicyReplayMemory(50, 0, transition_capacity=2000)
+    restored.load_snapshot(str(tmp_path))
+
+    #Every restored episode is whole and the episode ids follow each other
+    ep_ids = [ep_id for ep_id, _ in contents(restored)]
+    assert ep_ids == list(range(ep_ids[0], ep_ids[0] + len(ep_ids)))
+    assert ep_ids[-1] == restored.snapshot_last_id
+    for ep_id, fields in contents(restored):
+        n = 10 if ep_id == 0 else 1 + ep_id % 40
+        assert np.allclose(fields["state"][:, 0], ep_id + np.arange(n) / 1000.)
+        assert np.array_equal(fields["na_idx"][:, 0], np.arange(n))
@@ -0,0 +1,84 @@
+#SharedPolicyReplayMemory: spawned writer processes push into the shared segments while the learner samples,
+#and the segments are freed once the replay is closed
+
+import multiprocessing as mp
+import os
+import numpy as np
+import pytest
+
+from SAC.replay_memory import SharedPolicyReplayMemory
+
+FIELDS = [("state", (5,)), ("action", (3,)), ("reward", ()), ("next_state", (5,)), ("mask", ()),
+          ("h_current", (1, 4)), ("neural_activity", (7,)), ("na_idx", (1,))]
+
+N_WRITERS = 4
+N_EPISODES = 50
+
+def push_episodes(replay, i_writer):
+
+    #The episodes of a writer are tagged with i_writer * 100 + episode number in their state, reward and h_current (exact in float16)
+    rng = np.random.RandomState(i_writer)
+    for i_episode in range(N_EPISODES):
+        n = rng.randint(5, 60)
+        tag = i_writer * 100 + i_episode
+        replay.push_columns([np.full((n, 5), tag, np.float32), np.zeros((n, 3)), np.full(n, tag, np.float32), np.zeros((n, 5)),
+                             np.ones(n), np.full((n, 1, 4), tag, np.float32), np.zeros((n, 7)), np.arange(n)[:, None]])
+
+def check_batch(batch):
+
+    #Every sampled sequence belongs to a single episode
+    state, reward, h_current, lengths, na_idx = batch[0], batch[2], batch[5], batch[7][0], batch[9]
+    offset = 0
+    for n in lengths:
+        tag = state[offset, 0]
+        assert (state[offset:offset + n] == tag).all() and (reward[offset:offset + n] == tag).all()
+        assert (h_current[offset:offset + n] == tag).all()
+        assert np.array_equal(na_idx[offset:offset + n, 0], np.arange(n))
+        offset += n
+
+def test_spawned_writers():
+
+    ctx = mp.get_context("spawn")
+    replay = SharedPolicyReplayMemory(50, 0, 2000, FIELDS, codecs={"h_current": "float16"}, ctx=ctx)
+    segment_names = [segment.name for segment, _, _ in replay._segments.values()]
+
+    writers = [ctx.Process(target=push_episodes, args=(replay, i_writer)) for i_writer in range(N_WRITERS)]
+    for writer in writers:
+        writer.start()
+
+    while any(writer.is_alive() for writer in writers):
+        if len(replay) >= 8:
+            check_batch(replay.sample(8))
+    for writer in writers:
+        writer.join()
+        assert writer.exitcode == 0
+
+    #All the pushed episodes got an id and the index matches the stored rows
+    positions = replay._positions()
+    assert replay.cursor[3] == N_WRITERS * N_EPISODES
+    assert len(replay) == 50 and replay.n_transitions == replay.ep_len[positions].sum()
+    assert len(np.unique(replay.ep_id[positions])) == 50
+
+    tags = set()
+    for position in positions:
+        start, n = replay.ep_start[position], replay.ep_len[position]
+        rows = np.arange(start, start + n)
+        tag = replay.storage["state"][start, 0]
+        assert (replay.storage["state"][rows] == tag).all() and (replay.storage["h_current"][rows] == tag).all()
+        tags.add(tag)
+
+    #Each writer pushes its episodes in order, the replay keeps the newest ones
+    assert len(tags) == 50
+    for i_writer in range(N_WRITERS):
+        writer_tags = sorted(tag - i_writer * 100 for tag in tags if i_writer * 100 <= tag < (i_writer + 1) * 100)
+        assert writer_tags == list(range(N_EPISODES - len(writer_tags), N_EPISODES))
+
+    check_batch(replay.sample(50))
+
+    #The segments are unlinked by close()
+    replay.close()
+    for name in segment_names:
+        with pytest.raises(FileNotFoundError):
+            replay._shared_memory.SharedMemory(name=name)
+        if os.path.isdir("/dev/shm"):
+            assert not os.path.exists(os.path.join("/dev/shm", name.lstrip("/")))
@@ -0,0 +1,65 @@
+#VideoRecorder: frames from a fake frame source are encoded to a file, and recording is skipped without a renderer
+
+import os
+import re
+import subprocess
+import numpy as np
+import pytest
+import skvideo
+
+from SAC.utils import VideoRecorder
+
+class FakeFrameSource():
+
+    #Stands in for Muscle_Env.render(mode='rgb_array'): a square moving over a gradient
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.n_rendered = 0
+
+    def render(self, mode='human', width=64, height=48):
+
+        if self.fail:
+            raise RuntimeError("Failed to initialize OpenGL")
+
+        frame = np.zeros((height, width, 3), dtype=np.uint8)
+        frame[..., 0] = np.linspace(0, 255, width, dtype=np.uint8)
+        x = (4 * self.n_rendered) % (width - 8)
+        frame[8:16, x:x + 8] = 255
+        self.n_rendered += 1
+
+        return frame
+
+def decode(filename):
+
+    #Raw rgb24 frames and the (height, width) of the video stream, decoded with the ffmpeg used by skvideo
+    result = subprocess.run([os.path.join(skvideo.getFFmpegPath(), "ffmpeg"), "-i", filename, "-f", "rawvideo", "-pix_fmt", "rgb24", "-"],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    width, height = map(int, re.search(rb"Stream .*Video: .*?(\d{2,})x(\d{2,})", result.stderr).groups())
+
+    return np.frombuffer(result.stdout, dtype=np.uint8).reshape(-1, height, width, 3)
+
+@pytest.mark.skipif(skvideo.getFFmpegVersion() == "0.0.0", reason="FFmpeg is not installed")
+def test_video_recorder_writes_every_frame(tmp_path):
+
+    source = FakeFrameSource()
+    assert VideoRecorder.unavailable_reason(source, 64, 48) is None
+
+    filename = str(tmp_path / 'video_cond_0.mp4')
+    video_recorder = VideoRecorder(filename, 25, max_queued_frames=4)
+    frames = [source.render(mode='rgb_array', width=64, height=48) for _ in range(30)]
+    for frame in frames:
+        video_recorder.add_frame(frame)
+    video_recorder.close()
+
+    assert os.path.getsize(filename) > 0
+
+    decoded = decode(filename)
+    assert decoded.shape == (30, 48, 64, 3)
+
+    #Lossy encoding: the frames only match approximately
+    assert np.abs(decoded.astype(np.float64) - np.array(frames)).mean() < 10
+
+def test_video_recording_is_skipped_without_renderer():
+
+    reason = VideoRecorder.unavailable_reason(FakeFrameSource(fail=True), 64, 48)
+    assert reason is not None and "offscreen rendering failed" in reason